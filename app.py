@@ -1,6 +1,8 @@
 import streamlit as st
 import pandas as pd
+import hashlib
 import logic
+import pipeline
 import utils
 import io
 import os
@@ -93,6 +95,28 @@ if 'modo_calculado' not in st.session_state:
     st.session_state.modo_calculado = None
 if 'show_docs' not in st.session_state:
     st.session_state.show_docs = False
+if 'resultados_por_origen' not in st.session_state:
+    st.session_state.resultados_por_origen = None
+if 'parametros_calculo' not in st.session_state:
+    st.session_state.parametros_calculo = None
+if 'barrido' not in st.session_state:
+    st.session_state.barrido = None
+if 'comparacion_metodos' not in st.session_state:
+    st.session_state.comparacion_metodos = None
+if 'riesgo_quiebre' not in st.session_state:
+    st.session_state.riesgo_quiebre = None
+if 'simulacion_semanas' not in st.session_state:
+    st.session_state.simulacion_semanas = None
+if 'rebalanceo_red' not in st.session_state:
+    st.session_state.rebalanceo_red = None
+if 'cargas' not in st.session_state:
+    st.session_state.cargas = None
+if 'retornos' not in st.session_state:
+    st.session_state.retornos = None
+if 'historial_cargado' not in st.session_state:
+    st.session_state.historial_cargado = (None, None)
+if 'cache_pipeline' not in st.session_state:
+    st.session_state.cache_pipeline = {}
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -145,6 +169,58 @@ def mostrar_documentacion():
         )
 
 
+# ─────────────────────────────────────────────────────────────────────────────
+# FUNCIÓN: Coberturas finales y limpieza del resultado de Reposición
+# ─────────────────────────────────────────────────────────────────────────────
+def completar_resultado_reposicion(df_final, sucursal_origen):
+    """
+    Agrega las coberturas post envío y redondea las columnas de cantidades.
+    """
+    # Asegurar que existan columnas de tránsito
+    for col in [c for datos in logic.SUCURSALES.values() for c in (datos['entrante'], datos['transito'])]:
+        if col not in df_final.columns:
+            df_final[col] = 0
+
+    # --- CÁLCULO DE COBERTURAS FINALES (Post Envío) - DINÁMICO ---
+    df_final = logic.calcular_coberturas_finales(df_final, sucursal_origen.lower())
+
+    # Las columnas auxiliares no se muestran: se reconstruyen por SKU con "Explicar cálculo"
+    df_final = df_final.drop(columns=logic.columnas_auxiliares(df_final))
+
+    # --- LIMPIEZA DE DECIMALES ---
+    for col in df_final.columns:
+        condicion_enteros = any(x in col for x in ['qty', 'qpres', 'qrem', 'stock', 'final_enviar', 'transito'])
+        no_es_peso_vol = 'peso' not in col and 'volumen' not in col and 'cobertura' not in col
+
+        if pd.api.types.is_numeric_dtype(df_final[col]):
+            if condicion_enteros and no_es_peso_vol:
+                df_final[col] = df_final[col].fillna(0).round(0).astype(int)
+            elif 'diff' in col:
+                df_final[col] = df_final[col].fillna(0).round(2)
+
+    return df_final
+
+def mostrar_vista_previa(contenedor, df_previa, sucursal_origen, total_skus):
+    """
+    Vista previa de los envíos de los SKUs prioritarios mientras se completa el catálogo.
+    """
+    destinos = [s for s in logic.SUCURSALES if s != sucursal_origen and f'final_enviar_{s}' in df_previa.columns]
+    peso = pd.to_numeric(df_previa['peso'], errors='coerce').fillna(0) if 'peso' in df_previa.columns else 0
+    with contenedor.container():
+        st.info(f"⚡ **Vista previa:** {len(df_previa):,} SKUs prioritarios de {total_skus:,}. Completando el resto del catálogo...")
+        columnas = st.columns(len(destinos)) if destinos else []
+        for col, suc in zip(columnas, destinos):
+            envio = df_previa[f'final_enviar_{suc}']
+            col.metric(f"📦 {suc.upper()}", f"{envio.sum():,.0f} u", f"{(envio * peso).sum():,.0f} kg", delta_color="off")
+        cols_envio = [f'final_enviar_{s}' for s in destinos]
+        con_envio = df_previa[df_previa[cols_envio].sum(axis=1) > 0] if cols_envio else df_previa.iloc[0:0]
+        cols_ver = [c for c in logic.COLUMNAS_IDENTIFICACION + ['demanda_estimada_total'] + cols_envio if c in con_envio.columns]
+        st.dataframe(
+            con_envio.nlargest(200, 'demanda_estimada_total')[cols_ver],
+            use_container_width=True, hide_index=True
+        )
+
+
 # --- BARRA LATERAL (SIDEBAR) ---
 with st.sidebar:
     st.image("https://cdn-icons-png.flaticon.com/512/4143/4143163.png", width=60)
@@ -172,7 +248,7 @@ with st.sidebar:
 
     # Sección 2: Filtro de Familias
     st.subheader("🗂️ Familias Lógicas")
-    familias_opciones = ['GET', 'RODAJE', 'DONALDSON', 'TURBO', 'KTN', 'REPUESTOS', 'OTROS']
+    familias_opciones = logic.FAMILIAS_LOGICAS
     familias_seleccionadas = st.multiselect(
         "Seleccionar Familias:",
         options=familias_opciones,
@@ -186,18 +262,29 @@ with st.sidebar:
         st.subheader("📍 Sucursal Origen")
         sucursal_origen = st.selectbox(
             "Seleccione Origen:",
-            ["SF", "BA", "MDZ", "SLT"],
+            [s.upper() for s in logic.SUCURSALES],
             index=0,
             help="Sucursal desde donde se enviará el stock"
         )
+        evaluar_todos_origenes = st.checkbox(
+            "Evaluar todos los orígenes",
+            value=False,
+            help="Calcula los envíos de todas las sucursales como origen en una sola pasada. Luego se puede cambiar el origen sin recalcular."
+        )
+        vista_previa = st.checkbox(
+            "⚡ Vista previa progresiva",
+            value=False,
+            disabled=evaluar_todos_origenes,
+            help="Muestra primero los envíos de los SKUs prioritarios (menos de 1 mes de cobertura o mayor demanda) y luego completa el catálogo."
+        )
 
         st.subheader("📊 Lógica de Demanda")
         metodo_demanda = st.radio(
             "Método Estimación:",
-            ('A', 'B'),
+            ('A', 'B', 'C'),
             index=1,
             horizontal=True,
-            help="**Método A (Teórico):** Basado en parque de máquinas (Population) y coeficientes de familia.\n\n**Método B (Histórico):** Basado en histórico de ventas/reemplazos reciente (Recomendado)."
+            help="**Método A (Teórico):** Basado en parque de máquinas (Population) y coeficientes de familia.\n\n**Método B (Histórico):** Basado en histórico de ventas/reemplazos reciente (Recomendado).\n\n**Método C (Suavizado):** Proyecta 12 meses a partir del historial mensual, con tendencia y estacionalidad."
         )
 
         st.subheader("🎯 Coberturas (En meses)")
@@ -215,16 +302,33 @@ with st.sidebar:
             min_value=0.0,
             help="Cobertura en meses para todas las sucursales destino"
         )
+
+        st.subheader("🚚 Capacidad por Destino")
+        limitar_capacidad = st.checkbox(
+            "Limitar envíos por capacidad",
+            value=False,
+            help="Recorta los envíos de cada destino al peso/volumen disponible (ej: camión semanal), priorizando los productos en riesgo. Las líneas se recortan en cajas o juegos completos."
+        )
+        capacidad_destinos = {}
+        if limitar_capacidad:
+            for suc in logic.SUCURSALES:
+                if suc == sucursal_origen.lower():
+                    continue
+                c_cap1, c_cap2 = st.columns(2)
+                peso_max = c_cap1.number_input(f"{suc.upper()} (kg)", value=0.0, step=500.0, min_value=0.0, help="0 = sin límite", key=f"cap_peso_{suc}")
+                volumen_max = c_cap2.number_input(f"{suc.upper()} (m³)", value=0.0, step=1.0, min_value=0.0, help="0 = sin límite", key=f"cap_vol_{suc}")
+                if peso_max or volumen_max:
+                    capacidad_destinos[suc] = (peso_max, volumen_max)
         
     else:
         # Parametros modo Devolución
         st.subheader("📊 Parámetros Devolución")
         metodo_demanda = st.radio(
             "Método Estimación (Base):", 
-            ('A', 'B'), 
+            ('A', 'B', 'C'), 
             index=1,
             horizontal=True,
-            help="**Método A:** Cálculo Teórico (Parque).\n**Método B:** Cálculo Histórico (Rotación)."
+            help="**Método A:** Cálculo Teórico (Parque).\n**Método B:** Cálculo Histórico (Rotación).\n**Método C:** Suavizado del historial mensual."
         )
         
         st.markdown("---")
@@ -238,6 +342,33 @@ with st.sidebar:
         meses_equiv = umbral_devolucion * 12
         st.caption(f"ℹ️ Se considerará sobrante todo stock que supere los **{meses_equiv:.1f} meses** de cobertura.")
 
+        cob_transferencia_meses = None
+        if st.checkbox("🔀 Transferencias entre sucursales", value=False,
+                       help="Cruza los sobrantes de cada sucursal con los faltantes de las otras antes de devolver a SF."):
+            cob_transferencia_meses = st.number_input(
+                "Cobertura objetivo de quien recibe (meses)",
+                value=3.0,
+                step=0.5,
+                min_value=0.5,
+                help="Las sucursales sin sobrante piden hasta esta cobertura. El resto del sobrante vuelve a SF."
+            )
+
+    historial_mensual = None
+    if metodo_demanda == 'C':
+        archivo_historial = st.file_uploader(
+            "Historial mensual (CSV):", type=['csv'], key="archivo_historial",
+            help="Columnas: codigo, sucursal, mes (AAAA-MM), cantidad. Los SKUs sin historial usan el Método B."
+        )
+        # Se parsea y se hashea una sola vez por archivo subido
+        clave_historial = hashlib.sha1(archivo_historial.getvalue()).hexdigest() if archivo_historial is not None else None
+        if st.session_state.historial_cargado[0] != clave_historial:
+            st.session_state.historial_cargado = (clave_historial, utils.cargar_historial(archivo_historial))
+        historial_mensual = st.session_state.historial_cargado[1]
+        if historial_mensual is not None:
+            st.caption(f"ℹ️ Historial de **{len(historial_mensual)} SKUs** y **{historial_mensual.columns.get_level_values(1).nunique()} meses**.")
+        elif archivo_historial is not None:
+            st.error("❌ No se pudo leer el historial mensual.")
+
     # ─── BOTÓN DE DOCUMENTACIÓN (al final del sidebar) ───────────────────────
     st.divider()
     if st.button("📖 Manual de Usuario", use_container_width=True, help="Ver la documentación completa del sistema"):
@@ -311,88 +442,108 @@ else:
             if process_clicked:
                 if len(df) == 0:
                     st.error("⚠️ No hay datos para procesar.")
+                elif metodo_demanda == 'C' and historial_mensual is None:
+                    st.error("⚠️ El Método C requiere cargar el historial mensual en la barra lateral.")
                 else:
                     with st.spinner('🔄 Procesando lógica de negocio...'):
                         
-                        # 1. Cálculos Comunes (W y Demanda)
-                        df_proc = logic.calcular_parametros_w(df)
-                        
-                        # Filtro Familias
-                        if familias_seleccionadas:
-                            df_proc = df_proc[df_proc['familia_logica'].isin(familias_seleccionadas)]
+                        # 1. Cálculos Comunes (W, Familias y Demanda)
+                        # Las etapas se cachean por hash de datos + parámetros: solo se recalcula lo que cambió
+                        parametros = {
+                            'familias': familias_seleccionadas,
+                            'metodo_demanda': metodo_demanda,
+                            'historial_mensual': historial_mensual,
+                            'clave_historial': st.session_state.historial_cargado[0] if historial_mensual is not None else None,
+                        }
+                        if modo_analisis == "Reposición (Envío)":
+                            parametros.update({
+                                'sucursal_origen': sucursal_origen.lower(),
+                                'cob_origen_meses': cob_origen_meses,
+                                'cob_destino_meses': cob_destino_meses,
+                                'capacidad_destinos': capacidad_destinos or None,
+                            })
+                        else:
+                            parametros['umbral_devolucion'] = umbral_devolucion
+                            parametros['cob_transferencia_meses'] = cob_transferencia_meses
+
+                        clave_datos = pipeline.hash_datos(df)
+                        df_proc, _ = pipeline.ejecutar_pipeline(
+                            df, parametros, etapas=pipeline.ETAPAS_COMUNES,
+                            cache=st.session_state.cache_pipeline, clave_datos=clave_datos,
+                            puntos_cache=pipeline.ETAPAS_CACHEADAS_SESION
+                        )
                         
                         if len(df_proc) == 0:
                             st.warning("⚠️ No hay registros para las familias seleccionadas.")
                             st.session_state.data_calculada = None
                         else:
-                            df_proc = logic.estimar_demanda(df_proc, metodo_demanda)
-                            
                             # ----------------------------------------------------
                             #                 MODO REPOSICIÓN
                             # ----------------------------------------------------
                             if modo_analisis == "Reposición (Envío)":
-                                df_proc = logic.calcular_coberturas(
-                                    df_proc,
-                                    sucursal_origen=sucursal_origen.lower(),
-                                    cob_origen_meses=cob_origen_meses,
-                                    cob_destino_meses=cob_destino_meses
-                                )
-                                df_final = logic.distribuir_stock(df_proc, sucursal_origen=sucursal_origen.lower())
-
-                                # Determinar sucursales destino para cálculos
-                                todas_sucursales = ['SF', 'BA', 'MDZ', 'SLT']
-                                sucursales_destino_view = [s for s in todas_sucursales if s != sucursal_origen.upper()]
-
-                                # Asegurar que existan columnas de tránsito
-                                for col in ['qty_sf', 'qty_ba', 'qty_mdz', 'qty_slt',
-                                           'qty_ot_transito_sf', 'qty_ot_transito_ba',
-                                           'qty_ot_transito_mdz', 'qty_ot_transito_slt']:
-                                    if col not in df_final.columns:
-                                        df_final[col] = 0
-
-                                # --- CÁLCULO DE COBERTURAS FINALES (Post Envío) - DINÁMICO ---
-                                for suc in [s.lower() for s in sucursales_destino_view]:
-                                    if suc == 'sf':
-                                        col_stock = 'stock_total_sf_fisico'
-                                        col_transito = 'qty_ot_transito_sf'
-                                    else:
-                                        col_stock = f'stock_{suc}'
-                                        col_transito = f'qty_ot_transito_{suc}'
-
-                                    col_envio = f'final_enviar_{suc}'
-                                    col_demanda = f'demanda_estimada_{suc}'
-
-                                    if col_stock in df_final.columns and col_envio in df_final.columns:
-                                        stock_final = df_final[col_stock] + df_final.get(col_transito, 0) + df_final[col_envio]
-                                        df_final[f'cobertura_fin_{suc}'] = stock_final / df_final[col_demanda].replace(0, 0.0001)
-
-                                # --- LIMPIEZA DE DECIMALES ---
-                                for col in df_final.columns:
-                                    condicion_enteros = any(x in col for x in ['qty', 'qpres', 'qrem', 'stock', 'final_enviar', 'transito'])
-                                    no_es_peso_vol = 'peso' not in col and 'volumen' not in col and 'cobertura' not in col
-                                    
-                                    if pd.api.types.is_numeric_dtype(df_final[col]):
-                                        if condicion_enteros and no_es_peso_vol:
-                                            df_final[col] = df_final[col].fillna(0).round(0).astype(int)
-                                        elif 'diff' in col:
-                                            df_final[col] = df_final[col].fillna(0).round(2)
+                                if evaluar_todos_origenes:
+                                    # Una sola pasada para todos los orígenes; el selector cambia la vista sin recalcular
+                                    resultados = logic.planificar_multi_origen(
+                                        df_proc,
+                                        cob_origen_meses=cob_origen_meses,
+                                        cob_destino_meses=cob_destino_meses
+                                    )
+                                    if capacidad_destinos:
+                                        resultados = {
+                                            origen: logic.ajustar_a_capacidad(df_origen, capacidad_destinos, origen, cob_destino_meses)
+                                            for origen, df_origen in resultados.items()
+                                        }
+                                    st.session_state.resultados_por_origen = {
+                                        origen: completar_resultado_reposicion(df_origen, origen)
+                                        for origen, df_origen in resultados.items()
+                                    }
+                                    df_final = st.session_state.resultados_por_origen[sucursal_origen.lower()]
+                                elif vista_previa:
+                                    # Primero los SKUs prioritarios; la vista previa se reemplaza al completar
+                                    previa = st.empty()
+                                    for df_final, es_final in pipeline.ejecutar_progresivo(
+                                        df, parametros, etapas=pipeline.ETAPAS_REPOSICION,
+                                        cache=st.session_state.cache_pipeline, clave_datos=clave_datos,
+                                        puntos_cache=pipeline.ETAPAS_CACHEADAS_SESION
+                                    ):
+                                        df_final = completar_resultado_reposicion(df_final, sucursal_origen)
+                                        if es_final:
+                                            previa.empty()
+                                            break
+                                        mostrar_vista_previa(previa, df_final, sucursal_origen.lower(), len(df_proc))
+                                    st.session_state.resultados_por_origen = None
+                                else:
+                                    df_final, _ = pipeline.ejecutar_pipeline(
+                                        df, parametros, etapas=pipeline.ETAPAS_REPOSICION,
+                                        cache=st.session_state.cache_pipeline, clave_datos=clave_datos,
+                                        puntos_cache=pipeline.ETAPAS_CACHEADAS_SESION
+                                    )
+                                    df_final = completar_resultado_reposicion(df_final, sucursal_origen)
+                                    st.session_state.resultados_por_origen = None
 
                                 # GUARDAR EN SESSION STATE
                                 st.session_state.data_calculada = df_final
+                                st.session_state.parametros_calculo = parametros
+                                st.session_state.barrido = None
+                                st.session_state.comparacion_metodos = None
+                                st.session_state.riesgo_quiebre = None
+                                st.session_state.simulacion_semanas = None
+                                st.session_state.rebalanceo_red = None
+                                st.session_state.cargas = None
                                 st.session_state.modo_calculado = "Reposición (Envío)"
 
                             # ----------------------------------------------------
                             #                 MODO DEVOLUCIÓN
                             # ----------------------------------------------------
                             else:
-                                cols_sf_fisico = ['stock_sf', 'stock_aux', 'stock_sv_arg', 'stock_sv_min', 'stock_ns_noa']
-                                for c in cols_sf_fisico: 
-                                    if c not in df_proc.columns: df_proc[c] = 0
-                                df_proc['stock_total_sf_fisico'] = df_proc[cols_sf_fisico].sum(axis=1)
-
-                                df_dev = logic.calcular_excedentes_sucursales(df_proc, umbral_meses_exceso=umbral_devolucion)
+                                df_dev, _ = pipeline.ejecutar_pipeline(
+                                    df, parametros, etapas=pipeline.ETAPAS_DEVOLUCION,
+                                    cache=st.session_state.cache_pipeline, clave_datos=clave_datos,
+                                    puntos_cache=pipeline.ETAPAS_CACHEADAS_SESION
+                                )
                                 
                                 st.session_state.data_calculada = df_dev
+                                st.session_state.retornos = None
                                 st.session_state.modo_calculado = "Devolución (Sobrantes)"
 
 
@@ -402,9 +553,11 @@ else:
                 # REPOSICIÓN
                 if modo_analisis == "Reposición (Envío)":
                     df_final = st.session_state.data_calculada
+                    if st.session_state.resultados_por_origen is not None:
+                        df_final = st.session_state.resultados_por_origen[sucursal_origen.lower()]
 
                     # --- DETERMINAR SUCURSALES DESTINO DINÁMICAMENTE ---
-                    todas_sucursales = ['SF', 'BA', 'MDZ', 'SLT']
+                    todas_sucursales = [s.upper() for s in logic.SUCURSALES]
                     sucursales_destino_view = [s for s in todas_sucursales if s != sucursal_origen.upper()]
 
                     # --- PREPARACIÓN DE DATOS PARA VISTA PRINCIPAL ---
@@ -596,12 +749,8 @@ else:
                         df_view[f'vol_total_{suc}'] = df_view[col_envio] * df_view['volumen']
 
                         col_demanda_orig = f'demanda_estimada_{suc.lower()}'
-                        if suc.upper() == 'SF':
-                            col_stock_orig = 'stock_total_sf_fisico'
-                            col_transito_orig = 'qty_ot_transito_sf'
-                        else:
-                            col_stock_orig = f'stock_{suc.lower()}'
-                            col_transito_orig = f'qty_ot_transito_{suc.lower()}'
+                        col_stock_orig = logic.SUCURSALES[suc.lower()]['stock']
+                        col_transito_orig = logic.SUCURSALES[suc.lower()]['transito']
                         col_enviar_orig = f'final_enviar_{suc.lower()}'
 
                         if col_stock_orig in df_final.columns and col_demanda_orig in df_final.columns:
@@ -645,6 +794,11 @@ else:
                             
                             st.write("")
                             
+                            # Recorte por capacidad del destino
+                            col_recorte = f'recorte_{suc.lower()}'
+                            if col_recorte in df_final.columns and df_final[col_recorte].sum() > 0:
+                                st.info(f"🚚 Por capacidad quedaron fuera **{df_final[col_recorte].sum():,.0f}** unidades en **{int((df_final[col_recorte] > 0).sum())}** líneas.")
+
                             # Alertas de Stock
                             kriticos = df_view[df_view[f'risk_antes_{suc}']].shape[0]
                             cubiertos = df_view[df_view[f'salvados_{suc}']].shape[0]
@@ -665,7 +819,7 @@ else:
                             
                             # Tabla Resumen Agrupada
                             group_cols = ['Familia Logica']
-                            df_grp = df_suc.groupby(group_cols).agg({
+                            df_grp = df_suc.groupby(group_cols, observed=True).agg({
                                 col_envio: 'sum',
                                 f'peso_total_{suc}': 'sum',
                                 f'vol_total_{suc}': 'sum'
@@ -728,6 +882,252 @@ else:
                                 st.dataframe(styled_df, use_container_width=True)
                                 st.caption("Mostrando primeras 1000 filas.")
 
+                    # ==========================================
+                    #       BARRIDO DE COBERTURAS
+                    # ==========================================
+                    st.divider()
+                    with st.expander("📈 Barrido de Coberturas Objetivo", expanded=False):
+                        st.markdown("Compara el resultado de distintas coberturas objetivo sin recalcular el proceso completo.")
+                        opciones_meses = [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 8.0, 9.0, 12.0]
+                        c_sw1, c_sw2 = st.columns(2)
+                        with c_sw1:
+                            meses_origen_sw = st.multiselect(f"Cobertura {sucursal_origen} (meses)", opciones_meses, default=[3.0, 6.0, 9.0])
+                        with c_sw2:
+                            meses_destino_sw = st.multiselect("Cobertura Destinos (meses)", opciones_meses, default=[2.0, 3.0, 4.0, 5.0, 6.0])
+
+                        if st.button("Calcular Barrido", key="btn_barrido"):
+                            grilla = [(o, d) for o in meses_origen_sw for d in meses_destino_sw]
+                            if grilla:
+                                st.session_state.barrido = logic.barrido_coberturas(
+                                    df_final, grilla, sucursal_origen=sucursal_origen.lower()
+                                )
+
+                        df_barrido = st.session_state.barrido
+                        if df_barrido is not None and len(df_barrido) > 0:
+                            for metrica, titulo in [('unidades', 'Unidades a Enviar'), ('peso', 'Peso Total (kg)'),
+                                                    ('volumen', 'Volumen Total (m³)'), ('skus_bajo_1_mes', 'SKUs < 1 mes tras el envío')]:
+                                st.markdown(f"##### {titulo}")
+                                curva = df_barrido.pivot(index='cob_destino_meses', columns='cob_origen_meses', values=metrica)
+                                curva.columns = [f"{sucursal_origen} {c:g} m" for c in curva.columns]
+                                st.line_chart(curva)
+                            st.dataframe(df_barrido, use_container_width=True, hide_index=True)
+
+                    # --- COMPARACIÓN MÉTODO A VS B ---
+                    with st.expander("⚖️ Comparar Método A vs Método B", expanded=False):
+                        st.markdown("Calcula ambos métodos de demanda en una sola pasada y muestra la diferencia de envíos (B − A).")
+                        parametros_calculo = st.session_state.parametros_calculo
+                        if st.button("Comparar Métodos", key="btn_comparar") and parametros_calculo is not None:
+                            df_base, _ = pipeline.ejecutar_pipeline(
+                                df, parametros_calculo, etapas=pipeline.ETAPAS_COMUNES, hasta='familias',
+                                cache=st.session_state.cache_pipeline, clave_datos=pipeline.hash_datos(df),
+                                puntos_cache=pipeline.ETAPAS_CACHEADAS_SESION
+                            )
+                            st.session_state.comparacion_metodos = logic.comparar_metodos(
+                                df_base,
+                                sucursal_origen=sucursal_origen.lower(),
+                                cob_origen_meses=parametros_calculo['cob_origen_meses'],
+                                cob_destino_meses=parametros_calculo['cob_destino_meses']
+                            )
+
+                        df_cmp = st.session_state.comparacion_metodos
+                        if df_cmp is not None and f'delta_enviar_{sucursal_origen.lower()}' not in df_cmp.columns:
+                            destinos_cmp = [s.lower() for s in sucursales_destino_view]
+
+                            # Por sucursal
+                            resumen_cmp = pd.DataFrame({
+                                'Sucursal': [s.upper() for s in destinos_cmp],
+                                'Unidades Método A': [df_cmp[f'final_enviar_{s}_metodo_a'].sum() for s in destinos_cmp],
+                                'Unidades Método B': [df_cmp[f'final_enviar_{s}_metodo_b'].sum() for s in destinos_cmp],
+                                'Diferencia (B − A)': [df_cmp[f'delta_enviar_{s}'].sum() for s in destinos_cmp],
+                            })
+                            st.dataframe(resumen_cmp, use_container_width=True, hide_index=True)
+
+                            # Por SKU (solo los que cambian)
+                            cols_sku = [c for c in ['codigo', 'descripcion', 'familia_logica'] if c in df_cmp.columns]
+                            for s in destinos_cmp:
+                                cols_sku += [f'final_enviar_{s}_metodo_a', f'final_enviar_{s}_metodo_b', f'delta_enviar_{s}']
+                            cols_sku.append('delta_enviar_total')
+                            df_skus_cmp = df_cmp.loc[df_cmp['delta_enviar_total'] != 0, cols_sku]
+                            df_skus_cmp = df_skus_cmp.reindex(df_skus_cmp['delta_enviar_total'].abs().sort_values(ascending=False).index)
+                            st.markdown(f"**{len(df_skus_cmp)} SKUs con envíos distintos entre métodos**")
+                            st.dataframe(df_skus_cmp, use_container_width=True, hide_index=True)
+
+                    # --- SIMULACIÓN DE RIESGO DE QUIEBRE ---
+                    with st.expander("🎲 Simular Riesgo de Quiebre", expanded=False):
+                        st.markdown("Sortea la demanda hasta la próxima reposición y estima la probabilidad de quiebre de cada SKU, sin y con este envío.")
+                        c_mc1, c_mc2, c_mc3 = st.columns(3)
+                        with c_mc1:
+                            n_ensayos_mc = st.number_input("Ensayos", min_value=100, max_value=10000, value=1000, step=100, key="ensayos_riesgo")
+                        with c_mc2:
+                            horizonte_mc = st.number_input("Meses hasta la próxima reposición", min_value=0.25, max_value=6.0, value=1.0, step=0.25, key="horizonte_riesgo")
+                        with c_mc3:
+                            semilla_mc = st.number_input("Semilla", min_value=0, value=0, step=1, key="semilla_riesgo")
+
+                        if st.button("Simular", key="btn_riesgo"):
+                            st.session_state.riesgo_quiebre = logic.simular_riesgo_quiebre(
+                                df_final,
+                                sucursal_origen=sucursal_origen.lower(),
+                                n_ensayos=int(n_ensayos_mc),
+                                horizonte_meses=horizonte_mc,
+                                semilla=int(semilla_mc)
+                            )
+
+                        if st.session_state.riesgo_quiebre is not None:
+                            df_mc, resumen_mc = st.session_state.riesgo_quiebre
+                            if f'prob_quiebre_antes_{sucursal_origen.lower()}' not in df_mc.columns:
+                                st.dataframe(resumen_mc.rename(columns={
+                                    'sucursal': 'Sucursal',
+                                    'skus_quiebre_antes': 'SKUs en quiebre (sin envío)',
+                                    'skus_quiebre_despues': 'SKUs en quiebre (con envío)',
+                                    'skus_quiebre_antes_p95': 'P95 sin envío',
+                                    'skus_quiebre_despues_p95': 'P95 con envío',
+                                }).round(1), use_container_width=True, hide_index=True)
+
+                                # SKUs con mayor probabilidad de quiebre aun con el envío
+                                cols_mc = [c for c in ['codigo', 'descripcion', 'familia_logica'] if c in df_mc.columns]
+                                cols_prob = [c for c in df_mc.columns if c.startswith(('prob_quiebre_antes_', 'prob_quiebre_despues_'))]
+                                cols_despues = [c for c in cols_prob if c.startswith('prob_quiebre_despues_')]
+                                prob_max = df_mc[cols_despues].max(axis=1)
+                                df_top_mc = df_mc.loc[prob_max.nlargest(200).index, cols_mc + cols_prob]
+                                df_top_mc = df_top_mc[df_top_mc[cols_despues].max(axis=1) > 0]
+                                st.markdown(f"**{len(df_top_mc)} SKUs con mayor probabilidad de quiebre tras el envío**")
+                                st.dataframe(df_top_mc.round(3), use_container_width=True, hide_index=True)
+
+                    # --- SIMULACIÓN SEMANA A SEMANA ---
+                    with st.expander("🗓️ Simular Semanas", expanded=False):
+                        st.markdown("Proyecta la red semana a semana: llegan tránsitos y envíos, se consume la demanda y se repite la regla de distribución cada semana.")
+                        c_sem1, c_sem2, c_sem3 = st.columns(3)
+                        with c_sem1:
+                            semanas_sim = st.number_input("Semanas", min_value=1, max_value=52, value=12, step=1, key="semanas_sim")
+                        with c_sem2:
+                            demora_sim = st.number_input("Demora del envío (semanas)", min_value=1, max_value=8, value=1, step=1, key="demora_sim")
+                        with c_sem3:
+                            arribo_sim = st.number_input("Llegada de tránsitos (semana)", min_value=1, max_value=52, value=1, step=1, key="arribo_sim")
+                        demanda_aleatoria = st.checkbox("Demanda semanal aleatoria (Poisson)", value=False, key="demanda_aleatoria_sim")
+
+                        parametros_calculo = st.session_state.parametros_calculo
+                        if st.button("Simular Semanas", key="btn_semanas") and parametros_calculo is not None:
+                            st.session_state.simulacion_semanas = logic.simular_semanas(
+                                df_final,
+                                sucursal_origen=sucursal_origen.lower(),
+                                semanas=int(semanas_sim),
+                                cob_origen_meses=parametros_calculo['cob_origen_meses'],
+                                cob_destino_meses=parametros_calculo['cob_destino_meses'],
+                                demora_envio_semanas=int(demora_sim),
+                                semanas_arribo_transito=int(arribo_sim),
+                                semilla=0 if demanda_aleatoria else None
+                            )
+
+                        df_semanas = st.session_state.simulacion_semanas
+                        if df_semanas is not None:
+                            st.markdown("##### Unidades enviadas por semana")
+                            st.line_chart(df_semanas.set_index('semana')[[f'unidades_{s.lower()}' for s in sucursales_destino_view]])
+                            st.markdown("##### SKUs en quiebre por semana")
+                            st.line_chart(df_semanas.set_index('semana')[[c for c in df_semanas.columns if c.startswith('quiebres_')]])
+                            k_sem1, k_sem2, k_sem3 = st.columns(3)
+                            k_sem1.metric("🚚 Líneas despachadas", f"{df_semanas['lineas_envio'].sum():,.0f}")
+                            k_sem2.metric("📦 Unidades despachadas", f"{df_semanas['unidades_enviadas'].sum():,.0f}")
+                            k_sem3.metric("⚠️ Unidades no abastecidas", f"{df_semanas['unidades_no_abastecidas'].sum():,.0f}")
+                            st.dataframe(df_semanas.round(1), use_container_width=True, hide_index=True)
+
+                    # --- ARMADO DE CAMIONES ---
+                    with st.expander("🚚 Armado de Camiones", expanded=False):
+                        st.markdown("Arma los camiones de cada destino por peso y volumen, sin separar cajas ni juegos completos.")
+                        c_cam1, c_cam2 = st.columns(2)
+                        with c_cam1:
+                            capacidad_peso_cam = st.number_input("Capacidad por camión (kg)", min_value=1.0, value=logic.CAPACIDAD_CAMION_PESO, step=500.0, key="capacidad_peso_cam")
+                        with c_cam2:
+                            capacidad_vol_cam = st.number_input("Capacidad por camión (m³)", min_value=0.1, value=logic.CAPACIDAD_CAMION_VOLUMEN, step=1.0, key="capacidad_vol_cam")
+
+                        if st.button("Armar Camiones", key="btn_camiones"):
+                            st.session_state.cargas = logic.armar_cargas(
+                                df_final,
+                                sucursal_origen=sucursal_origen.lower(),
+                                capacidad_peso=capacidad_peso_cam,
+                                capacidad_volumen=capacidad_vol_cam
+                            )
+
+                        if st.session_state.cargas is not None:
+                            manifiesto_cam, resumen_cam = st.session_state.cargas
+                            if len(resumen_cam) > 0 and sucursal_origen.lower() not in resumen_cam['destino'].values:
+                                st.dataframe(resumen_cam.assign(
+                                    destino=resumen_cam['destino'].str.upper(),
+                                    ocupacion_peso=(resumen_cam['ocupacion_peso'] * 100).round(1),
+                                    ocupacion_volumen=(resumen_cam['ocupacion_volumen'] * 100).round(1),
+                                ).rename(columns={
+                                    'destino': 'Destino', 'camiones': 'Camiones', 'lineas': 'Líneas', 'unidades': 'Unidades',
+                                    'peso': 'Peso (kg)', 'volumen': 'Volumen (m³)',
+                                    'ocupacion_peso': 'Ocupación Peso (%)', 'ocupacion_volumen': 'Ocupación Volumen (%)',
+                                }).round(2), use_container_width=True, hide_index=True)
+
+                                destino_cam = st.selectbox("Manifiesto del destino", resumen_cam['destino'].str.upper().tolist(), key="destino_cam")
+                                st.dataframe(manifiesto_cam[manifiesto_cam['destino'] == destino_cam.lower()].round(2), use_container_width=True, hide_index=True)
+
+                                buffer_cam = io.BytesIO()
+                                with pd.ExcelWriter(buffer_cam, engine='xlsxwriter') as writer:
+                                    for destino, manifiesto_destino in manifiesto_cam.groupby('destino', sort=False):
+                                        manifiesto_destino.to_excel(writer, index=False, sheet_name=destino.upper())
+                                st.download_button(
+                                    label="📦 DESCARGAR MANIFIESTOS (.XLSX)",
+                                    data=buffer_cam.getvalue(),
+                                    file_name="manifiestos_camiones.xlsx",
+                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                                    key="download_manifiestos"
+                                )
+
+                    # --- REBALANCEO DE TODA LA RED ---
+                    with st.expander("🔀 Rebalanceo de Red (todas las sucursales)", expanded=False):
+                        st.markdown("Resuelve en una sola pasada los envíos entre todas las sucursales: cada una con excedente puede abastecer a cualquier otra con faltante, con las mismas reglas de cajas y juegos.")
+                        parametros_calculo = st.session_state.parametros_calculo
+                        if st.button("Calcular Rebalanceo", key="btn_red") and parametros_calculo is not None:
+                            st.session_state.rebalanceo_red, _ = pipeline.ejecutar_pipeline(
+                                df, parametros_calculo, etapas=pipeline.ETAPAS_RED,
+                                cache=st.session_state.cache_pipeline, clave_datos=pipeline.hash_datos(df),
+                                puntos_cache=pipeline.ETAPAS_CACHEADAS_SESION
+                            )
+
+                        df_red = st.session_state.rebalanceo_red
+                        if df_red is not None:
+                            peso_red = pd.to_numeric(df_red['peso'], errors='coerce').fillna(0) if 'peso' in df_red.columns else 0
+                            vol_red = pd.to_numeric(df_red['volumen'], errors='coerce').fillna(0) if 'volumen' in df_red.columns else 0
+                            cols_tramos = [c for c in df_red.columns if c.startswith('enviar_') and '_a_' in c]
+
+                            # Por tramo origen -> destino
+                            resumen_red = pd.DataFrame([
+                                {
+                                    'Origen': c[len('enviar_'):].split('_a_')[0].upper(),
+                                    'Destino': c.split('_a_')[1].upper(),
+                                    'Unidades': df_red[c].sum(),
+                                    'SKUs': int((df_red[c] > 0).sum()),
+                                    'Peso (kg)': (df_red[c] * peso_red).sum(),
+                                    'Volumen (m³)': (df_red[c] * vol_red).sum(),
+                                }
+                                for c in cols_tramos
+                            ])
+                            resumen_red = resumen_red[resumen_red['Unidades'] > 0]
+                            st.dataframe(resumen_red.round(2), use_container_width=True, hide_index=True)
+
+                            # Por SKU (solo los que se mueven)
+                            cols_sku_red = [c for c in ['codigo', 'descripcion', 'familia_logica'] if c in df_red.columns]
+                            df_skus_red = df_red.loc[(df_red[cols_tramos] > 0).any(axis=1), cols_sku_red + cols_tramos]
+                            df_skus_red = df_skus_red.loc[:, (df_skus_red != 0).any(axis=0) | df_skus_red.columns.isin(cols_sku_red)]
+                            st.markdown(f"**{len(df_skus_red)} SKUs con transferencias**")
+                            st.dataframe(df_skus_red, use_container_width=True, hide_index=True)
+
+                    # --- TRAZA DE CÁLCULO DE UN SKU ---
+                    with st.expander("🔎 Explicar cálculo de un SKU", expanded=False):
+                        st.markdown("Recalcula paso a paso la demanda, coberturas, necesidad y envío de un código.")
+                        codigo_explicar = st.text_input("Código", key="codigo_explicar").strip()
+                        parametros_calculo = st.session_state.parametros_calculo
+                        if codigo_explicar and parametros_calculo is not None:
+                            parametros_sku = dict(parametros_calculo, sucursal_origen=sucursal_origen.lower())
+                            traza = pipeline.explicar_sku(df, codigo_explicar, parametros_sku, resultado=df_final)
+                            if traza is None:
+                                st.warning(f"⚠️ El código {codigo_explicar} no está en los datos cargados.")
+                            else:
+                                st.dataframe(traza['sku'].astype(str).rename('valor'), use_container_width=True)
+                                st.dataframe(traza['sucursales'].round(2), use_container_width=True)
+
                     # ==========================================
                     #       BOTONES DE DESCARGA (FUERA DEL LOOP)
                     # ==========================================
@@ -859,7 +1259,32 @@ else:
                     </div>
                     """, unsafe_allow_html=True)
                     
-                    sucursales_view = ['BA', 'MDZ', 'SLT']
+                    sucursales_view = [s.upper() for s in logic.SUCURSALES if s != logic.SUCURSAL_CENTRAL]
+                    hay_transferencias = any(c.startswith('transferir_') for c in df_dev.columns)
+
+                    if hay_transferencias:
+                        st.markdown("##### 🔀 Transferencias entre Sucursales")
+                        filas_tramos = []
+                        for col in [c for c in df_dev.columns if c.startswith('transferir_')]:
+                            origen, destino = col[len('transferir_'):].split('_a_')
+                            unidades = df_dev[col]
+                            filas_tramos.append({
+                                'Origen': origen.upper(),
+                                'Destino': destino.upper(),
+                                'Items': int((unidades > 0).sum()),
+                                'Unidades': unidades.sum(),
+                                'Peso (kg)': (unidades * df_dev['peso']).sum(),
+                                'Volumen (m³)': (unidades * df_dev['volumen']).sum(),
+                            })
+                        df_tramos = pd.DataFrame(filas_tramos)
+                        df_tramos = df_tramos[df_tramos['Unidades'] > 0]
+                        if len(df_tramos) == 0:
+                            st.info("Ningún sobrante cubre faltantes de otra sucursal: todo vuelve a SF.")
+                        else:
+                            st.dataframe(df_tramos.style.format({
+                                'Unidades': '{:,.0f}', 'Peso (kg)': '{:,.2f}', 'Volumen (m³)': '{:,.2f}'
+                            }), use_container_width=True, hide_index=True)
+
                     tabs = st.tabs([f"📍 {s}" for s in sucursales_view])
                     
                     for i, suc in enumerate(sucursales_view):
@@ -880,13 +1305,22 @@ else:
                                 total_peso = df_suc_dev[col_exc_peso].sum()
                                 total_vol = df_suc_dev[col_exc_vol].sum()
                                 
+                                col_peso_retorno = f'retorno_peso_{suc.lower()}' if hay_transferencias else col_exc_peso
                                 items_match = df_suc_dev[df_suc_dev[col_prioridad]].shape[0]
-                                kg_match = df_suc_dev[df_suc_dev[col_prioridad]][col_exc_peso].sum()
+                                kg_match = df_suc_dev[df_suc_dev[col_prioridad]][col_peso_retorno].sum()
 
                                 c1.metric("Items con Exceso", f"{total_items}")
                                 c2.metric("Unidades Sobrantes", f"{total_unidades:,.0f}")
                                 c3.metric("Peso Sobrante", f"{total_peso:,.0f} kg")
                                 c4.metric("Volumen Sobrante", f"{total_vol:,.2f} m³")
+
+                                if hay_transferencias:
+                                    transferido = total_unidades - df_suc_dev[f'retorno_qty_{suc.lower()}'].sum()
+                                    st.caption(
+                                        f"🔀 {transferido:,.0f} unidades se transfieren a otras sucursales; "
+                                        f"vuelven a SF {total_unidades - transferido:,.0f} unidades "
+                                        f"({df_suc_dev[col_peso_retorno].sum():,.0f} kg)."
+                                    )
                                 
                                 st.write("")
                                 if items_match > 0:
@@ -898,7 +1332,7 @@ else:
                                     """, unsafe_allow_html=True)
                                 
                                 st.markdown("##### 📦 Detalle por Familia")
-                                df_grp = df_suc_dev.groupby('familia_logica').agg({
+                                df_grp = df_suc_dev.groupby('familia_logica', observed=True).agg({
                                     col_exc_qty: 'sum',
                                     col_exc_peso: 'sum',
                                     col_exc_vol: 'sum',
@@ -915,14 +1349,73 @@ else:
                                 
                                 with st.expander(f"Ver detalle SKU de {suc}"):
                                     cols_detalle = ['familia_logica', 'codigo', 'descripcion', f'stock_{suc.lower()}', f'demanda_estimada_{suc.lower()}', col_exc_qty, col_prioridad]
+                                    if hay_transferencias:
+                                        cols_detalle.insert(-1, f'retorno_qty_{suc.lower()}')
                                     df_show_sku = df_suc_dev[cols_detalle].rename(columns={
                                         f'stock_{suc.lower()}': 'Stock Actual',
                                         f'demanda_estimada_{suc.lower()}': 'Demanda',
                                         col_exc_qty: 'Excedente Sugerido',
+                                        f'retorno_qty_{suc.lower()}': 'Vuelve a SF',
                                         col_prioridad: 'Sirve a SF?'
                                     })
                                     st.dataframe(df_show_sku, use_container_width=True)
 
+                    # --- CONSOLIDACIÓN DE RETORNOS EN CAMIONES ---
+                    st.divider()
+                    with st.expander("🚚 Consolidación de Retornos a SF", expanded=False):
+                        st.markdown("Agrupa lo que vuelve de cada sucursal en camiones por peso y volumen. Las líneas que más déficit de SF cubren por kg viajan en los primeros camiones.")
+                        c_ret1, c_ret2 = st.columns(2)
+                        with c_ret1:
+                            capacidad_peso_ret = st.number_input("Capacidad por camión (kg)", min_value=1.0, value=logic.CAPACIDAD_CAMION_PESO, step=500.0, key="capacidad_peso_ret")
+                        with c_ret2:
+                            capacidad_vol_ret = st.number_input("Capacidad por camión (m³)", min_value=0.1, value=logic.CAPACIDAD_CAMION_VOLUMEN, step=1.0, key="capacidad_vol_ret")
+
+                        if st.button("Consolidar Retornos", key="btn_retornos"):
+                            st.session_state.retornos = logic.armar_retornos(
+                                df_dev, capacidad_peso=capacidad_peso_ret, capacidad_volumen=capacidad_vol_ret
+                            )
+
+                        if st.session_state.retornos is not None:
+                            manifiesto_ret, resumen_ret = st.session_state.retornos
+                            if len(resumen_ret) == 0:
+                                st.success("✅ No hay sobrantes para devolver a SF.")
+                            else:
+                                por_sucursal = resumen_ret.groupby('sucursal', sort=False).agg(
+                                    camiones=('camion', 'size'),
+                                    camiones_sin_valor=('valor', lambda v: int((v <= 0).sum())),
+                                    lineas=('lineas', 'sum'), unidades=('unidades', 'sum'),
+                                    peso=('peso', 'sum'), volumen=('volumen', 'sum'), valor=('valor', 'sum'),
+                                ).reset_index()
+                                st.dataframe(por_sucursal.assign(sucursal=por_sucursal['sucursal'].str.upper()).rename(columns={
+                                    'sucursal': 'Sucursal', 'camiones': 'Camiones', 'camiones_sin_valor': 'Camiones sin déficit SF',
+                                    'lineas': 'Líneas', 'unidades': 'Unidades', 'peso': 'Peso (kg)',
+                                    'volumen': 'Volumen (m³)', 'valor': 'Unidades que cubren déficit SF',
+                                }).round(2), use_container_width=True, hide_index=True)
+
+                                sucursal_ret = st.selectbox("Camiones de la sucursal", por_sucursal['sucursal'].str.upper().tolist(), key="sucursal_ret")
+                                camiones_suc = resumen_ret[resumen_ret['sucursal'] == sucursal_ret.lower()]
+                                st.dataframe(camiones_suc.assign(
+                                    ocupacion_peso=(camiones_suc['ocupacion_peso'] * 100).round(1),
+                                    ocupacion_volumen=(camiones_suc['ocupacion_volumen'] * 100).round(1),
+                                ).rename(columns={
+                                    'camion': 'Camión', 'lineas': 'Líneas', 'unidades': 'Unidades', 'peso': 'Peso (kg)',
+                                    'volumen': 'Volumen (m³)', 'valor': 'Cubre déficit SF (u)',
+                                    'ocupacion_peso': 'Ocupación Peso (%)', 'ocupacion_volumen': 'Ocupación Volumen (%)',
+                                    'valor_por_kg': 'Déficit cubierto por kg',
+                                }).drop(columns=['sucursal']).round(3), use_container_width=True, hide_index=True)
+
+                                buffer_ret = io.BytesIO()
+                                with pd.ExcelWriter(buffer_ret, engine='xlsxwriter') as writer:
+                                    for sucursal, manifiesto_suc in manifiesto_ret.groupby('sucursal', sort=False):
+                                        manifiesto_suc.replace(float('inf'), float('nan')).to_excel(writer, index=False, sheet_name=sucursal.upper())
+                                st.download_button(
+                                    label="📦 DESCARGAR MANIFIESTOS DE RETORNO (.XLSX)",
+                                    data=buffer_ret.getvalue(),
+                                    file_name="manifiestos_retornos.xlsx",
+                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                                    key="download_retornos"
+                                )
+
                     # Descarga Global de Devoluciones (EXCEL CON FORMATO)
                     st.divider()
                     st.markdown("### 📥 Descargas Globales")
@@ -2,6 +2,118 @@ import pandas as pd
 import numpy as np
 import math
 
+# Familias lógicas en orden de precedencia de las reglas 1-a a 1-f
+FAMILIAS_LOGICAS = ['GET', 'RODAJE', 'DONALDSON', 'TURBO', 'KTN', 'REPUESTOS', 'OTROS']
+
+# Regla de cajas (Filtros): tamaño de caja -> máximo de unidades faltantes para completarla
+REGLAS_CAJAS_FILTROS = {
+    6: 2,
+    12: 3,
+}
+
+# Familias consideradas "Filtros" para lógica de cajas (el resto usa lógica de juegos)
+FAMILIAS_FILTROS = ['DONALDSON', 'TURBO', 'KTN']
+
+# Registro de sucursales de la red. El orden del registro es el orden de las
+# columnas en las matrices SKU x sucursal (ver construir_matrices).
+#   rem / pres: remitido y presupuestado (365 días)
+#   depositos: columnas de stock físico que se suman para la sucursal
+#   stock: columna de stock físico consolidado
+#   transito: tránsito por OT
+#   entrante: envío entrante ya comprometido
+#   transito_devolucion: tránsito considerado en el modo Devolución
+SUCURSALES = {
+    'sf': {
+        'rem': 'qremsf', 'pres': 'qpressf',
+        'depositos': ['stock_sf', 'stock_aux', 'stock_sv_arg', 'stock_sv_min', 'stock_ns_noa'],
+        'stock': 'stock_total_sf_fisico',
+        'transito': 'qty_ot_transito_sf',
+        'entrante': 'qty_sf',
+        'transito_devolucion': 'qty_ot_transito_sf',
+    },
+    'ba': {
+        'rem': 'qremba', 'pres': 'qpresba',
+        'depositos': ['stock_ba'],
+        'stock': 'stock_ba',
+        'transito': 'qty_ot_transito_ba',
+        'entrante': 'qty_ba',
+        'transito_devolucion': 'qty_transito_ba',
+    },
+    'mdz': {
+        'rem': 'qremmdz', 'pres': 'qpresmdz',
+        'depositos': ['stock_mdz'],
+        'stock': 'stock_mdz',
+        'transito': 'qty_ot_transito_mdz',
+        'entrante': 'qty_mdz',
+        'transito_devolucion': 'qty_transito_mdz',
+    },
+    'slt': {
+        'rem': 'qremslt', 'pres': 'qpresslt',
+        'depositos': ['stock_slt'],
+        'stock': 'stock_slt',
+        'transito': 'qty_ot_transito_slt',
+        'entrante': 'qty_slt',
+        'transito_devolucion': 'qty_ot_transito_slt',
+    },
+}
+
+# Sucursal central: recibe las devoluciones de la red
+SUCURSAL_CENTRAL = 'sf'
+
+def preparar_stock_fisico(df):
+    """
+    Crea la columna de stock físico consolidado de cada sucursal con más de un
+    depósito (SF: Stock SF + Aux + SV ARG + SV MIN + NS NOA).
+    """
+    for datos in SUCURSALES.values():
+        if datos['depositos'] == [datos['stock']]:
+            continue
+        for c in datos['depositos']:
+            if c not in df.columns: df[c] = 0
+        df[datos['stock']] = df[datos['depositos']].sum(axis=1)
+    return df
+
+def construir_matrices(df, sucursales=None):
+    """
+    Representación densa SKU x sucursal de las cantidades por sucursal.
+    Devuelve un dict con matrices float64 contiguas (filas = SKUs, columnas =
+    sucursales en el orden de `sucursales`) para stock, transito, entrante,
+    demanda y diff. Las columnas ausentes se toman como 0.
+
+    Args:
+        df: DataFrame con los datos (stock físico ya consolidado, ver preparar_stock_fisico)
+        sucursales: Lista de códigos de sucursal (por defecto, todo el registro)
+    """
+    if sucursales is None: sucursales = list(SUCURSALES)
+
+    columnas = {
+        'stock': [SUCURSALES[s]['stock'] for s in sucursales],
+        'transito': [SUCURSALES[s]['transito'] for s in sucursales],
+        'entrante': [SUCURSALES[s]['entrante'] for s in sucursales],
+        'demanda': [f'demanda_estimada_{s}' for s in sucursales],
+        'diff': [f'diff_{s}' for s in sucursales],
+    }
+
+    matrices = {'sucursales': list(sucursales)}
+    for nombre, cols in columnas.items():
+        matriz = np.zeros((len(df), len(cols)))
+        for j, col in enumerate(cols):
+            if col in df.columns:
+                matriz[:, j] = df[col].to_numpy(dtype=float)
+        matrices[nombre] = matriz
+    return matrices
+
+def _columna_sucursal(valores, disperso=False):
+    """
+    Columna por sucursal tal como se guarda en el DataFrame: densa, o en modo
+    disperso como SparseArray con relleno 0 (solo se guardan las celdas no nulas).
+    """
+    return pd.arrays.SparseArray(valores, fill_value=0.0) if disperso else valores
+
+def _serie_densa(serie):
+    """ Versión densa de una columna por sucursal (ver _columna_sucursal). """
+    return serie.sparse.to_dense() if isinstance(serie.dtype, pd.SparseDtype) else serie
+
 def determinar_familia_logica(row):
     """
     Define la familia lógica según reglas 1-a a 1-f.
@@ -25,15 +137,70 @@ def determinar_familia_logica(row):
     else:
         return 'OTROS'
 
-def calcular_parametros_w(df):
+def clasificar_familias(df):
+    """
+    Versión columnar de determinar_familia_logica.
+    Evalúa las reglas 1-a a 1-f una sola vez por cada par distinto
+    (subfamilia, subfamilia2) y devuelve el resultado como columna categórica.
+    """
+    vacio = pd.Series('', index=df.index)
+    col_sf = df['subfamilia'] if 'subfamilia' in df.columns else vacio
+    col_sf2 = df['subfamilia2'] if 'subfamilia2' in df.columns else vacio
+
+    # 1. Pares distintos (subfamilia, subfamilia2)
+    cod_sf, unicos_sf = pd.factorize(col_sf, use_na_sentinel=False)
+    cod_sf2, unicos_sf2 = pd.factorize(col_sf2, use_na_sentinel=False)
+    n_sf2 = max(len(unicos_sf2), 1)
+    cod_par, unicos_par = pd.factorize(cod_sf.astype(np.int64) * n_sf2 + cod_sf2)
+
+    # 2. Textos normalizados solo para los pares distintos
+    textos_sf = pd.Series(unicos_sf, dtype=object).astype(str).str.upper()
+    textos_sf2 = pd.Series(unicos_sf2, dtype=object).astype(str).str.upper()
+    sf = textos_sf.iloc[unicos_par // n_sf2].reset_index(drop=True)
+    sf2 = textos_sf2.iloc[unicos_par % n_sf2].reset_index(drop=True)
+
+    def contiene(serie, texto):
+        return serie.str.contains(texto, regex=False).to_numpy()
+
+    # 3. Mismo orden de precedencia que determinar_familia_logica
+    condiciones = [
+        contiene(sf2, 'GET KTN') | contiene(sf2, 'FIJACION GET'),
+        contiene(sf2, 'RODAJE KTN') | contiene(sf2, 'FIJACION RODAJE'),
+        contiene(sf, 'DONALDSON'),
+        contiene(sf, 'TURBO'),
+        contiene(sf, 'IMPORTADOS') & contiene(sf2, 'FILTROS KTN'),
+        contiene(sf2, 'CAT ALTERNATIVO') | contiene(sf2, 'REPUESTOS KTN') | contiene(sf, 'NORDIC LIGHTS'),
+    ]
+    familias_par = np.select(condiciones, FAMILIAS_LOGICAS[:-1], default='OTROS')
+
+    # 4. Volver a expandir a nivel fila
+    return pd.Series(
+        pd.Categorical(familias_par[cod_par], categories=FAMILIAS_LOGICAS),
+        index=df.index
+    )
+
+def calcular_parametros_w(df, sumas_familia=None):
+    """
+    Familia lógica, Wp por SKU y Wf por familia.
+
+    Args:
+        df: DataFrame con los datos
+        sumas_familia: Sumas de qrem_total / qpres_total por familia lógica ya calculadas
+                       sobre todo el maestro (ej: primera pasada por bloques). Por defecto
+                       se calculan sobre df.
+    """
     # Asignar familia lógica primero
-    df['familia_logica'] = df.apply(determinar_familia_logica, axis=1)
+    df['familia_logica'] = clasificar_familias(df)
 
     # Evitar división por cero
     df['qpres_total'] = df['qpres_total'].replace(0, 1) 
     df['Wp'] = df['qrem_total'] / df['qpres_total']
     
-    familia_stats = df.groupby('familia_logica')[['qrem_total', 'qpres_total']].sum().reset_index()
+    if sumas_familia is None:
+        familia_stats = df.groupby('familia_logica', observed=True)[['qrem_total', 'qpres_total']].sum().reset_index()
+    else:
+        familia_stats = sumas_familia[['qrem_total', 'qpres_total']].rename_axis('familia_logica').reset_index()
+        familia_stats['familia_logica'] = pd.Categorical(familia_stats['familia_logica'], categories=FAMILIAS_LOGICAS)
     # Evitar división por cero en familias
     familia_stats['qpres_total'] = familia_stats['qpres_total'].replace(0, 1)
     familia_stats['Wf'] = familia_stats['qrem_total'] / familia_stats['qpres_total']
@@ -42,342 +209,1426 @@ def calcular_parametros_w(df):
     df['Wf'] = df['Wf'].fillna(0)
     return df
 
-def estimar_demanda(df, metodo):
+def _matrices_demanda(df):
+    """ Matrices SKU x sucursal de remitido y presupuestado (agrega las columnas faltantes en 0). """
+    for datos in SUCURSALES.values():
+        if datos['rem'] not in df.columns: df[datos['rem']] = 0
+        if datos['pres'] not in df.columns: df[datos['pres']] = 0
+
+    rem = df[[datos['rem'] for datos in SUCURSALES.values()]].to_numpy(dtype=float)
+    pres = df[[datos['pres'] for datos in SUCURSALES.values()]].to_numpy(dtype=float)
+    return rem, pres
+
+def _demanda_matriz(rem, pres, Wp, Wf, metodo):
+    """ Demanda por SKU x sucursal según el método (Wp y Wf como columnas (SKUs, 1)). """
+    # Metodo A
+    if metodo == 'A':
+        return np.where(Wp < Wf, Wf * pres, 1.1 * rem)
+
+    # Metodo B
+    return np.select(
+        [
+            rem == 0,
+            (pres > rem) & (pres < (rem * 1.5)),
+            pres >= (rem * 1.5),
+        ],
+        [
+            pres * 0.5,
+            (pres + rem) / 2,
+            rem * 1.5,
+        ],
+        default=rem
+    )
+
+# Suavizado exponencial (Método C): nivel, tendencia amortiguada y estacionalidad mensual
+PARAMETROS_SUAVIZADO = {'alfa': 0.3, 'beta': 0.1, 'gamma': 0.2, 'phi': 0.9}
+MESES_TEMPORADA = 12
+
+def _matriz_historial(codigos, historial):
+    """
+    Historial mensual alineado con los SKUs: array (SKUs, sucursales, meses) en el orden
+    del registro de sucursales, y máscara (SKUs, sucursales) de las celdas con historia
+    (el SKU figura en el historial y la sucursal tiene columnas).
+    historial: DataFrame indexado por código con columnas (sucursal, mes) en orden cronológico.
+    """
+    meses = list(dict.fromkeys(historial.columns.get_level_values(1)))
+    columnas = pd.MultiIndex.from_product([list(SUCURSALES), meses])
+    valores = np.nan_to_num(historial.reindex(columns=columnas).to_numpy(dtype=float))
+
+    # Los códigos se comparan como texto (el maestro puede leerlos como números)
+    posicion = historial.index.astype(str).get_indexer(pd.Index(codigos).astype(str))
+    sku_presente = posicion >= 0
+    matriz = np.zeros((len(codigos), len(columnas)))
+    matriz[sku_presente] = valores[posicion[sku_presente]]
+    sucursales_historial = set(historial.columns.get_level_values(0))
+    sucursal_presente = np.array([suc in sucursales_historial for suc in SUCURSALES])
+    presente = sku_presente[:, None] & sucursal_presente[None, :]
+    return matriz.reshape(len(codigos), len(SUCURSALES), len(meses)), presente
+
+def _suavizado_exponencial(serie, alfa, beta, gamma, phi, temporada=MESES_TEMPORADA):
+    """
+    Holt-Winters aditivo con tendencia amortiguada para todas las series a la vez: cada
+    mes actualiza nivel, tendencia y estacionalidad de todo el array (el único bucle es
+    sobre los meses). Con menos de dos temporadas de historia no se usa estacionalidad.
+
+    Args:
+        serie: Array (..., meses) de cantidades mensuales
+        alfa, beta, gamma: Pesos de nivel, tendencia y estacionalidad
+        phi: Amortiguación de la tendencia al proyectar
+
+    Returns:
+        Array (...) con la demanda proyectada de los próximos 12 meses (nunca negativa)
+    """
+    n_meses = serie.shape[-1]
+    serie = np.moveaxis(serie, -1, 0)
+    if n_meses >= 2 * temporada:
+        # Arranque con la primera temporada: el promedio es el nivel a mitad de temporada
+        # y la estacionalidad es lo que queda tras descontar la tendencia
+        primera = serie[:temporada].mean(axis=0)
+        tendencia = (serie[temporada:2 * temporada].mean(axis=0) - primera) / temporada
+        desde_mitad = (np.arange(temporada) - (temporada - 1) / 2).reshape((temporada,) + (1,) * primera.ndim)
+        estacion = serie[:temporada] - (primera + desde_mitad * tendencia)
+        nivel = primera + tendencia * (temporada - 1) / 2
+        inicio = temporada
+    else:
+        nivel = serie[0]
+        tendencia = serie[1] - serie[0] if n_meses > 1 else np.zeros_like(nivel)
+        estacion = np.zeros((temporada,) + nivel.shape)
+        gamma = 0.0
+        inicio = 1
+
+    for t in range(inicio, n_meses):
+        e = t % temporada
+        nivel_anterior = nivel
+        nivel = alfa * (serie[t] - estacion[e]) + (1 - alfa) * (nivel + phi * tendencia)
+        tendencia = beta * (nivel - nivel_anterior) + (1 - beta) * phi * tendencia
+        estacion[e] = gamma * (serie[t] - nivel) + (1 - gamma) * estacion[e]
+
+    # Proyección mes a mes: nivel + (phi + ... + phi^h) * tendencia + estacionalidad
+    horizonte = np.arange(1, MESES_TEMPORADA + 1)
+    amortiguacion = np.cumsum(phi ** horizonte)
+    total = np.zeros_like(nivel)
+    for h, factor in zip(horizonte, amortiguacion):
+        total += np.maximum(nivel + factor * tendencia + estacion[(n_meses - 1 + h) % temporada], 0)
+    return total
+
+def _demanda_historial(codigos, historial, rem, pres):
+    """
+    Demanda anual por suavizado del historial mensual (Método C). Los SKUs que no
+    figuran en el historial, y las sucursales sin columnas en él, usan el Método B
+    sobre los totales de 365 días.
+    """
+    matriz, presente = _matriz_historial(codigos, historial)
+    demanda = _suavizado_exponencial(matriz, **PARAMETROS_SUAVIZADO)
+    filas = np.flatnonzero(~presente.all(axis=1))
+    if len(filas):
+        metodo_b = _demanda_matriz(rem[filas], pres[filas], None, None, 'B')
+        demanda[filas] = np.where(presente[filas], demanda[filas], metodo_b)
+    return demanda
+
+def _sumar_sucursales(matriz):
+    """ Suma por fila sobre el último eje igual que DataFrame.sum(axis=1): sin NaN y en orden. """
+    total = np.zeros(matriz.shape[:-1])
+    for i in range(matriz.shape[-1]):
+        total = total + np.nan_to_num(matriz[..., i])
+    return total
+
+def estimar_demanda(df, metodo, disperso=False, historial=None):
     """
     Estima demanda para cada SUCURSAL individualmente y luego SUMA para el TOTAL.
+    Todas las sucursales del registro se calculan juntas sobre una matriz SKU x sucursal.
+
+    Args:
+        df: DataFrame con los datos (Wp y Wf ya calculados)
+        metodo: 'A', 'B' o 'C' (suavizado exponencial del historial mensual)
+        disperso: Calcular solo los SKUs con algún remitido/presupuestado no nulo (en el
+                  resto la demanda es 0 con ambos métodos) y guardar las demandas como
+                  columnas dispersas
+        historial: Para el Método C, DataFrame indexado por código con columnas
+                   (sucursal, mes) en orden cronológico (ver utils.cargar_historial)
+    """
+    # 1. Matrices SKU x sucursal
+    rem, pres = _matrices_demanda(df)
+
+    if metodo == 'C':
+        if historial is None:
+            raise ValueError("El Método C requiere el historial mensual")
+        demanda = _demanda_historial(df['codigo'].to_numpy(), historial, rem, pres)
+        filas = np.flatnonzero((demanda != 0).any(axis=1)) if disperso else slice(None)
+        demanda = demanda[filas]
+    else:
+        filas = slice(None)
+        if disperso:
+            filas = np.flatnonzero(((rem != 0) | (pres != 0)).any(axis=1))
+            rem, pres = rem[filas], pres[filas]
+
+        Wp = df['Wp'].to_numpy(dtype=float)[filas, None] if metodo == 'A' else None
+        Wf = df['Wf'].to_numpy(dtype=float)[filas, None] if metodo == 'A' else None
+        demanda = _demanda_matriz(rem, pres, Wp, Wf, metodo)
+
+    # 2. Volcar demanda individual de cada sucursal
+    cols_demanda_suc = [f'demanda_estimada_{suc}' for suc in SUCURSALES]
+    if not disperso:
+        for i, col_name in enumerate(cols_demanda_suc):
+            df[col_name] = demanda[:, i]
+
+        # 3. Calcular la Demanda Total
+        df['demanda_estimada_total'] = df[cols_demanda_suc].sum(axis=1)
+        return df
+
+    # Modo disperso: solo se materializan las filas calculadas
+    completa = np.zeros((len(df), len(cols_demanda_suc)))
+    completa[filas] = demanda
+    for i, col_name in enumerate(cols_demanda_suc):
+        df[col_name] = _columna_sucursal(completa[:, i], disperso)
+    df['demanda_estimada_total'] = _sumar_sucursales(completa)
+
+    return df
+
+def _preparar_stock(df):
+    """
+    Stock físico consolidado, columnas de tránsito y stock ampliado global (no depende
+    de la demanda). Devuelve las matrices SKU x sucursal.
+    """
+    # Preparar stock físico consolidado (SF suma sus depósitos)
+    preparar_stock_fisico(df)
+
+    # Asegurar que existan todas las columnas de tránsito
+    for datos in SUCURSALES.values():
+        for c in (datos['transito'], datos['entrante']):
+            if c not in df.columns: df[c] = 0
+
+    m = construir_matrices(df)
+
+    # Stock ampliado global = stock físico total + todos los tránsitos OT + todos los envíos entrantes
+    stock_ampliado_global = df['stock_total'] + m['transito'].sum(axis=1) + m['entrante'].sum(axis=1)
+    m['stock_ampliado_global'] = stock_ampliado_global.to_numpy(dtype=float)
+    return m
+
+def _preparar_coberturas(df):
+    """
+    Pasos comunes a cualquier origen: cobertura total, stock físico consolidado,
+    columnas de tránsito y cobertura ampliada global. Devuelve las matrices SKU x sucursal.
     """
-    sucursales = {
-        'sf': ('qremsf', 'qpressf'),
-        'ba': ('qremba', 'qpresba'),
-        'mdz': ('qremmdz', 'qpresmdz'),
-        'slt': ('qremslt', 'qpresslt')
+    # 1. Cobertura TOTAL (GLOBAL) - Física
+    if 'stock_total' not in df.columns: df['stock_total'] = 0
+    df['cobertura_ini_total'] = df['stock_total'] / df['demanda_estimada_total'].replace(0, 0.00001)
+
+    # 2. Stock físico consolidado y tránsitos
+    m = _preparar_stock(df)
+
+    # 2.1 Calcular COBERTURA AMPLIADA GLOBAL (incluye todos los tránsitos y envíos entrantes)
+    # Esto se usa para limitar correctamente los targets de las sucursales destino
+    df['cobertura_ampliada_total'] = m['stock_ampliado_global'] / df['demanda_estimada_total'].replace(0, 0.00001)
+    m['cobertura_ampliada_total'] = df['cobertura_ampliada_total'].to_numpy(dtype=float)
+    return m
+
+def _coberturas_matriz(m, es_origen, cob_origen_años, cob_destino_años):
+    """
+    Coberturas y diferencias sobre las matrices SKU x sucursal.
+    es_origen es un array booleano broadcastable a (..., SKUs, sucursales); con un eje
+    inicial de escenarios se evalúan varios orígenes u objetivos en la misma operación.
+    """
+    demanda_segura = np.where(m['demanda'] == 0, 0.00001, m['demanda'])
+
+    # Stock inicial = físico + tránsito OT; ampliado = inicial + envío entrante
+    stock_inicial = m['stock'] + m['transito']
+    stock_ampliado = stock_inicial + m['entrante']
+
+    # Objetivo efectivo (limitado por la cobertura ampliada global)
+    target_eff = np.minimum(
+        np.where(es_origen, cob_origen_años, cob_destino_años),
+        m['cobertura_ampliada_total'][..., None]
+    )
+
+    # Diferencia: el origen usa STOCK AMPLIADO (considera envío entrante para decidir si hay excedente)
+    stock_base = np.where(es_origen, stock_ampliado, stock_inicial)
+
+    return {
+        # Cobertura inicial (solo físico + tránsito OT, sin envío entrante)
+        'cobertura_ini': stock_inicial / demanda_segura,
+        'cobertura_ampliada': stock_ampliado / demanda_segura,
+        'stock_ampliado': stock_ampliado,
+        'target_eff': target_eff,
+        'diff': stock_base - m['demanda'] * target_eff,
     }
 
-    def calcular_demanda_fila(row, col_rem, col_pres):
-        if col_rem not in row or col_pres not in row:
-            return 0
-            
-        rem = row[col_rem]
-        pres = row[col_pres]
-        
-        # Metodo A
-        if metodo == 'A':
-            Wp = row['Wp']
-            Wf = row['Wf']
-            if Wp < Wf:
-                return Wf * pres 
-            else:
-                return 1.1 * rem
-            
-        # Metodo B
-        else:
-            if rem == 0:
-                return pres * 0.5
-            elif pres > rem and pres < (rem * 1.5):
-                return (pres + rem) / 2
-            elif pres >= (rem * 1.5):
-                return rem * 1.5
-            else:
-                return rem
-
-    # 1. Calcular demanda individual para cada sucursal
-    cols_demanda_suc = []
-    for suc, (c_rem, c_pres) in sucursales.items():
-        col_name = f'demanda_estimada_{suc}'
-        cols_demanda_suc.append(col_name)
-        
-        if c_rem not in df.columns: df[c_rem] = 0
-        if c_pres not in df.columns: df[c_pres] = 0
-        
-        df[col_name] = df.apply(lambda x: calcular_demanda_fila(x, c_rem, c_pres), axis=1)
+def _volcar_coberturas(df, m, cob, sucursal_origen, disperso=False):
+    """ Escribe en df las columnas de calcular_coberturas para un origen. """
+    sucursales = m['sucursales']
+    for i, suc in enumerate(sucursales):
+        df[f'cobertura_ini_{suc}'] = _columna_sucursal(cob['cobertura_ini'][:, i], disperso)
+        df[f'diff_{suc}'] = _columna_sucursal(cob['diff'][:, i], disperso)
+
+    i_origen = sucursales.index(sucursal_origen)
 
-    # 2. Calcular la Demanda Total
-    df['demanda_estimada_total'] = df[cols_demanda_suc].sum(axis=1)
+    # Cobertura ampliada (para referencia y visualización)
+    df[f'cobertura_ampliada_{sucursal_origen}'] = cob['cobertura_ampliada'][:, i_origen]
+    df[f'target_{sucursal_origen}_eff'] = _columna_sucursal(cob['target_eff'][:, i_origen], disperso)
 
+    # Guardar columnas auxiliares para distribuir_stock
+    df[f'_stock_fisico_{sucursal_origen}'] = m['stock'][:, i_origen]
+    df[f'_stock_ampliado_{sucursal_origen}'] = cob['stock_ampliado'][:, i_origen]
     return df
 
-def calcular_coberturas(df, sucursal_origen='sf', cob_origen_meses=6.0, cob_destino_meses=4.0):
+def calcular_coberturas(df, sucursal_origen='sf', cob_origen_meses=6.0, cob_destino_meses=4.0, disperso=False):
     """
     Calcula coberturas y diferencias (Sobra/Falta) de forma dinámica.
+    Origen y destinos se resuelven en una sola operación sobre las matrices SKU x sucursal.
 
     Args:
         df: DataFrame con los datos
         sucursal_origen: Código de sucursal origen ('sf', 'ba', 'mdz', 'slt')
         cob_origen_meses: Cobertura objetivo en meses para la sucursal origen
         cob_destino_meses: Cobertura objetivo en meses para las sucursales destino
+        disperso: Calcular solo los SKUs con algún stock, tránsito o demanda no nulo (en el
+                  resto coberturas, objetivo y diferencias son 0) y guardar cobertura_ini_*,
+                  diff_* y target_*_eff como columnas dispersas
     """
     # Convertir meses a años para cálculos internos
     cob_origen_años = cob_origen_meses / 12.0
     cob_destino_años = cob_destino_meses / 12.0
 
-    # 1. Cobertura TOTAL (GLOBAL) - Física
-    if 'stock_total' not in df.columns: df['stock_total'] = 0
-    df['cobertura_ini_total'] = df['stock_total'] / df['demanda_estimada_total'].replace(0, 0.00001)
+    m = _preparar_coberturas(df)
 
-    # 2. Preparar stock físico de SF (siempre necesario para cálculos)
-    cols_sf_fisico = ['stock_sf', 'stock_aux', 'stock_sv_arg', 'stock_sv_min', 'stock_ns_noa']
-    for c in cols_sf_fisico:
-        if c not in df.columns: df[c] = 0
-    df['stock_total_sf_fisico'] = df[cols_sf_fisico].sum(axis=1)
+    # Origen y destinos como columnas de la misma matriz
+    es_origen = np.array([suc == sucursal_origen for suc in m['sucursales']])
+    if not disperso:
+        cob = _coberturas_matriz(m, es_origen, cob_origen_años, cob_destino_años)
+        return _volcar_coberturas(df, m, cob, sucursal_origen)
 
-    # 2.1 Calcular COBERTURA AMPLIADA GLOBAL (incluye todos los tránsitos y envíos entrantes)
-    # Esto se usa para limitar correctamente los targets de las sucursales destino
+    # Modo disperso: las filas sin stock ni demanda quedan en 0
+    filas = np.flatnonzero(
+        (m['stock'] != 0).any(axis=1) | (m['transito'] != 0).any(axis=1)
+        | (m['entrante'] != 0).any(axis=1) | (m['demanda'] != 0).any(axis=1)
+    )
+    parcial = {clave: valor[filas] if isinstance(valor, np.ndarray) else valor for clave, valor in m.items()}
+    cob_filas = _coberturas_matriz(parcial, es_origen, cob_origen_años, cob_destino_años)
+    cob = {}
+    for clave, valor in cob_filas.items():
+        cob[clave] = np.zeros((len(df),) + valor.shape[1:])
+        cob[clave][filas] = valor
+    return _volcar_coberturas(df, m, cob, sucursal_origen, disperso)
+
+def _parametros_empaque(df):
+    """ Tamaño de lote (qty_piezas saneado) y marca de Filtro por SKU. """
+    qty_p = df['qty_piezas'].to_numpy(dtype=float)
+    qty_p = np.where(np.isnan(qty_p) | (qty_p <= 0), 1, qty_p)
+
+    es_filtro = df['familia_logica'].isin(FAMILIAS_FILTROS).to_numpy()
+    return qty_p, es_filtro
+
+def _disponible_origen(stock_fisico, demanda, diff_ampliado, qty_p, es_filtro):
+    """
+    Unidades que una sucursal puede ceder como origen: excedente según cobertura
+    ampliada, reteniendo 1 mes de demanda (Filtros) o al menos 1 juego (Kits), y nunca
+    más que el stock físico. Los argumentos son arrays broadcastables entre sí.
+    """
+    # RESTRICCIÓN CLAVE: Retener stock para cubrir 1 mes hasta que llegue el envío entrante
+    cobertura_minima_años = 1.0 / 12.0  # 1 mes = 0.0833 años
+    demanda_1_mes = demanda * cobertura_minima_años
+
+    # Lógica Filtros: Retener demanda de 1 mes
+    libre_filtros = stock_fisico - demanda_1_mes
+    max_disponible_filtros = np.where(libre_filtros > 0, libre_filtros, 0)
+    disponible_filtros = np.floor(np.minimum(diff_ampliado, max_disponible_filtros))
+
+    # Lógica Kits (No Filtros): Retener al menos 1 juego completo, o lo que se necesite para 1 mes
+    kits_necesarios_minimo = np.maximum(1, np.ceil(demanda_1_mes / qty_p))
+    libre_kits = stock_fisico - kits_necesarios_minimo * qty_p
+    max_disponible_kits = np.where(libre_kits > 0, libre_kits, 0)
+    disponible_kits = np.maximum(0, np.trunc(np.minimum(diff_ampliado, max_disponible_kits)))
+
+    # Solo hay disponibilidad si hay excedente según cobertura ampliada
+    disponible = np.where(
+        diff_ampliado > 0,
+        np.where(es_filtro, disponible_filtros, disponible_kits),
+        0
+    )
 
-    # Asegurar que existan todas las columnas de tránsito
-    cols_transito_global = ['qty_ot_transito_sf', 'qty_ot_transito_ba', 'qty_ot_transito_mdz', 'qty_ot_transito_slt',
-                           'qty_sf', 'qty_ba', 'qty_mdz', 'qty_slt']
-    for c in cols_transito_global:
-        if c not in df.columns: df[c] = 0
+    # Seguridad física final: nunca enviar más que el stock físico
+    return np.where(stock_fisico < disponible, stock_fisico, disponible)
 
-    # Stock ampliado global = stock físico total + todos los tránsitos OT + todos los envíos entrantes
-    stock_ampliado_global = (
-        df['stock_total'] +
-        df['qty_ot_transito_sf'] + df['qty_ot_transito_ba'] + df['qty_ot_transito_mdz'] + df['qty_ot_transito_slt'] +
-        df['qty_sf'] + df['qty_ba'] + df['qty_mdz'] + df['qty_slt']
+def _envios_deseados(necesita, diff, stock_destino, qty_p, es_filtro, reglas_cajas=None):
+    """
+    Faltante (techo de la brecha) y envío deseado por sucursal con la regla de cajas
+    (Filtros) o de juegos (Kits). qty_p y es_filtro como columnas (SKUs, 1).
+    """
+    falta_base = np.ceil(np.abs(np.where(necesita, diff, 0)))
+    envios_deseados = np.where(
+        necesita,
+        np.where(
+            es_filtro,
+            calcular_qty_filtros_array(falta_base, qty_p, reglas_cajas),
+            calcular_qty_kits_array(falta_base, stock_destino, qty_p)
+        ),
+        0
     )
+    return falta_base, envios_deseados
 
-    df['cobertura_ampliada_total'] = stock_ampliado_global / df['demanda_estimada_total'].replace(0, 0.00001)
+def _repartir_disponible(envios_deseados, total_deseado, disponible, diff):
+    """
+    Reparte el disponible de cada fila entre sus sucursales: si alcanza, cada una recibe
+    lo deseado; si no, prorrateo con corrección de remanentes (mayor necesidad primero).
+    """
+    envios_finales = np.zeros_like(envios_deseados)
+
+    hay_disponible = disponible > 0
+    alcanza = hay_disponible & (disponible >= total_deseado)
+    envios_finales[alcanza] = envios_deseados[alcanza]
+
+    # Escasez: Prorratear con corrección de remanentes
+    escasez = np.flatnonzero(hay_disponible & ~alcanza & (total_deseado > 0))
+    if len(escasez) > 0:
+        deseados = envios_deseados[escasez]
+        disponible = disponible[escasez]
+        ratio = disponible / total_deseado[escasez]
+
+        # A) Asignación proporcional base (suelo)
+        asignados = np.where(deseados > 0, np.floor(deseados * ratio[:, None]), 0)
+
+        # B) Distribuir el remanente (lo que sobró por redondear hacia abajo)
+        remanente = disponible - asignados.sum(axis=1)
+
+        # Candidatos: Sucursales que pidieron y aún no recibieron todo,
+        # ordenadas por mayor necesidad (diff más negativo primero)
+        candidatos = (deseados > 0) & (deseados - asignados > 0)
+        prioridad = np.where(candidatos, diff[escasez], np.inf)
+        orden = np.argsort(prioridad, axis=1, kind='stable')
+        candidatos_ordenados = np.take_along_axis(candidatos, orden, axis=1)
+        filas = np.arange(len(escasez))
+
+        # Repartir 1 a 1 en orden de prioridad; cada vuelta recorre a todos los candidatos
+        while (remanente > 0).any():
+            asignado_en_vuelta = False
+            for j in range(orden.shape[1]):
+                col = orden[:, j]
+                recibe = (
+                    (remanente > 0)
+                    & candidatos_ordenados[:, j]
+                    & (asignados[filas, col] < deseados[filas, col])
+                )
+                if recibe.any():
+                    asignados[filas[recibe], col[recibe]] += 1
+                    remanente = remanente - recibe
+                    asignado_en_vuelta = True
+            if not asignado_en_vuelta:
+                break
+
+        envios_finales[escasez] = asignados
+
+    return envios_finales
+
+def _distribuir_matriz(stock, transito, demanda, diff, origen, qty_p, es_filtro, reglas_cajas=None, traza=None):
+    """
+    Núcleo de distribuir_stock sobre matrices (filas x sucursales).
+    origen indica, por fila, la columna de la sucursal que envía; el resto son destinos.
+    Devuelve la matriz de envíos (0 en la columna de origen).
+    Si se pasa un dict en traza, se guardan ahí los valores intermedios (disponible
+    en origen y envíos deseados por destino) para explicar el resultado.
+    """
+    filas_todas = np.arange(len(origen))
+    es_destino = np.arange(stock.shape[1])[None, :] != origen[:, None]
 
-    # 3. Definir todas las sucursales
-    todas_sucursales = ['sf', 'ba', 'mdz', 'slt']
-    sucursales_destino = [s for s in todas_sucursales if s != sucursal_origen]
+    # --- 1. DISPONIBILIDAD EN SUCURSAL ORIGEN ---
+    # El diff ya está calculado con stock ampliado (incluye envío entrante)
+    disponible_origen = _disponible_origen(
+        stock[filas_todas, origen], demanda[filas_todas, origen], diff[filas_todas, origen], qty_p, es_filtro
+    )
 
-    # 4. Calcular para ORIGEN
-    col_stock_origen = f'stock_{sucursal_origen}' if sucursal_origen != 'sf' else 'stock_total_sf_fisico'
-    col_demanda_origen = f'demanda_estimada_{sucursal_origen}'
+    # --- 2. NECESIDAD SUCURSALES DESTINO (TECHO DEL FALTANTE) ---
+    stock_destino = stock + transito
 
-    # Obtener stock físico origen
-    if sucursal_origen == 'sf':
-        stock_fisico_origen = df['stock_total_sf_fisico']
-    else:
-        stock_fisico_origen = df[col_stock_origen] if col_stock_origen in df.columns else 0
+    necesita = es_destino & (diff < 0)
+    falta_base, envios_deseados = _envios_deseados(
+        necesita, diff, stock_destino, qty_p[:, None], es_filtro[:, None], reglas_cajas
+    )
+    total_deseado = envios_deseados.sum(axis=1)
 
-    # COBERTURA AMPLIADA ORIGEN: Incluye stock físico + tránsitos por OT + tránsitos por envío entrante
-    # Columna de envío entrante (qty_sf, qty_ba, qty_mdz, qty_slt según sucursal)
-    col_envio_entrante = f'qty_{sucursal_origen}'
+    if traza is not None:
+        traza.update(
+            disponible_origen=disponible_origen,
+            falta_base=falta_base,
+            envios_deseados=envios_deseados,
+            total_deseado=total_deseado,
+        )
 
-    # Columna de tránsito por OT (solo para sucursales, no para SF)
-    if sucursal_origen == 'sf':
-        col_transito_ot = 'qty_ot_transito_sf'  # Para consistencia, aunque SF puede no tener
-    elif sucursal_origen == 'slt':
-        col_transito_ot = 'qty_ot_transito_slt'
-    else:
-        col_transito_ot = f'qty_ot_transito_{sucursal_origen}'
+    # --- 3. DISTRIBUCIÓN ---
+    return _repartir_disponible(envios_deseados, total_deseado, disponible_origen, diff)
 
-    # Stock ampliado = físico + tránsito OT + envío entrante
-    stock_ampliado_origen = (
-        stock_fisico_origen +
-        df.get(col_transito_ot, 0) +
-        df.get(col_envio_entrante, 0)
+def _distribuir_escenarios(m, diff, idx_origenes, qty_p, es_filtro, reglas_cajas=None):
+    """
+    Distribución de varios escenarios a la vez: diff tiene forma (escenarios, SKUs, sucursales)
+    e idx_origenes indica la columna origen de cada escenario. Los escenarios se apilan
+    como filas de _distribuir_matriz. Devuelve envíos con la forma de diff.
+    """
+    n_escenarios, n_skus, n_suc = diff.shape
+
+    def apilar(matriz):
+        return np.broadcast_to(matriz, (n_escenarios, n_skus, n_suc)).reshape(-1, n_suc)
+
+    envios = _distribuir_matriz(
+        apilar(m['stock']), apilar(m['transito']), apilar(m['demanda']),
+        diff.reshape(-1, n_suc),
+        np.repeat(np.broadcast_to(idx_origenes, (n_escenarios,)), n_skus),
+        np.tile(qty_p, n_escenarios), np.tile(es_filtro, n_escenarios),
+        reglas_cajas
     )
+    return envios.reshape(n_escenarios, n_skus, n_suc)
 
-    # Cobertura ampliada (para referencia y visualización)
-    df[f'cobertura_ampliada_{sucursal_origen}'] = stock_ampliado_origen / df[col_demanda_origen].replace(0, 0.00001)
+def distribuir_stock(df, sucursal_origen='sf', reglas_cajas=None, disperso=False):
+    """
+    Define los envíos aplicando lógica de cajas (Filtros) y juegos (No Filtros).
+    Corrige la ineficiencia de remanentes en escenarios de escasez.
+    Todos los SKUs se resuelven juntos sobre matrices SKU x sucursal.
 
-    # Cobertura inicial (solo físico + tránsito OT, sin envío entrante)
-    stock_inicial_origen = stock_fisico_origen + df.get(col_transito_ot, 0)
-    df[f'cobertura_ini_{sucursal_origen}'] = stock_inicial_origen / df[col_demanda_origen].replace(0, 0.00001)
+    Args:
+        df: DataFrame con los datos calculados
+        sucursal_origen: Código de sucursal origen ('sf', 'ba', 'mdz', 'slt')
+        reglas_cajas: Tabla {tamaño_caja: max_faltante} para Filtros (por defecto REGLAS_CAJAS_FILTROS)
+        disperso: Resolver solo los SKUs que pueden generar envíos (origen con excedente y
+                  stock físico, algún destino con faltante) y guardar los envíos como
+                  columnas dispersas
+    """
+    m = construir_matrices(df)
+    qty_p, es_filtro = _parametros_empaque(df)
 
-    # Objetivo real origen (usar cobertura ampliada global)
-    df[f'target_{sucursal_origen}_eff'] = np.minimum(cob_origen_años, df['cobertura_ampliada_total'])
-    stock_obj_origen = df[col_demanda_origen] * df[f'target_{sucursal_origen}_eff']
+    i_origen = m['sucursales'].index(sucursal_origen)
+    origen = np.full(len(df), i_origen)
 
-    # Diferencia usando STOCK AMPLIADO (considera envío entrante para decidir si hay excedente)
-    df[f'diff_{sucursal_origen}'] = stock_ampliado_origen - stock_obj_origen
+    if not disperso:
+        envios = _distribuir_matriz(
+            m['stock'], m['transito'], m['demanda'], m['diff'], origen, qty_p, es_filtro, reglas_cajas
+        )
+    else:
+        es_destino = np.arange(len(m['sucursales'])) != i_origen
+        filas = np.flatnonzero(
+            (m['diff'][:, i_origen] > 0)
+            & (m['stock'][:, i_origen] > 0)
+            & (m['diff'][:, es_destino] < 0).any(axis=1)
+        )
+        envios = np.zeros((len(df), len(m['sucursales'])))
+        envios[filas] = _distribuir_matriz(
+            m['stock'][filas], m['transito'][filas], m['demanda'][filas], m['diff'][filas],
+            origen[filas], qty_p[filas], es_filtro[filas], reglas_cajas
+        )
+
+    for i, suc in enumerate(m['sucursales']):
+        if i != i_origen:
+            df[f'final_enviar_{suc}'] = _columna_sucursal(envios[:, i], disperso)
 
-    # Guardar columnas auxiliares para distribuir_stock
-    df[f'_stock_fisico_{sucursal_origen}'] = stock_fisico_origen
-    df[f'_stock_ampliado_{sucursal_origen}'] = stock_ampliado_origen
+    return df
 
-    # 5. Calcular para DESTINOS
-    for suc_destino in sucursales_destino:
-        col_stock = f'stock_{suc_destino}'
+def calcular_coberturas_finales(df, sucursal_origen='sf'):
+    """ Cobertura post envío de cada sucursal destino (cobertura_fin_*). """
+    for suc, datos in SUCURSALES.items():
+        col_envio = f'final_enviar_{suc}'
+        if suc == sucursal_origen or datos['stock'] not in df.columns or col_envio not in df.columns:
+            continue
+        stock_final = df[datos['stock']] + df.get(datos['transito'], 0) + _serie_densa(df[col_envio])
+        df[f'cobertura_fin_{suc}'] = stock_final / _serie_densa(df[f'demanda_estimada_{suc}']).replace(0, 0.0001)
+    return df
 
-        # Columna de tránsito OT: qty_ot_transito_* para todas las sucursales
-        if suc_destino == 'sf':
-            col_stock = 'stock_total_sf_fisico'
-            col_transito = 'qty_ot_transito_sf'
-        else:
-            col_transito = f'qty_ot_transito_{suc_destino}'
+def columnas_auxiliares(df):
+    """ Columnas intermedias de calcular_coberturas para distribuir_stock (no son decisiones). """
+    return [
+        c for c in df.columns
+        if c.startswith(('_stock_fisico_', '_stock_ampliado_'))
+        or (c.startswith('target_') and c.endswith('_eff'))
+        or c == 'cobertura_ampliada_total'
+    ]
+
+def seleccionar_prioritarios(df, n, cobertura_meses=1.0):
+    """
+    Posiciones (en orden de df) de los n SKUs a calcular primero: los que ya tienen
+    menos de cobertura_meses en alguna sucursal (stock físico y tránsito contra su
+    demanda) y, entre ellos y después el resto, los de mayor demanda_estimada_total.
+    Usa selección parcial, sin ordenar todo el catálogo. Requiere demanda ya estimada.
+    """
+    if n >= len(df):
+        return np.arange(len(df))
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    en_riesgo = np.zeros(len(df), dtype=bool)
+    for suc, datos in SUCURSALES.items():
+        stock = np.zeros(len(df))
+        for col in datos['depositos'] + [datos['transito']]:
+            if col in df.columns:
+                stock += np.nan_to_num(df[col].to_numpy(dtype=float))
+        demanda = np.nan_to_num(_serie_densa(df[f'demanda_estimada_{suc}']).to_numpy(dtype=float))
+        en_riesgo |= (demanda > 0) & (stock < demanda * cobertura_meses / 12.0)
+
+    # Clave única: los SKUs en riesgo quedan por encima de cualquier otro
+    demanda_total = np.clip(np.nan_to_num(df['demanda_estimada_total'].to_numpy(dtype=float)), 0, None)
+    clave = demanda_total + np.where(en_riesgo, demanda_total.max() + 1.0, 0.0)
+    return np.sort(np.argpartition(-clave, n - 1)[:n])
+
+# Columnas que identifican al SKU en la salida liviana
+COLUMNAS_IDENTIFICACION = ['codigo', 'descripcion', 'familia_logica']
+
+def salida_liviana(df, sucursal_origen='sf'):
+    """
+    Reduce el resultado de distribuir_stock a las columnas de decisión: envíos
+    (final_enviar_*), coberturas finales (cobertura_fin_*) y diferencias (diff_*).
+    Las columnas auxiliares se pueden reconstruir por SKU con pipeline.explicar_sku.
+    """
+    calcular_coberturas_finales(df, sucursal_origen)
+    identificacion = [c for c in COLUMNAS_IDENTIFICACION if c in df.columns]
+    decision = [c for c in df.columns if c.startswith(('final_enviar_', 'recorte_', 'cobertura_fin_', 'diff_'))]
+    return df[identificacion + decision]
 
-        stk = df[col_stock] if col_stock in df.columns else 0
-        trs = df.get(col_transito, 0)
+def planificar_multi_origen(df, origenes=None, cob_origen_meses=6.0, cob_destino_meses=4.0,
+                            cascada=None, reglas_cajas=None):
+    """
+    Evalúa varias sucursales origen en una sola pasada.
+    Requiere df con demanda ya estimada (calcular_parametros_w y estimar_demanda se
+    corren una sola vez). Coberturas y distribución de todos los orígenes se resuelven
+    sobre matrices apiladas (orígenes x SKUs x sucursales).
 
-        stock_suc_total = stk + trs
-        col_demanda_local = f'demanda_estimada_{suc_destino}'
+    Args:
+        df: DataFrame con demanda estimada
+        origenes: Lista de sucursales origen a evaluar (por defecto, todo el registro)
+        cob_origen_meses: Cobertura objetivo en meses para la sucursal origen
+        cob_destino_meses: Cobertura objetivo en meses para las sucursales destino
+        cascada: Lista ordenada de orígenes (ej: ['sf', 'ba']). Cada origen envía con lo
+                 que quedó después de los anteriores; lo enviado llega a destino como tránsito.
+                 Un origen ya procesado no recibe de los siguientes (no hay envíos de ida y
+                 vuelta en un mismo plan). Solo disponible desde la librería: la app usa
+                 "Evaluar todos los orígenes" sin cascada.
+        reglas_cajas: Tabla {tamaño_caja: max_faltante} para Filtros
+
+    Returns:
+        dict {origen: DataFrame} con las mismas columnas que calcular_coberturas +
+        distribuir_stock para ese origen. Si se indica cascada, la clave 'cascada' contiene
+        final_enviar_{destino}_desde_{origen} por paso y final_enviar_{destino} acumulado.
+    """
+    if origenes is None: origenes = list(SUCURSALES)
+    cob_origen_años = cob_origen_meses / 12.0
+    cob_destino_años = cob_destino_meses / 12.0
+
+    m = _preparar_coberturas(df)
+    qty_p, es_filtro = _parametros_empaque(df)
+    sucursales = m['sucursales']
+    n_skus, n_suc = m['stock'].shape
+
+    # 1. Coberturas de todos los orígenes: eje inicial = origen evaluado
+    idx_origenes = np.array([sucursales.index(o) for o in origenes])
+    es_origen = (np.arange(n_suc)[None, :] == idx_origenes[:, None])[:, None, :]
+    cob = _coberturas_matriz(m, es_origen, cob_origen_años, cob_destino_años)
+
+    # 2. Distribución de todos los orígenes en una sola llamada
+    envios = _distribuir_escenarios(m, cob['diff'], idx_origenes, qty_p, es_filtro, reglas_cajas)
+
+    resultados = {}
+    for k, origen in enumerate(origenes):
+        df_origen = df.copy()
+        cob_origen = {nombre: (valor[k] if valor.ndim == 3 else valor) for nombre, valor in cob.items()}
+        _volcar_coberturas(df_origen, m, cob_origen, origen)
+        for i, suc in enumerate(sucursales):
+            if suc != origen:
+                df_origen[f'final_enviar_{suc}'] = envios[k][:, i]
+        resultados[origen] = df_origen
+
+    # 3. Cascada: cada origen usa el stock remanente de los pasos anteriores
+    if cascada:
+        stock = m['stock'].copy()
+        transito = m['transito'].copy()
+        df_cascada = df.copy()
+        recibido = np.zeros((n_skus, n_suc))
+
+        procesados = []
+        for origen in cascada:
+            i_origen = sucursales.index(origen)
+            m_paso = dict(m, stock=stock, transito=transito)
+            es_origen_paso = np.arange(n_suc) == i_origen
+            cob_paso = _coberturas_matriz(m_paso, es_origen_paso, cob_origen_años, cob_destino_años)
+
+            # Los orígenes anteriores no son destino: sin faltante no piden
+            diff_paso = cob_paso['diff'].copy()
+            diff_paso[:, procesados] = np.maximum(diff_paso[:, procesados], 0)
+
+            envios_paso = _distribuir_matriz(
+                stock, transito, m['demanda'], diff_paso,
+                np.full(n_skus, i_origen), qty_p, es_filtro, reglas_cajas
+            )
+            procesados.append(i_origen)
+
+            # Lo enviado sale del físico del origen y llega a destino como tránsito
+            stock[:, i_origen] -= envios_paso.sum(axis=1)
+            transito += envios_paso
+            recibido += envios_paso
+
+            for i, suc in enumerate(sucursales):
+                if i != i_origen:
+                    df_cascada[f'final_enviar_{suc}_desde_{origen}'] = envios_paso[:, i]
+
+        for i, suc in enumerate(sucursales):
+            df_cascada[f'final_enviar_{suc}'] = recibido[:, i]
+        resultados['cascada'] = df_cascada
+
+    return resultados
+
+def _cancelar_ciclos_negativos(envios, disponible, costo, max_rondas=100):
+    """
+    Lleva a costo mínimo una asignación factible origen -> destino de todos los SKUs a la
+    vez. En el grafo residual de cada SKU (sucursales más un nodo de oferta sin usar) se
+    busca un ciclo de costo negativo con Bellman-Ford en lote y se empuja por él lo que
+    permite su tramo más ajustado; sin ciclos negativos la asignación es óptima.
+    Solo se procesan los SKUs con más de un origen y más de un destino (con un único
+    origen o un único destino el reparto por tramo de menor costo ya es óptimo).
+
+    Args:
+        envios: Array (SKUs, sucursales, sucursales) de envíos origen -> destino; se modifica
+        disponible: Array (SKUs, sucursales) con la oferta de cada origen
+        costo: Array (sucursales, sucursales) con el costo por unidad de cada tramo
+    """
+    n_suc = costo.shape[0]
+    recibe = envios.sum(axis=1) > 0
+    filas = np.flatnonzero(((disponible > 0).sum(axis=1) > 1) & (recibe.sum(axis=1) > 1))
+    nodos = n_suc + 1
+    libre = n_suc
+    for _ in range(max_rondas):
+        if len(filas) == 0:
+            break
+        x = envios[filas]
+        oferta = disponible[filas]
+        sin_usar = oferta - x.sum(axis=2)
+        es_origen = oferta > 0
+
+        # Tramos residuales: origen -> destino sin tope, destino -> origen hasta lo enviado,
+        # oferta sin usar -> origen y origen -> oferta sin usar
+        tope = np.zeros((len(filas), nodos, nodos))
+        tope[:, :n_suc, :n_suc] = np.where(es_origen[:, :, None] & recibe[filas][:, None, :], np.inf, 0)
+        tope[:, :n_suc, :n_suc] += np.swapaxes(x, 1, 2)
+        tope[:, libre, :n_suc] = np.where(es_origen, sin_usar, 0)
+        tope[:, :n_suc, libre] = np.where(es_origen, oferta - sin_usar, 0)
+        np.einsum('kii->ki', tope)[:] = 0
+        peso = np.zeros((len(filas), nodos, nodos))
+        peso[:, :n_suc, :n_suc] = np.where(np.swapaxes(x, 1, 2) > 0, -costo.T, costo)
+        peso = np.where(tope > 1e-9, peso, np.inf)
+
+        # Bellman-Ford desde un origen virtual unido a todos los nodos
+        distancia = np.zeros((len(filas), nodos))
+        previo = np.full((len(filas), nodos), -1)
+        for _ in range(nodos):
+            candidato = distancia[:, :, None] + peso
+            mejor = candidato.min(axis=1)
+            mejora = mejor < distancia - 1e-9
+            previo = np.where(mejora, candidato.argmin(axis=1), previo)
+            distancia = np.where(mejora, mejor, distancia)
+        con_ciclo = mejora.any(axis=1)
+        if not con_ciclo.any():
+            break
+
+        # Nodo sobre el ciclo: retroceder desde uno que sigue mejorando
+        k = np.flatnonzero(con_ciclo)
+        nodo = mejora[k].argmax(axis=1)
+        for _ in range(nodos):
+            nodo = previo[k, nodo]
+
+        # Recorrer el ciclo: tramo más ajustado y luego empujar esa cantidad
+        tramos = []
+        actual, activo = nodo.copy(), np.ones(len(k), dtype=bool)
+        for _ in range(nodos):
+            anterior = previo[k, actual]
+            tramos.append((anterior, actual, activo.copy()))
+            actual = np.where(activo, anterior, actual)
+            activo &= actual != nodo
+        delta = np.full(len(k), np.inf)
+        costo_ciclo = np.zeros(len(k))
+        for desde, hasta, activo in tramos:
+            delta = np.where(activo, np.minimum(delta, tope[k, desde, hasta]), delta)
+            costo_ciclo = np.where(activo, costo_ciclo + peso[k, desde, hasta], costo_ciclo)
+        delta = np.where(costo_ciclo < -1e-9, delta, 0)
+        for desde, hasta, activo in tramos:
+            adelante = activo & (desde < n_suc) & (hasta < n_suc) & es_origen[k, np.minimum(desde, n_suc - 1)]
+            atras = activo & (desde < n_suc) & (hasta < n_suc) & ~adelante
+            f = filas[k]
+            envios[f[adelante], desde[adelante], hasta[adelante]] += delta[adelante]
+            envios[f[atras], hasta[atras], desde[atras]] -= delta[atras]
+        filas = filas[k]
+
+def resolver_red(df, cob_origen_meses=6.0, cob_destino_meses=4.0, costos=None, reglas_cajas=None):
+    """
+    Rebalanceo de toda la red en una sola pasada, como problema de transporte por SKU
+    resuelto en lote para todo el catálogo. Cada sucursal con excedente (regla de origen:
+    cobertura ampliada sobre cob_origen_meses, retención de 1 mes o 1 juego) ofrece stock;
+    cada sucursal con faltante (regla de destino sobre cob_destino_meses, con cajas o
+    juegos) lo pide. Si la oferta no alcanza se prorratea como en distribuir_stock, y lo
+    recibido por cada destino se asigna a los orígenes con el menor costo total del SKU
+    (reparto inicial por tramo de menor costo, luego _cancelar_ciclos_negativos).
+    Requiere df con demanda ya estimada.
+
+    Args:
+        df: DataFrame con demanda estimada
+        cob_origen_meses: Cobertura que retiene una sucursal antes de ceder stock
+        cob_destino_meses: Cobertura objetivo de las sucursales con faltante
+        costos: Dict {(origen, destino): costo por unidad}; los tramos ausentes valen 1.
+                A igual costo se respeta el orden del registro de sucursales.
+        reglas_cajas: Tabla {tamaño_caja: max_faltante} para Filtros
+
+    Returns:
+        Copia de df con enviar_{origen}_a_{destino} por tramo, final_enviar_{sucursal}
+        (total recibido) y final_salida_{sucursal} (total cedido).
+    """
+    if costos is None: costos = {}
+    df = df.copy()
+    m = _preparar_coberturas(df)
+    qty_p, es_filtro = _parametros_empaque(df)
+    sucursales = m['sucursales']
+    n_skus, n_suc = m['stock'].shape
+
+    # 1. Oferta: todas las sucursales evaluadas como origen
+    cob_oferta = _coberturas_matriz(m, True, cob_origen_meses / 12.0, cob_destino_meses / 12.0)
+    disponible = _disponible_origen(
+        m['stock'], m['demanda'], cob_oferta['diff'], qty_p[:, None], es_filtro[:, None]
+    )
 
-        df[f'cobertura_ini_{suc_destino}'] = stock_suc_total / df[col_demanda_local].replace(0, 0.00001)
+    # 2. Pedido: todas las sucursales evaluadas como destino (si no ofrecen)
+    cob_pedido = _coberturas_matriz(m, False, cob_origen_meses / 12.0, cob_destino_meses / 12.0)
+    necesita = (disponible <= 0) & (cob_pedido['diff'] < 0)
+    _, deseados = _envios_deseados(
+        necesita, cob_pedido['diff'], m['stock'] + m['transito'], qty_p[:, None], es_filtro[:, None], reglas_cajas
+    )
 
-        # Usar cobertura ampliada global para calcular target efectivo
-        target_suc_eff = np.minimum(cob_destino_años, df['cobertura_ampliada_total'])
-        stock_obj_ideal = df[col_demanda_local] * target_suc_eff
+    # 3. Lo que recibe cada destino con la oferta total del SKU
+    recibido = _repartir_disponible(deseados, deseados.sum(axis=1), disponible.sum(axis=1), cob_pedido['diff'])
 
-        # Diferencia Real Sucursal (Float)
-        df[f'diff_{suc_destino}'] = stock_suc_total - stock_obj_ideal
+    # 4. Asignación a tramos origen -> destino: reparto inicial por tramo de menor costo y
+    # ajuste a costo mínimo por SKU, todos los SKUs a la vez
+    costo = np.array([[costos.get((o, d), 1.0) for d in sucursales] for o in sucursales])
+    tramos = sorted(
+        ((o, d) for o in range(n_suc) for d in range(n_suc) if o != d),
+        key=lambda tramo: costo[tramo]
+    )
+    oferta = disponible.copy()
+    pendiente = recibido.copy()
+    envios = np.zeros((n_skus, n_suc, n_suc))
+    for o, d in tramos:
+        cantidad = np.minimum(oferta[:, o], pendiente[:, d])
+        envios[:, o, d] = cantidad
+        oferta[:, o] -= cantidad
+        pendiente[:, d] -= cantidad
+    _cancelar_ciclos_negativos(envios, disponible, costo)
+
+    for o, d in sorted(tramos):
+        df[f'enviar_{sucursales[o]}_a_{sucursales[d]}'] = envios[:, o, d]
+    for i, suc in enumerate(sucursales):
+        df[f'final_enviar_{suc}'] = envios[:, :, i].sum(axis=1)
+        df[f'final_salida_{suc}'] = envios[:, i, :].sum(axis=1)
 
     return df
 
-def distribuir_stock(df, sucursal_origen='sf'):
+def barrido_coberturas(df, grilla, sucursal_origen='sf', reglas_cajas=None, max_filas_lote=2_000_000):
     """
-    Define los envíos aplicando lógica de cajas (Filtros) y juegos (No Filtros).
-    Corrige la ineficiencia de remanentes en escenarios de escasez.
+    Evalúa una grilla de coberturas objetivo (origen, destino) en un cálculo por lotes
+    (escenarios x SKUs x sucursales) y resume cada punto de la grilla.
+    Requiere df con demanda ya estimada.
 
     Args:
-        df: DataFrame con los datos calculados
-        sucursal_origen: Código de sucursal origen ('sf', 'ba', 'mdz', 'slt')
+        df: DataFrame con demanda estimada
+        grilla: Lista de pares (cob_origen_meses, cob_destino_meses)
+        sucursal_origen: Código de sucursal origen
+        reglas_cajas: Tabla {tamaño_caja: max_faltante} para Filtros
+        max_filas_lote: Máximo de filas (escenarios x SKUs) por lote, acota la memoria
+
+    Returns:
+        DataFrame con una fila por punto de la grilla: unidades, peso, volumen,
+        unidades por destino y SKUs con algún destino por debajo de 1 mes tras el envío.
     """
-    # Determinar sucursales destino dinámicamente
-    todas_sucursales = ['sf', 'ba', 'mdz', 'slt']
-    sucursales_destino = [s for s in todas_sucursales if s != sucursal_origen]
+    df = df.copy()
+    m = _preparar_coberturas(df)
+    qty_p, es_filtro = _parametros_empaque(df)
+    sucursales = m['sucursales']
+    n_skus = len(df)
+
+    i_origen = sucursales.index(sucursal_origen)
+    es_origen = np.arange(len(sucursales)) == i_origen
+    es_destino = ~es_origen
+
+    peso = pd.to_numeric(df['peso'], errors='coerce').fillna(0).to_numpy() if 'peso' in df.columns else np.zeros(n_skus)
+    volumen = pd.to_numeric(df['volumen'], errors='coerce').fillna(0).to_numpy() if 'volumen' in df.columns else np.zeros(n_skus)
+
+    stock_destino = m['stock'] + m['transito']
+    demanda_segura = np.where(m['demanda'] == 0, 0.00001, m['demanda'])
+    cobertura_minima_años = 1.0 / 12.0
+
+    grilla = np.asarray(grilla, dtype=float).reshape(-1, 2)
+    escenarios_por_lote = max(1, max_filas_lote // max(n_skus, 1))
+
+    filas = []
+    for inicio in range(0, len(grilla), escenarios_por_lote):
+        lote = grilla[inicio:inicio + escenarios_por_lote]
+        cob_origen_años = (lote[:, 0] / 12.0)[:, None, None]
+        cob_destino_años = (lote[:, 1] / 12.0)[:, None, None]
+
+        cob = _coberturas_matriz(m, es_origen, cob_origen_años, cob_destino_años)
+        envios = _distribuir_escenarios(m, cob['diff'], i_origen, qty_p, es_filtro, reglas_cajas)
+
+        # Cobertura post envío de los destinos (mismo criterio de riesgo que el tablero)
+        cobertura_fin = (stock_destino + envios) / demanda_segura
+        bajo_1_mes = ((cobertura_fin < cobertura_minima_años) & es_destino).any(axis=2)
+
+        unidades_suc = envios.sum(axis=1)
+        unidades_sku = envios.sum(axis=2)
+        for k, (cob_o, cob_d) in enumerate(lote):
+            fila = {
+                'cob_origen_meses': cob_o,
+                'cob_destino_meses': cob_d,
+                'unidades': unidades_suc[k].sum(),
+                'peso': unidades_sku[k] @ peso,
+                'volumen': unidades_sku[k] @ volumen,
+                'skus_bajo_1_mes': int(bajo_1_mes[k].sum()),
+            }
+            for i, suc in enumerate(sucursales):
+                if i != i_origen:
+                    fila[f'unidades_{suc}'] = unidades_suc[k, i]
+            filas.append(fila)
+
+    return pd.DataFrame(filas)
+
+def comparar_metodos(df, sucursal_origen='sf', cob_origen_meses=6.0, cob_destino_meses=4.0, reglas_cajas=None):
+    """
+    Calcula Método A y Método B lado a lado en una sola pasada: las demandas de ambos
+    métodos se apilan en un eje inicial (métodos x SKUs x sucursales) y coberturas y
+    distribución se resuelven juntas. Requiere df con Wp y Wf (calcular_parametros_w).
 
-    # Familias consideradas "Filtros" para lógica de cajas
-    familias_filtros = ['DONALDSON', 'TURBO', 'KTN'] 
-    
-    def calcular_fila(row):
-        qty_p = row['qty_piezas']
-        if pd.isna(qty_p) or qty_p <= 0: qty_p = 1
-
-        fam = row['familia_logica']
-        es_filtro = fam in familias_filtros
-
-        # --- 1. DISPONIBILIDAD EN SUCURSAL ORIGEN ---
-        # El diff ya está calculado con stock ampliado (incluye envío entrante)
-        diff_origen_ampliado = row[f'diff_{sucursal_origen}']
-
-        # Obtener stocks de las columnas auxiliares
-        stock_fisico_origen = row.get(f'_stock_fisico_{sucursal_origen}', 0)
-        demanda_origen = row[f'demanda_estimada_{sucursal_origen}']
-
-        # RESTRICCIÓN CLAVE: Retener stock para cubrir 1 mes hasta que llegue el envío entrante
-        cobertura_minima_años = 1.0 / 12.0  # 1 mes = 0.0833 años
-        demanda_1_mes = demanda_origen * cobertura_minima_años
-
-        if diff_origen_ampliado > 0:
-            # Hay excedente según cobertura ampliada
-            if es_filtro:
-                # Lógica Filtros: Retener demanda de 1 mes
-                # Máximo a enviar = Stock_Físico - Demanda_1_Mes
-                stock_minimo_retencion = demanda_1_mes
-                max_disponible_fisico = max(0, stock_fisico_origen - stock_minimo_retencion)
-                disponible_origen = math.floor(min(diff_origen_ampliado, max_disponible_fisico))
-
-            else:
-                # Lógica Kits (No Filtros): Retener kits completos para 1 mes
-                # Calcular kits necesarios para cubrir 1 mes de demanda
-                kits_para_1_mes = math.ceil(demanda_1_mes / qty_p)
-
-                # Retener al menos 1 juego completo, o lo que se necesite para 1 mes
-                kits_necesarios_minimo = max(1, kits_para_1_mes)
-                stock_retencion_final = kits_necesarios_minimo * qty_p
-
-                # Disponible desde stock físico
-                max_disponible_fisico = max(0, stock_fisico_origen - stock_retencion_final)
-                disponible_teorico = min(diff_origen_ampliado, max_disponible_fisico)
-                disponible_origen = max(0, int(disponible_teorico))
+    Args:
+        df: DataFrame con parámetros W calculados (y familias ya filtradas)
+        sucursal_origen: Código de sucursal origen
+        cob_origen_meses: Cobertura objetivo en meses para la sucursal origen
+        cob_destino_meses: Cobertura objetivo en meses para las sucursales destino
+        reglas_cajas: Tabla {tamaño_caja: max_faltante} para Filtros
+
+    Returns:
+        Copia de df con columnas pareadas por método (sufijos _metodo_a / _metodo_b) de
+        demanda, diff y final_enviar, más delta_enviar_{destino} y delta_enviar_total
+        (Método B - Método A).
+    """
+    metodos = ['A', 'B']
+    df = df.copy()
+    if 'stock_total' not in df.columns: df['stock_total'] = 0
+
+    # 1. Demanda de ambos métodos sobre las mismas matrices
+    rem, pres = _matrices_demanda(df)
+    Wp = df['Wp'].to_numpy(dtype=float)[:, None]
+    Wf = df['Wf'].to_numpy(dtype=float)[:, None]
+    demanda = np.stack([_demanda_matriz(rem, pres, Wp, Wf, metodo) for metodo in metodos])
+    demanda_total = _sumar_sucursales(demanda)
+
+    # 2. Coberturas y distribución con el eje de métodos
+    m = _preparar_stock(df)
+    m['demanda'] = demanda
+    m['cobertura_ampliada_total'] = m['stock_ampliado_global'] / np.where(demanda_total == 0, 0.00001, demanda_total)
+    qty_p, es_filtro = _parametros_empaque(df)
+    sucursales = m['sucursales']
+
+    i_origen = sucursales.index(sucursal_origen)
+    es_origen = np.arange(len(sucursales)) == i_origen
+    cob = _coberturas_matriz(m, es_origen, cob_origen_meses / 12.0, cob_destino_meses / 12.0)
+    envios = _distribuir_escenarios(m, cob['diff'], i_origen, qty_p, es_filtro, reglas_cajas)
+
+    # 3. Columnas pareadas y diferencias
+    for k, metodo in enumerate(metodos):
+        sufijo = f'metodo_{metodo.lower()}'
+        for i, suc in enumerate(sucursales):
+            df[f'demanda_estimada_{suc}_{sufijo}'] = demanda[k][:, i]
+        df[f'demanda_estimada_total_{sufijo}'] = demanda_total[k]
+        for i, suc in enumerate(sucursales):
+            df[f'diff_{suc}_{sufijo}'] = cob['diff'][k][:, i]
+        for i, suc in enumerate(sucursales):
+            if i != i_origen:
+                df[f'final_enviar_{suc}_{sufijo}'] = envios[k][:, i]
+
+    delta = envios[1] - envios[0]
+    for i, suc in enumerate(sucursales):
+        if i != i_origen:
+            df[f'delta_enviar_{suc}'] = delta[:, i]
+    df['delta_enviar_total'] = delta.sum(axis=1)
+
+    return df
+
+# Media de demanda del horizonte hasta la que la Poisson se sortea por transformada
+# inversa contra su función de distribución tabulada (por encima, sorteo directo)
+MEDIA_MAXIMA_TABLA = 100.0
+
+def _umbrales_poisson(media, disponible):
+    """
+    F(floor(disponible)) de una Poisson(media) por celda, tabulada con la recurrencia
+    p(k) = p(k-1) x media / k. Hay quiebre (demanda > disponible) cuando U > F con U
+    uniforme en [0, 1). Disponible negativo quiebra siempre (F = -1) y por encima de
+    la cola extrema (media + 10 desvíos) no quiebra nunca (F = 1). Las celdas con
+    media > MEDIA_MAXIMA_TABLA no se tabulan (quedan en 1): se sortean directamente.
+    """
+    n = np.floor(disponible)
+    umbral = np.where(n < 0, -1.0, 1.0)
+    cola = np.ceil(media + 10.0 * np.sqrt(media) + 10.0)
+    tabular = (n >= 0) & (n <= cola)
+    tabular &= media <= MEDIA_MAXIMA_TABLA
+    if not tabular.any():
+        return umbral
+
+    m, k_celda = media[tabular], n[tabular]
+    prob = np.exp(-m)
+    acumulada = prob.copy()
+    valores = np.where(k_celda == 0, acumulada, 1.0)
+    for k in range(1, int(k_celda.max()) + 1):
+        prob = prob * m / k
+        acumulada += prob
+        valores = np.where(k_celda == k, acumulada, valores)
+    umbral[tabular] = np.minimum(valores, 1.0)
+    return umbral
+
+def simular_riesgo_quiebre(df, sucursal_origen='sf', n_ensayos=1000, horizonte_meses=1.0, semilla=0,
+                           max_celdas_lote=10_000_000):
+    """
+    Simulación Monte Carlo del riesgo de quiebre en las sucursales destino antes de la
+    próxima reposición. La demanda del horizonte es Poisson con media
+    demanda_estimada_* x horizonte y se sortea para todos los SKUs x destinos x ensayos
+    a la vez (por lotes de SKUs para acotar la memoria). El mismo sorteo se compara
+    contra el stock disponible sin y con el envío propuesto (final_enviar_*).
+    Requiere df con demanda estimada y envíos (distribuir_stock).
+
+    Args:
+        df: DataFrame resultado de distribuir_stock
+        sucursal_origen: Código de sucursal origen (no se simula)
+        n_ensayos: Cantidad de ensayos por SKU
+        horizonte_meses: Meses hasta la próxima reposición
+        semilla: Semilla del generador; con la misma semilla y max_celdas_lote el resultado se repite
+        max_celdas_lote: Máximo de celdas (SKUs x destinos x ensayos) sorteadas por lote
+
+    Returns:
+        (df con prob_quiebre_antes_{destino} y prob_quiebre_despues_{destino},
+         DataFrame resumen con una fila por destino: SKUs en quiebre esperados y
+         percentil 95 por ensayo, sin y con el envío)
+    """
+    df = df.copy()
+    destinos = [
+        suc for suc, datos in SUCURSALES.items()
+        if suc != sucursal_origen and datos['stock'] in df.columns and f'demanda_estimada_{suc}' in df.columns
+    ]
+    n_skus, n_destinos = len(df), len(destinos)
+
+    media = np.column_stack([
+        _serie_densa(df[f'demanda_estimada_{suc}']).fillna(0).clip(lower=0).to_numpy(dtype=float)
+        for suc in destinos
+    ]).reshape(n_skus, n_destinos) * (horizonte_meses / 12.0)
+    disponible_antes = np.column_stack([
+        (df[SUCURSALES[suc]['stock']] + df.get(SUCURSALES[suc]['transito'], 0)).fillna(0).to_numpy(dtype=float)
+        for suc in destinos
+    ]).reshape(n_skus, n_destinos)
+    envio = np.column_stack([
+        _serie_densa(df[f'final_enviar_{suc}']).fillna(0).to_numpy(dtype=float) if f'final_enviar_{suc}' in df.columns
+        else np.zeros(n_skus)
+        for suc in destinos
+    ]).reshape(n_skus, n_destinos)
+    disponible_despues = disponible_antes + envio
+
+    # Solo se sortean los SKUs que pueden quebrar en algún destino
+    umbral_antes = _umbrales_poisson(media, disponible_antes)
+    umbral_despues = _umbrales_poisson(media, disponible_despues)
+    directa = media > MEDIA_MAXIMA_TABLA
+    filas = np.flatnonzero((umbral_antes < 1.0).any(axis=1) | directa.any(axis=1))
+
+    quiebres_antes = np.zeros((n_skus, n_destinos))
+    quiebres_despues = np.zeros((n_skus, n_destinos))
+    # SKUs en quiebre en cada ensayo, por destino
+    por_ensayo_antes = np.zeros((n_ensayos, n_destinos))
+    por_ensayo_despues = np.zeros((n_ensayos, n_destinos))
+
+    rng = np.random.default_rng(semilla)
+    filas_por_lote = max(1, max_celdas_lote // max(n_ensayos * n_destinos, 1))
+    for inicio in range(0, len(filas), filas_por_lote):
+        lote = filas[inicio:inicio + filas_por_lote]
+        u = rng.random((len(lote), n_destinos, n_ensayos))
+        quiebre_antes = u > umbral_antes[lote][:, :, None]
+        quiebre_despues = u > umbral_despues[lote][:, :, None]
+
+        # Medias altas: sorteo directo de la demanda
+        i_sku, i_suc = np.nonzero(directa[lote])
+        if len(i_sku):
+            demanda = rng.poisson(media[lote][i_sku, i_suc][:, None], size=(len(i_sku), n_ensayos))
+            quiebre_antes[i_sku, i_suc] = demanda > disponible_antes[lote][i_sku, i_suc][:, None]
+            quiebre_despues[i_sku, i_suc] = demanda > disponible_despues[lote][i_sku, i_suc][:, None]
+
+        quiebres_antes[lote] = np.count_nonzero(quiebre_antes, axis=2)
+        quiebres_despues[lote] = np.count_nonzero(quiebre_despues, axis=2)
+        por_ensayo_antes += np.count_nonzero(quiebre_antes, axis=0).T
+        por_ensayo_despues += np.count_nonzero(quiebre_despues, axis=0).T
+
+    for i, suc in enumerate(destinos):
+        df[f'prob_quiebre_antes_{suc}'] = quiebres_antes[:, i] / n_ensayos
+        df[f'prob_quiebre_despues_{suc}'] = quiebres_despues[:, i] / n_ensayos
+
+    resumen = pd.DataFrame({
+        'sucursal': destinos,
+        'skus_quiebre_antes': por_ensayo_antes.mean(axis=0),
+        'skus_quiebre_despues': por_ensayo_despues.mean(axis=0),
+        'skus_quiebre_antes_p95': np.percentile(por_ensayo_antes, 95, axis=0),
+        'skus_quiebre_despues_p95': np.percentile(por_ensayo_despues, 95, axis=0),
+    })
+    return df, resumen
+
+def simular_semanas(df, sucursal_origen='sf', semanas=12, cob_origen_meses=6.0, cob_destino_meses=4.0,
+                    demora_envio_semanas=1, semanas_arribo_transito=1, semilla=None, reglas_cajas=None):
+    """
+    Simula la red semana a semana a partir de un resultado de distribuir_stock. La semana 0
+    despacha los envíos propuestos (final_enviar_*); cada semana siguiente llegan los
+    tránsitos y envíos que corresponden, se consume la demanda semanal y se vuelve a
+    aplicar la regla de distribución sobre todos los SKUs a la vez.
 
+    Args:
+        df: DataFrame resultado de distribuir_stock
+        sucursal_origen: Código de sucursal origen
+        semanas: Horizonte de la simulación en semanas
+        cob_origen_meses: Cobertura objetivo en meses para la sucursal origen
+        cob_destino_meses: Cobertura objetivo en meses para las sucursales destino
+        demora_envio_semanas: Semanas entre el despacho y la llegada de un envío. Con 0 el
+                              envío llega a destino en el mismo despacho (sin pasar por tránsito)
+        semanas_arribo_transito: Semana en que llegan los tránsitos OT y envíos entrantes
+                                 iniciales (0 = antes del despacho de la semana 0)
+        semilla: None = demanda semanal igual a la demanda estimada / 52; con semilla, se sortea Poisson
+        reglas_cajas: Tabla {tamaño_caja: max_faltante} para Filtros
+
+    Returns:
+        DataFrame con una fila por semana: unidades y líneas despachadas, unidades recibidas
+        de envíos, SKUs en quiebre y unidades no abastecidas (total y por sucursal).
+    """
+    if demora_envio_semanas < 0 or semanas_arribo_transito < 0:
+        raise ValueError("La demora del envío y la semana de llegada de tránsitos no pueden ser negativas")
+    df = df.copy()
+    m = _preparar_stock(df)
+    qty_p, es_filtro = _parametros_empaque(df)
+    sucursales = m['sucursales']
+    n_skus, n_suc = m['stock'].shape
+
+    i_origen = sucursales.index(sucursal_origen)
+    es_origen = np.arange(n_suc) == i_origen
+    origen = np.full(n_skus, i_origen)
+
+    demanda = np.nan_to_num(m['demanda'])
+    demanda_total = _sumar_sucursales(demanda)
+    demanda_segura_total = np.where(demanda_total == 0, 0.00001, demanda_total)
+    demanda_semanal = demanda / 52.0
+
+    stock = np.nan_to_num(m['stock'])
+    transito_ot = np.nan_to_num(m['transito'])
+    entrante = np.nan_to_num(m['entrante'])
+    # Envíos despachados y no recibidos: por semana de llegada y acumulados por destino
+    en_camino = {}
+    transito_envios = np.zeros((n_skus, n_suc))
+
+    envios = np.zeros((n_skus, n_suc))
+    for i, suc in enumerate(sucursales):
+        if i != i_origen and f'final_enviar_{suc}' in df.columns:
+            envios[:, i] = _serie_densa(df[f'final_enviar_{suc}']).fillna(0).to_numpy(dtype=float)
+
+    rng = np.random.default_rng(semilla) if semilla is not None else None
+    filas = []
+    for semana in range(semanas + 1):
+        fila = {'semana': semana, 'unidades_recibidas': 0.0}
+
+        # 1. Llegadas
+        if semana == semanas_arribo_transito:
+            stock = stock + transito_ot + entrante
+            transito_ot = np.zeros_like(transito_ot)
+            entrante = np.zeros_like(entrante)
+        llegada = en_camino.pop(semana, None)
+        if llegada is not None:
+            stock = stock + llegada
+            transito_envios = transito_envios - llegada
+            fila['unidades_recibidas'] = llegada.sum()
+
+        if semana > 0:
+            # 2. Consumo de la demanda semanal; lo que no alcanza se pierde
+            consumo = rng.poisson(demanda_semanal) if rng is not None else demanda_semanal
+            no_abastecido = np.maximum(consumo - stock, 0)
+            stock = np.maximum(stock - consumo, 0)
+
+            quiebre = no_abastecido > 0
+            fila['skus_quiebre'] = int(quiebre.any(axis=1).sum())
+            fila['unidades_no_abastecidas'] = no_abastecido.sum()
+            for i, suc in enumerate(sucursales):
+                fila[f'quiebres_{suc}'] = int(quiebre[:, i].sum())
+
+            # 3. Nueva distribución con el estado de la semana
+            transito = transito_ot + transito_envios
+            m_semana = {
+                'stock': stock, 'transito': transito, 'entrante': entrante, 'demanda': demanda,
+                'cobertura_ampliada_total': (stock.sum(axis=1) + transito.sum(axis=1) + entrante.sum(axis=1))
+                                            / demanda_segura_total,
+            }
+            cob = _coberturas_matriz(m_semana, es_origen, cob_origen_meses / 12.0, cob_destino_meses / 12.0)
+            envios = _distribuir_matriz(stock, transito, demanda, cob['diff'], origen, qty_p, es_filtro, reglas_cajas)
         else:
-            disponible_origen = 0
-
-        # Seguridad física final: nunca enviar más que el stock físico
-        disponible_origen = min(disponible_origen, stock_fisico_origen)
-
-        envios_deseados = {}
-        total_deseado = 0
-
-        # --- 2. NECESIDAD SUCURSALES DESTINO (TECHO DEL FALTANTE) ---
-        for suc_destino in sucursales_destino:
-            diferencia_real = row.get(f'diff_{suc_destino}', 0)
-
-            if diferencia_real < 0:
-                falta_base = math.ceil(abs(diferencia_real))
-                qty_a_pedir = 0
-
-                if es_filtro:
-                    qty_a_pedir = calcular_qty_filtros(falta_base, qty_p)
-                else:
-                    # Determinar columnas según sucursal destino
-                    if suc_destino == 'sf':
-                        col_stock = 'stock_total_sf_fisico'
-                        col_trans = 'qty_ot_transito_sf'
-                    else:
-                        col_stock = f'stock_{suc_destino}'
-                        col_trans = f'qty_ot_transito_{suc_destino}'
-
-                    stock_suc_actual = row.get(col_stock, 0) + row.get(col_trans, 0)
-                    qty_a_pedir = calcular_qty_kits(falta_base, stock_suc_actual, qty_p)
-
-                envios_deseados[suc_destino] = qty_a_pedir
-                total_deseado += qty_a_pedir
-            else:
-                envios_deseados[suc_destino] = 0
-
-        # --- 3. DISTRIBUCIÓN ---
-        envios_finales = {suc: 0 for suc in sucursales_destino}
-
-        if disponible_origen <= 0:
-            return pd.Series(envios_finales)
-
-        if disponible_origen >= total_deseado:
-            for suc, qty in envios_deseados.items():
-                envios_finales[suc] = qty
-            return pd.Series(envios_finales)
-
-        # Escasez: Prorratear con corrección de remanentes
-        if total_deseado > 0:
-            ratio = disponible_origen / total_deseado
-
-            # A) Asignación proporcional base (suelo)
-            for suc, qty_deseada in envios_deseados.items():
-                if qty_deseada > 0:
-                    cant_prop = math.floor(qty_deseada * ratio)
-                    envios_finales[suc] = cant_prop
-
-            # B) Distribuir el remanente (lo que sobró por redondear hacia abajo)
-            total_asignado = sum(envios_finales.values())
-            remanente = disponible_origen - total_asignado
-
-            if remanente > 0:
-                # Candidatos: Sucursales que pidieron y aún no recibieron todo
-                candidatos = []
-                for suc in sucursales_destino:
-                    if envios_deseados[suc] > 0:
-                        falta_para_deseado = envios_deseados[suc] - envios_finales[suc]
-                        if falta_para_deseado > 0:
-                            # Prioridad: Diff más negativo (mayor escasez)
-                            diff_val = row.get(f'diff_{suc}', 0)
-                            candidatos.append({'suc': suc, 'diff': diff_val})
-
-                # Ordenar por mayor necesidad (diff más negativo primero)
-                candidatos.sort(key=lambda x: x['diff'])
-
-                # Repartir 1 a 1 en orden de prioridad hasta agotar remanente
-                idx = 0
-                while remanente > 0 and candidatos:
-                    # Usamos módulo para dar vuelta a la lista si sobra mucho (raro)
-                    cand = candidatos[idx % len(candidatos)]
-                    suc_cand = cand['suc']
-
-                    # Verificación final para no dar más de lo deseado (opcional en escasez extrema, pero prolijo)
-                    if envios_finales[suc_cand] < envios_deseados[suc_cand]:
-                        envios_finales[suc_cand] += 1
-                        remanente -= 1
-
-                    idx += 1
-
-        return pd.Series(envios_finales)
-
-    cols_envios = df.apply(calcular_fila, axis=1)
-    for suc in sucursales_destino:
-        df[f'final_enviar_{suc}'] = cols_envios[suc]
+            fila['skus_quiebre'] = 0
+            fila['unidades_no_abastecidas'] = 0.0
+            for suc in sucursales:
+                fila[f'quiebres_{suc}'] = 0
+
+        # 4. Despacho: sale del origen y llega a destino tras la demora
+        stock[:, i_origen] -= envios.sum(axis=1)
+        if demora_envio_semanas == 0:
+            stock = stock + envios
+            fila['unidades_recibidas'] += envios.sum()
+        else:
+            en_camino[semana + demora_envio_semanas] = envios
+            transito_envios = transito_envios + envios
+
+        fila['unidades_enviadas'] = envios.sum()
+        fila['lineas_envio'] = int((envios > 0).sum())
+        for i, suc in enumerate(sucursales):
+            if i != i_origen:
+                fila[f'unidades_{suc}'] = envios[:, i].sum()
+        filas.append(fila)
+
+    return pd.DataFrame(filas)
+
+# Capacidad por defecto de un camión (peso en kg, volumen en m³)
+CAPACIDAD_CAMION_PESO = 10_000.0
+CAPACIDAD_CAMION_VOLUMEN = 40.0
+
+def _empaquetar(unidades, tamano_bulto, peso, volumen, capacidad_peso, capacidad_volumen, prioridad=None,
+                ventana=None):
+    """
+    Arma cargas con First Fit Decreasing en dos dimensiones (peso y volumen). Cada línea
+    se parte en bultos indivisibles: cajas o juegos completos de tamano_bulto unidades y,
+    si la cantidad no es múltiplo, un bulto con las unidades sueltas. Los bultos iguales
+    de una línea se ubican juntos, llenando cada camión abierto con todos los que entran.
+
+    Args:
+        unidades, tamano_bulto, peso, volumen: Arrays por línea (peso y volumen por unidad)
+        capacidad_peso, capacidad_volumen: Capacidad de cada camión
+        prioridad: Array por línea opcional; las líneas de mayor prioridad se ubican
+                   primero (y ocupan los primeros camiones), a igual prioridad decreciente
+        ventana: Cantidad de camiones abiertos más recientes donde se buscan huecos (None =
+                 todos). Acota el trabajo por bulto y evita que lo de menor prioridad
+                 rellene los primeros camiones.
+
+    Returns:
+        (DataFrame con una fila por línea y camión: linea, camion, bultos, unidades;
+         cantidad de camiones)
+    """
+    unidades = np.asarray(unidades, dtype=float)
+    tamano_bulto = np.asarray(tamano_bulto, dtype=float)
+    completos = np.floor(unidades / tamano_bulto)
+    sueltas = unidades - completos * tamano_bulto
+
+    # Items: (línea, cantidad de bultos, unidades por bulto)
+    lineas = np.arange(len(unidades))
+    items_linea = np.concatenate([lineas[completos > 0], lineas[sueltas > 0]])
+    items_bultos = np.concatenate([completos[completos > 0], np.ones(int((sueltas > 0).sum()))])
+    items_tamano = np.concatenate([tamano_bulto[completos > 0], sueltas[sueltas > 0]])
+    items_peso = items_tamano * np.asarray(peso, dtype=float)[items_linea]
+    items_volumen = items_tamano * np.asarray(volumen, dtype=float)[items_linea]
+
+    # Decreciente por la dimensión más exigida del bulto
+    tamano_relativo = np.maximum(items_peso / capacidad_peso, items_volumen / capacidad_volumen)
+    if prioridad is None:
+        orden = np.argsort(-tamano_relativo, kind='stable')
+    else:
+        orden = np.lexsort((-tamano_relativo, -np.asarray(prioridad, dtype=float)[items_linea]))
+
+    # Mínimos de peso y volumen de los bultos que faltan ubicar: un camión con menos
+    # lugar que eso ya no recibe nada y se saca de la búsqueda
+    minimo_peso = np.minimum.accumulate(items_peso[orden][::-1])[::-1]
+    minimo_volumen = np.minimum.accumulate(items_volumen[orden][::-1])[::-1]
+
+    camiones = np.zeros(0, dtype=np.int64)
+    libre_peso = np.zeros(0)
+    libre_volumen = np.zeros(0)
+    n_camiones = 0
+    filas = []
+
+    def entran(libre_p, libre_v, p, v):
+        # Una dimensión nula no limita, salvo en un camión ya excedido por un bulto que iba solo
+        por_peso = np.floor((libre_p + 1e-9) / p) if p > 0 else np.where(libre_p + 1e-9 >= 0, np.inf, 0)
+        por_volumen = np.floor((libre_v + 1e-9) / v) if v > 0 else np.where(libre_v + 1e-9 >= 0, np.inf, 0)
+        return np.maximum(np.minimum(por_peso, por_volumen), 0)
+
+    items = zip(items_linea[orden].tolist(), items_bultos[orden].tolist(), items_tamano[orden].tolist(),
+                items_peso[orden].tolist(), items_volumen[orden].tolist())
+    for posicion, (linea, bultos, tamano, p, v) in enumerate(items):
+        if posicion % 64 == 0 and len(camiones):
+            vivos = (libre_peso + 1e-9 >= minimo_peso[posicion]) & (libre_volumen + 1e-9 >= minimo_volumen[posicion])
+            camiones, libre_peso, libre_volumen = camiones[vivos], libre_peso[vivos], libre_volumen[vivos]
+
+        # 1. First fit sobre los camiones abiertos
+        if bultos == 1:
+            # Un solo bulto: primer camión donde entra
+            cabe = (libre_peso + 1e-9 >= p) & (libre_volumen + 1e-9 >= v)
+            j = int(cabe.argmax()) if len(cabe) else 0
+            if len(cabe) and cabe[j]:
+                filas.append((linea, camiones[j], 1.0, tamano))
+                libre_peso[j] -= p
+                libre_volumen[j] -= v
+                continue
+            resto = 1.0
+        else:
+            capacidad = np.minimum(entran(libre_peso, libre_volumen, p, v), bultos)
+            toma = np.minimum(capacidad, np.maximum(bultos - (np.cumsum(capacidad) - capacidad), 0))
+            for j in np.flatnonzero(toma > 0):
+                filas.append((linea, camiones[j], toma[j], toma[j] * tamano))
+            libre_peso = libre_peso - toma * p
+            libre_volumen = libre_volumen - toma * v
+            resto = bultos - toma.sum()
+
+        # 2. Camiones nuevos para lo que no entró (un bulto que excede la capacidad va solo)
+        if resto > 0:
+            por_camion = max(1.0, min(entran(np.array([capacidad_peso]), np.array([capacidad_volumen]), p, v)[0], resto))
+            n_nuevos = int(np.ceil(resto / por_camion))
+            carga = np.full(n_nuevos, por_camion)
+            carga[-1] = resto - por_camion * (n_nuevos - 1)
+            nuevos = np.arange(n_camiones, n_camiones + n_nuevos)
+            for j in range(n_nuevos):
+                filas.append((linea, nuevos[j], carga[j], carga[j] * tamano))
+            camiones = np.concatenate([camiones, nuevos])
+            libre_peso = np.concatenate([libre_peso, capacidad_peso - carga * p])
+            libre_volumen = np.concatenate([libre_volumen, capacidad_volumen - carga * v])
+            n_camiones += n_nuevos
+            # La ventana avanza con cada camión nuevo
+            if ventana is not None and camiones[0] < n_camiones - ventana:
+                vivos = camiones >= n_camiones - ventana
+                camiones, libre_peso, libre_volumen = camiones[vivos], libre_peso[vivos], libre_volumen[vivos]
+
+    cargas = pd.DataFrame(filas, columns=['linea', 'camion', 'bultos', 'unidades'])
+    cargas = cargas.astype({'linea': np.int64, 'camion': np.int64})
+    return cargas, n_camiones
+
+def armar_cargas(df, sucursal_origen='sf', capacidad_peso=CAPACIDAD_CAMION_PESO,
+                 capacidad_volumen=CAPACIDAD_CAMION_VOLUMEN):
+    """
+    Arma los camiones de cada destino con las líneas de envío (final_enviar_*) usando
+    peso y volumen por unidad. Nunca separa una caja o juego completo (qty_piezas) ni
+    las unidades sueltas de una línea entre camiones.
+
+    Args:
+        df: DataFrame resultado de distribuir_stock (con peso y volumen)
+        sucursal_origen: Código de sucursal origen
+        capacidad_peso: Peso máximo por camión (kg)
+        capacidad_volumen: Volumen máximo por camión (m³)
+
+    Returns:
+        (DataFrame manifiesto con una fila por destino, camión y SKU,
+         DataFrame resumen con camiones, peso, volumen y ocupación por destino)
+    """
+    qty_p, _ = _parametros_empaque(df)
+    peso = pd.to_numeric(df['peso'], errors='coerce').fillna(0).to_numpy() if 'peso' in df.columns else np.zeros(len(df))
+    volumen = pd.to_numeric(df['volumen'], errors='coerce').fillna(0).to_numpy() if 'volumen' in df.columns else np.zeros(len(df))
+    identificacion = [c for c in COLUMNAS_IDENTIFICACION if c in df.columns]
+
+    manifiestos, resumen = [], []
+    for suc in SUCURSALES:
+        col_envio = f'final_enviar_{suc}'
+        if suc == sucursal_origen or col_envio not in df.columns:
+            continue
+        envio = _serie_densa(df[col_envio]).fillna(0).to_numpy(dtype=float)
+        filas = np.flatnonzero(envio > 0)
+
+        cargas, n_camiones = _empaquetar(
+            envio[filas], qty_p[filas], peso[filas], volumen[filas], capacidad_peso, capacidad_volumen
+        )
+        fila_df = filas[cargas['linea'].to_numpy()]
+        manifiesto = df.iloc[fila_df][identificacion].reset_index(drop=True)
+        manifiesto.insert(0, 'camion', cargas['camion'].to_numpy() + 1)
+        manifiesto.insert(0, 'destino', suc)
+        manifiesto['bultos'] = cargas['bultos'].to_numpy()
+        manifiesto['unidades'] = cargas['unidades'].to_numpy()
+        manifiesto['peso'] = manifiesto['unidades'] * peso[fila_df]
+        manifiesto['volumen'] = manifiesto['unidades'] * volumen[fila_df]
+        manifiestos.append(manifiesto.sort_values(['camion'], kind='stable'))
+
+        resumen.append({
+            'destino': suc,
+            'camiones': n_camiones,
+            'lineas': len(filas),
+            'unidades': envio.sum(),
+            'peso': manifiesto['peso'].sum(),
+            'volumen': manifiesto['volumen'].sum(),
+            'ocupacion_peso': manifiesto['peso'].sum() / (n_camiones * capacidad_peso) if n_camiones else 0.0,
+            'ocupacion_volumen': manifiesto['volumen'].sum() / (n_camiones * capacidad_volumen) if n_camiones else 0.0,
+        })
+
+    manifiesto = pd.concat(manifiestos, ignore_index=True) if manifiestos else pd.DataFrame()
+    return manifiesto, pd.DataFrame(resumen)
+
+def ajustar_a_capacidad(df, capacidades, sucursal_origen='sf', cob_destino_meses=4.0):
+    """
+    Recorta los envíos de cada destino a un tope de peso y volumen (ej: el camión semanal)
+    eligiendo las líneas con más beneficio de cobertura por capacidad ocupada. Primero
+    entran los SKUs en riesgo (cobertura antes del envío < 1 mes, como en el tablero) y,
+    dentro de cada grupo, los de mayor faltante de cobertura respecto del objetivo por
+    unidad de capacidad. Las líneas se recortan en bultos enteros: primero las unidades
+    sueltas que cierran la caja o el juego en destino y luego cajas o juegos completos
+    (qty_piezas), así que las reglas de lote se mantienen.
+
+    Args:
+        df: DataFrame resultado de distribuir_stock
+        capacidades: Dict {destino: (peso_max, volumen_max)}; None o 0 = sin límite en esa
+                     dimensión. Los destinos ausentes no se recortan.
+        sucursal_origen: Código de sucursal origen
+        cob_destino_meses: Cobertura objetivo de los destinos (mide el faltante de cobertura)
+
+    Returns:
+        df con final_enviar_{destino} recortado y recorte_{destino} (unidades que no entran)
+    """
+    qty_p, _ = _parametros_empaque(df)
+    peso = pd.to_numeric(df['peso'], errors='coerce').fillna(0).to_numpy() if 'peso' in df.columns else np.zeros(len(df))
+    volumen = pd.to_numeric(df['volumen'], errors='coerce').fillna(0).to_numpy() if 'volumen' in df.columns else np.zeros(len(df))
+
+    for suc, (peso_max, volumen_max) in capacidades.items():
+        col_envio = f'final_enviar_{suc}'
+        if suc == sucursal_origen or col_envio not in df.columns:
+            continue
+        peso_max = peso_max if peso_max else np.inf
+        volumen_max = volumen_max if volumen_max else np.inf
+
+        disperso = isinstance(df[col_envio].dtype, pd.SparseDtype)
+        envio = _serie_densa(df[col_envio]).fillna(0).to_numpy(dtype=float)
+        filas = np.flatnonzero(envio > 0)
+
+        # 1. Beneficio por unidad de capacidad de cada línea
+        datos = SUCURSALES[suc]
+        demanda_mes = _serie_densa(df[f'demanda_estimada_{suc}']).to_numpy(dtype=float)[filas] / 12.0
+        stock_destino = (df[datos['stock']] + df.get(datos['transito'], 0)).to_numpy(dtype=float)[filas]
+        cobertura_meses = stock_destino / np.where(demanda_mes == 0, 0.00001 / 12.0, demanda_mes)
+        en_riesgo = cobertura_meses < 1.0
+        faltante = np.clip(1.0 - cobertura_meses / cob_destino_meses, 0, 1) if cob_destino_meses > 0 else np.ones(len(filas))
+        ocupacion = peso[filas] / peso_max + volumen[filas] / volumen_max
+        densidad = faltante / np.where(ocupacion > 0, ocupacion, 1e-12)
+        orden = np.lexsort((-densidad, ~en_riesgo))
+
+        # 2. Llenado greedy en bultos enteros
+        elegido = np.zeros(len(filas))
+        libre_peso, libre_volumen = peso_max, volumen_max
+        for k, cantidad, lote, p, v in zip(orden.tolist(), envio[filas][orden].tolist(), qty_p[filas][orden].tolist(),
+                                           peso[filas][orden].tolist(), volumen[filas][orden].tolist()):
+            sueltas = cantidad % lote
+            if sueltas * p > libre_peso + 1e-9 or sueltas * v > libre_volumen + 1e-9:
+                continue
+            completos = (cantidad - sueltas) / lote
+            if p > 0: completos = min(completos, np.floor((libre_peso - sueltas * p + 1e-9) / (lote * p)))
+            if v > 0: completos = min(completos, np.floor((libre_volumen - sueltas * v + 1e-9) / (lote * v)))
+            tomado = sueltas + completos * lote
+            elegido[k] = tomado
+            libre_peso -= tomado * p
+            libre_volumen -= tomado * v
+
+        ajustado = np.zeros(len(df))
+        ajustado[filas] = elegido
+        df[col_envio] = _columna_sucursal(ajustado, disperso)
+        df[f'recorte_{suc}'] = envio - ajustado
 
     return df
 
-def calcular_qty_filtros(necesidad, lote):
+def calcular_qty_filtros(necesidad, lote, reglas_cajas=None):
     """
-    Regla Filtros:
+    Regla Filtros (ver REGLAS_CAJAS_FILTROS):
     - Caja 6: Completar si tengo 4 o 5 (falta 1 o 2).
     - Caja 12: Completar si tengo 9, 10, 11 (falta 1, 2 o 3).
     """
+    if reglas_cajas is None: reglas_cajas = REGLAS_CAJAS_FILTROS
     if lote <= 1: return necesidad
 
     resto = necesidad % lote
@@ -385,9 +1636,8 @@ def calcular_qty_filtros(necesidad, lote):
         
     adicional_para_cerrar = lote - resto
     
-    if lote == 6 and adicional_para_cerrar <= 2:
-        return necesidad + adicional_para_cerrar
-    elif lote == 12 and adicional_para_cerrar <= 3:
+    max_faltante = reglas_cajas.get(lote)
+    if max_faltante is not None and adicional_para_cerrar <= max_faltante:
         return necesidad + adicional_para_cerrar
 
     return necesidad
@@ -406,27 +1656,124 @@ def calcular_qty_kits(necesidad_base, stock_actual, lote):
     envio_calculado = stock_final_deseado - stock_actual
     return max(0, int(envio_calculado))
 
-def calcular_excedentes_sucursales(df, umbral_meses_exceso=0.5):
-    """ Identifica excedentes en sucursales. """
-    sucursales = ['ba', 'mdz', 'slt']
+def calcular_qty_filtros_array(necesidad, lote, reglas_cajas=None):
+    """
+    Versión sobre arrays de calcular_qty_filtros.
+    Los umbrales de cierre salen de reglas_cajas (por defecto REGLAS_CAJAS_FILTROS),
+    buscados por tamaño de caja para todos los SKUs a la vez.
+
+    Args:
+        necesidad: Array de unidades faltantes (enteras, > 0)
+        lote: Array de tamaños de caja (qty_piezas), broadcastable con necesidad
+        reglas_cajas: Dict {tamaño_caja: max_faltante_para_completar}
+    """
+    if reglas_cajas is None: reglas_cajas = REGLAS_CAJAS_FILTROS
+    necesidad = np.asarray(necesidad, dtype=float)
+    lote = np.asarray(lote, dtype=float)
+
+    # Umbral por tamaño de caja (-1 = la caja no se completa nunca)
+    tamaños = np.array(sorted(reglas_cajas), dtype=float)
+    umbrales = np.array([reglas_cajas[t] for t in sorted(reglas_cajas)], dtype=float)
+    max_faltante = np.full(lote.shape, -1.0)
+    if len(tamaños) > 0:
+        idx = np.minimum(np.searchsorted(tamaños, lote), len(tamaños) - 1)
+        max_faltante = np.where(tamaños[idx] == lote, umbrales[idx], -1.0)
+
+    lote_seguro = np.where(lote > 1, lote, 1)
+    resto = np.mod(necesidad, lote_seguro)
+    adicional_para_cerrar = lote_seguro - resto
+
+    completar = (lote > 1) & (resto != 0) & (adicional_para_cerrar <= max_faltante)
+    return np.where(completar, necesidad + adicional_para_cerrar, necesidad)
+
+def calcular_qty_kits_array(necesidad_base, stock_actual, lote):
+    """
+    Versión sobre arrays de calcular_qty_kits.
+    (Stock_Actual + Envio) se lleva al siguiente múltiplo de Lote (Juego) para todos los SKUs a la vez.
+    """
+    necesidad_base = np.asarray(necesidad_base, dtype=float)
+    stock_actual = np.asarray(stock_actual, dtype=float)
+    lote = np.asarray(lote, dtype=float)
+
+    lote_seguro = np.where(lote > 1, lote, 1)
+    kits_necesarios = np.ceil((stock_actual + necesidad_base) / lote_seguro)
+    envio_calculado = kits_necesarios * lote_seguro - stock_actual
+    return np.where(lote > 1, np.maximum(0, np.trunc(envio_calculado)), necesidad_base)
+
+def _transferencias_laterales(excedente, faltante, diff):
+    """
+    Cruza la matriz de excedentes con la de faltantes (SKUs x sucursales) en una sola
+    pasada. Lo que recibe cada sucursal se reparte como en distribuir_stock (prorrateo
+    por necesidad si el excedente total no alcanza); después cada fila se asigna
+    ordenando orígenes de mayor a menor excedente y destinos de mayor a menor necesidad,
+    y el envío origen -> destino es el solapamiento de sus tramos acumulados.
+
+    Returns:
+        Array (SKUs, origen, destino) con las unidades a transferir.
+    """
+    recibido = _repartir_disponible(faltante, faltante.sum(axis=1), excedente.sum(axis=1), diff)
+
+    orden_o = np.argsort(-excedente, axis=1, kind='stable')
+    orden_d = np.argsort(np.where(recibido > 0, diff, np.inf), axis=1, kind='stable')
+    fin_o = np.cumsum(np.take_along_axis(excedente, orden_o, axis=1), axis=1)
+    fin_d = np.cumsum(np.take_along_axis(recibido, orden_d, axis=1), axis=1)
+    inicio_o = fin_o - np.take_along_axis(excedente, orden_o, axis=1)
+    inicio_d = fin_d - np.take_along_axis(recibido, orden_d, axis=1)
+
+    solape = np.clip(
+        np.minimum(fin_o[:, :, None], fin_d[:, None, :]) - np.maximum(inicio_o[:, :, None], inicio_d[:, None, :]),
+        0, None
+    )
+    envios = np.zeros_like(solape)
+    filas = np.arange(len(excedente))[:, None, None]
+    envios[filas, orden_o[:, :, None], orden_d[:, None, :]] = solape
+    return envios
+
+def _rebalanceo_lateral(excedente, stock, demanda, cob_transferencia_meses):
+    """
+    Transferencias entre sucursales a partir de sus excedentes. Las sucursales sin
+    excedente piden hasta cob_transferencia_meses de cobertura (stock + tránsito de
+    devolución contra demanda anual); el resto del excedente queda para devolver a la central.
+
+    Args:
+        excedente, stock, demanda: Matrices (SKUs, sucursales)
+        cob_transferencia_meses: Cobertura objetivo de las sucursales que reciben
+
+    Returns:
+        (envios (SKUs, origen, destino), retorno (SKUs, sucursales))
+    """
+    stock, demanda = np.nan_to_num(stock), np.nan_to_num(demanda)
+    objetivo = demanda * (cob_transferencia_meses / 12.0)
+    diff = np.divide(stock - objetivo, demanda, out=np.zeros_like(objetivo), where=demanda > 0)
+    faltante = np.where((excedente <= 0) & (demanda > 0), np.ceil(np.clip(objetivo - stock, 0, None)), 0)
+    envios = _transferencias_laterales(excedente, faltante, diff)
+    return envios, excedente - envios.sum(axis=2)
+
+def calcular_excedentes_sucursales(df, umbral_meses_exceso=0.5, cob_transferencia_meses=None):
+    """
+    Identifica excedentes en sucursales. Con cob_transferencia_meses, además cruza los
+    excedentes con los faltantes de las otras sucursales (transferir_{origen}_a_{destino})
+    y deja el resto como devolución a la central (retorno_qty/peso/vol_{sucursal}).
+    """
+    sucursales = [s for s in SUCURSALES if s != SUCURSAL_CENTRAL]
+    central = SUCURSALES[SUCURSAL_CENTRAL]
     for c in ['peso', 'volumen']:
         df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0)
 
     # Contexto SF
     obj_sf = 0.5 
-    stock_sf_total = df['stock_total_sf_fisico'] + df.get('qty_sf', 0)
-    target_sf = df['demanda_estimada_sf'] * obj_sf
+    stock_sf_total = df[central['stock']] + df.get(central['entrante'], 0)
+    target_sf = _serie_densa(df[f'demanda_estimada_{SUCURSAL_CENTRAL}']) * obj_sf
     df['sf_deficit'] = target_sf - stock_sf_total
     df['sf_necesita_stock'] = df['sf_deficit'] > 0
 
     for suc in sucursales:
-        col_stock = f'stock_{suc}'
+        col_stock = SUCURSALES[suc]['stock']
         col_demanda = f'demanda_estimada_{suc}'
-        col_transito = f'qty_transito_{suc}'
-        if suc == 'slt': col_transito = 'qty_ot_transito_slt'
+        col_transito = SUCURSALES[suc]['transito_devolucion']
 
         stock_suc = df[col_stock] + df.get(col_transito, 0)
-        demanda_suc = df[col_demanda]
+        demanda_suc = _serie_densa(df[col_demanda])
         
         cobertura_actual = stock_suc / demanda_suc
         
@@ -447,4 +1794,108 @@ def calcular_excedentes_sucursales(df, umbral_meses_exceso=0.5):
         
         df[f'prioridad_retorno_{suc}'] = (df[col_excedente] > 0) & (df['sf_necesita_stock'])
 
-    return df
\ No newline at end of file
+    if cob_transferencia_meses is not None:
+        excedente = np.column_stack([df[f'excedente_qty_{suc}'].to_numpy(float) for suc in sucursales])
+        stock = np.column_stack([
+            (df[SUCURSALES[suc]['stock']] + df.get(SUCURSALES[suc]['transito_devolucion'], 0)).to_numpy(float)
+            for suc in sucursales
+        ])
+        demanda = np.column_stack([_serie_densa(df[f'demanda_estimada_{suc}']).to_numpy(float) for suc in sucursales])
+        envios, retorno = _rebalanceo_lateral(excedente, stock, demanda, cob_transferencia_meses)
+        for o, origen in enumerate(sucursales):
+            for d, destino in enumerate(sucursales):
+                if o != d:
+                    df[f'transferir_{origen}_a_{destino}'] = envios[:, o, d].astype(np.int64)
+        for i, suc in enumerate(sucursales):
+            df[f'retorno_qty_{suc}'] = retorno[:, i].astype(np.int64)
+            df[f'retorno_peso_{suc}'] = df[f'retorno_qty_{suc}'] * df['peso']
+            df[f'retorno_vol_{suc}'] = df[f'retorno_qty_{suc}'] * df['volumen']
+            df[f'prioridad_retorno_{suc}'] = (df[f'retorno_qty_{suc}'] > 0) & (df['sf_necesita_stock'])
+
+    return df
+
+
+# Camiones abiertos donde se buscan huecos al consolidar devoluciones
+VENTANA_RETORNOS = 16
+
+def armar_retornos(df, capacidad_peso=CAPACIDAD_CAMION_PESO, capacidad_volumen=CAPACIDAD_CAMION_VOLUMEN,
+                   columna_valor=None):
+    """
+    Consolida las devoluciones de cada sucursal a la central en camiones, con el mismo
+    empaque que armar_cargas (cajas o juegos enteros). Las líneas se ordenan por valor
+    recuperado por kg, así los primeros camiones llevan lo que más rinde el flete.
+    Usa retorno_qty_* (lo que queda tras las transferencias) o, si no está, excedente_qty_*.
+
+    Args:
+        df: DataFrame resultado de calcular_excedentes_sucursales
+        capacidad_peso: Peso máximo por camión (kg)
+        capacidad_volumen: Volumen máximo por camión (m³)
+        columna_valor: Columna con el valor por unidad. Sin ella, el valor de una línea son
+                       las unidades que cubren el déficit de la central (sf_deficit),
+                       repartido entre las sucursales en proporción a lo que devuelve cada una.
+
+    Returns:
+        (DataFrame manifiesto con una fila por sucursal, camión y SKU con su valor y
+         valor_por_kg, DataFrame resumen por sucursal y camión con carga, ocupación y valor)
+    """
+    qty_p, _ = _parametros_empaque(df)
+    peso = pd.to_numeric(df['peso'], errors='coerce').fillna(0).to_numpy() if 'peso' in df.columns else np.zeros(len(df))
+    volumen = pd.to_numeric(df['volumen'], errors='coerce').fillna(0).to_numpy() if 'volumen' in df.columns else np.zeros(len(df))
+    identificacion = [c for c in COLUMNAS_IDENTIFICACION if c in df.columns]
+    if columna_valor is not None:
+        valor_unitario = pd.to_numeric(df[columna_valor], errors='coerce').fillna(0).to_numpy(dtype=float)
+    columnas_retorno = {
+        suc: f'retorno_qty_{suc}' if f'retorno_qty_{suc}' in df.columns else f'excedente_qty_{suc}'
+        for suc in SUCURSALES if suc != SUCURSAL_CENTRAL
+    }
+    columnas_retorno = {suc: col for suc, col in columnas_retorno.items() if col in df.columns}
+    if columna_valor is None:
+        # El déficit de la central se cubre una sola vez: cada sucursal acredita la parte
+        # proporcional a lo que devuelve del total devuelto del SKU
+        deficit_central = np.ceil(np.clip(df['sf_deficit'].fillna(0).to_numpy(dtype=float), 0, None))
+        retorno_total = sum(df[col].fillna(0).to_numpy(dtype=float) for col in columnas_retorno.values())
+        cubierto = np.divide(deficit_central, retorno_total, out=np.zeros(len(df)), where=retorno_total > 0)
+        valor_unitario = np.minimum(cubierto, 1.0)
+
+    manifiestos, resumen = [], []
+    for suc, col_retorno in columnas_retorno.items():
+        retorno = df[col_retorno].fillna(0).to_numpy(dtype=float)
+        filas = np.flatnonzero(retorno > 0)
+
+        valor = retorno[filas] * valor_unitario[filas]
+        peso_linea = retorno[filas] * peso[filas]
+        valor_por_kg = np.divide(valor, peso_linea, out=np.where(valor > 0, np.inf, 0.0), where=peso_linea > 0)
+
+        cargas, n_camiones = _empaquetar(
+            retorno[filas], qty_p[filas], peso[filas], volumen[filas], capacidad_peso, capacidad_volumen,
+            prioridad=valor_por_kg, ventana=VENTANA_RETORNOS
+        )
+        linea = cargas['linea'].to_numpy()
+        fila_df = filas[linea]
+        manifiesto = df.iloc[fila_df][identificacion].reset_index(drop=True)
+        manifiesto.insert(0, 'camion', cargas['camion'].to_numpy() + 1)
+        manifiesto.insert(0, 'sucursal', suc)
+        manifiesto['bultos'] = cargas['bultos'].to_numpy()
+        manifiesto['unidades'] = cargas['unidades'].to_numpy()
+        manifiesto['peso'] = manifiesto['unidades'] * peso[fila_df]
+        manifiesto['volumen'] = manifiesto['unidades'] * volumen[fila_df]
+        manifiesto['valor'] = valor[linea] * manifiesto['unidades'] / retorno[fila_df]
+        manifiesto['valor_por_kg'] = valor_por_kg[linea]
+        manifiestos.append(manifiesto.sort_values(['camion'], kind='stable'))
+
+        por_camion = manifiesto.groupby('camion').agg(
+            lineas=('unidades', 'size'), unidades=('unidades', 'sum'), peso=('peso', 'sum'),
+            volumen=('volumen', 'sum'), valor=('valor', 'sum')
+        ).reset_index()
+        por_camion.insert(0, 'sucursal', suc)
+        por_camion['ocupacion_peso'] = por_camion['peso'] / capacidad_peso
+        por_camion['ocupacion_volumen'] = por_camion['volumen'] / capacidad_volumen
+        por_camion['valor_por_kg'] = np.divide(
+            por_camion['valor'], por_camion['peso'],
+            out=np.where(por_camion['valor'] > 0, np.inf, 0.0), where=por_camion['peso'] > 0
+        )
+        resumen.append(por_camion)
+
+    manifiesto = pd.concat(manifiestos, ignore_index=True) if manifiestos else pd.DataFrame()
+    resumen = pd.concat(resumen, ignore_index=True) if resumen else pd.DataFrame()
+    return manifiesto, resumen
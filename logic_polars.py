@@ -0,0 +1,410 @@
+import numpy as np
+import pandas as pd
+import logic
+from logic import SUCURSALES, SUCURSAL_CENTRAL, FAMILIAS_LOGICAS, FAMILIAS_FILTROS
+
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Motor Polars: las mismas etapas que logic.py como expresiones lazy.
+# Cada función recibe y devuelve un pl.LazyFrame y agrega las mismas columnas,
+# con el mismo nombre y en el mismo orden, que su equivalente en logic.py.
+# La distribución de stock es una asignación iterativa (remanentes por
+# rondas) y se resuelve con el mismo núcleo numpy (logic._distribuir_matriz).
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _verificar_polars():
+    if pl is None:
+        raise ImportError("El motor 'polars' requiere instalar polars (pip install polars)")
+
+def _columnas(lf):
+    return lf.collect_schema().names()
+
+def _minimo(a, b):
+    """ Como np.minimum: nulo si cualquiera de los dos es nulo. """
+    return pl.when(a <= b).then(a).when(a > b).then(b)
+
+def _cero_si_falta(lf, columnas):
+    existentes = set(_columnas(lf))
+    faltantes = [c for c in columnas if c not in existentes]
+    if faltantes:
+        lf = lf.with_columns([pl.lit(0, dtype=pl.Int64).alias(c) for c in dict.fromkeys(faltantes)])
+    return lf
+
+def _suma(columnas):
+    """ Como DataFrame.sum(axis=1): omite nulos y suma en orden (sum_horizontal suma por pares). """
+    total = pl.col(columnas[0]).fill_null(0)
+    for col in columnas[1:]:
+        total = total + pl.col(col).fill_null(0)
+    return total
+
+def _sin_cero(expr, valor):
+    return pl.when(expr == 0).then(valor).otherwise(expr)
+
+def clasificar_familias(lf):
+    """ Expresión con la familia lógica (reglas 1-a a 1-f, mismo orden que logic.clasificar_familias). """
+    columnas = _columnas(lf)
+
+    def texto(col):
+        if col not in columnas:
+            return pl.lit('')
+        return pl.col(col).cast(pl.String).fill_null('').str.to_uppercase()
+
+    sf, sf2 = texto('subfamilia'), texto('subfamilia2')
+
+    def contiene(expr, valor):
+        return expr.str.contains(valor, literal=True)
+
+    condiciones = [
+        contiene(sf2, 'GET KTN') | contiene(sf2, 'FIJACION GET'),
+        contiene(sf2, 'RODAJE KTN') | contiene(sf2, 'FIJACION RODAJE'),
+        contiene(sf, 'DONALDSON'),
+        contiene(sf, 'TURBO'),
+        contiene(sf, 'IMPORTADOS') & contiene(sf2, 'FILTROS KTN'),
+        contiene(sf2, 'CAT ALTERNATIVO') | contiene(sf2, 'REPUESTOS KTN') | contiene(sf, 'NORDIC LIGHTS'),
+    ]
+    expr = pl.when(condiciones[0]).then(pl.lit(FAMILIAS_LOGICAS[0]))
+    for cond, familia in zip(condiciones[1:], FAMILIAS_LOGICAS[1:-1]):
+        expr = expr.when(cond).then(pl.lit(familia))
+    return expr.otherwise(pl.lit('OTROS')).cast(pl.Enum(FAMILIAS_LOGICAS))
+
+def calcular_parametros_w(lf, sumas_familia=None):
+    """ Equivalente a logic.calcular_parametros_w. """
+    lf = lf.with_columns(familia_logica=clasificar_familias(lf))
+    lf = lf.with_columns(qpres_total=_sin_cero(pl.col('qpres_total'), 1))
+    lf = lf.with_columns(Wp=pl.col('qrem_total') / pl.col('qpres_total'))
+
+    if sumas_familia is None:
+        wf = (
+            pl.col('qrem_total').sum().over('familia_logica')
+            / _sin_cero(pl.col('qpres_total').sum().over('familia_logica'), 1)
+        )
+    else:
+        qpres = sumas_familia['qpres_total'].replace(0, 1)
+        mapa = (sumas_familia['qrem_total'] / qpres).to_dict()
+        wf = pl.col('familia_logica').cast(pl.String).replace_strict(
+            {str(k): v for k, v in mapa.items()}, default=None, return_dtype=pl.Float64
+        )
+    return lf.with_columns(Wf=wf.cast(pl.Float64).fill_null(0))
+
+def filtrar_familias(lf, familias):
+    if familias:
+        lf = lf.filter(pl.col('familia_logica').cast(pl.String).is_in(list(familias)))
+    return lf
+
+def estimar_demanda(lf, metodo, historial=None):
+    """ Equivalente a logic.estimar_demanda (el Método C corre el suavizado en numpy). """
+    lf = _cero_si_falta(lf, [c for d in SUCURSALES.values() for c in (d['rem'], d['pres'])])
+
+    if metodo == 'C':
+        if historial is None:
+            raise ValueError("El Método C requiere el historial mensual")
+        df = lf.collect()
+        rem = df.select([pl.col(d['rem']) for d in SUCURSALES.values()]).to_numpy().astype(float)
+        pres = df.select([pl.col(d['pres']) for d in SUCURSALES.values()]).to_numpy().astype(float)
+        demanda = logic._demanda_historial(df['codigo'].to_numpy(), historial, rem, pres)
+        lf = df.with_columns([
+            pl.Series(f'demanda_estimada_{suc}', demanda[:, i], nan_to_null=True) for i, suc in enumerate(SUCURSALES)
+        ]).lazy()
+        return lf.with_columns(
+            demanda_estimada_total=_suma([f'demanda_estimada_{suc}' for suc in SUCURSALES])
+        )
+
+    demandas = []
+    for suc, datos in SUCURSALES.items():
+        rem = pl.col(datos['rem']).cast(pl.Float64)
+        pres = pl.col(datos['pres']).cast(pl.Float64)
+
+        # Metodo A
+        if metodo == 'A':
+            demanda = pl.when(pl.col('Wp') < pl.col('Wf')).then(pl.col('Wf') * pres).otherwise(1.1 * rem)
+
+        # Metodo B
+        else:
+            demanda = (
+                pl.when(rem == 0).then(pres * 0.5)
+                .when((pres > rem) & (pres < rem * 1.5)).then((pres + rem) / 2)
+                .when(pres >= rem * 1.5).then(rem * 1.5)
+                .otherwise(rem)
+            )
+        demandas.append(demanda.alias(f'demanda_estimada_{suc}'))
+
+    lf = lf.with_columns(demandas)
+    return lf.with_columns(
+        demanda_estimada_total=_suma([f'demanda_estimada_{suc}' for suc in SUCURSALES])
+    )
+
+def preparar_stock_fisico(lf):
+    """ Equivalente a logic.preparar_stock_fisico. """
+    for datos in SUCURSALES.values():
+        if datos['depositos'] == [datos['stock']]:
+            continue
+        lf = _cero_si_falta(lf, datos['depositos'])
+        lf = lf.with_columns(_suma(datos['depositos']).alias(datos['stock']))
+    return lf
+
+def calcular_coberturas(lf, sucursal_origen='sf', cob_origen_meses=6.0, cob_destino_meses=4.0):
+    """ Equivalente a logic.calcular_coberturas. """
+    cob_origen_años = cob_origen_meses / 12.0
+    cob_destino_años = cob_destino_meses / 12.0
+
+    # 1. Cobertura total, stock físico consolidado y tránsitos
+    lf = _cero_si_falta(lf, ['stock_total'])
+    lf = lf.with_columns(
+        cobertura_ini_total=pl.col('stock_total') / _sin_cero(pl.col('demanda_estimada_total'), 0.00001)
+    )
+    lf = preparar_stock_fisico(lf)
+    lf = _cero_si_falta(lf, [c for d in SUCURSALES.values() for c in (d['transito'], d['entrante'])])
+
+    def num(col):
+        return pl.col(col).cast(pl.Float64)
+
+    # Stock ampliado global = stock físico total + todos los tránsitos OT + todos los envíos entrantes
+    def suma_matriz(clave):
+        cols = [num(d[clave]) for d in SUCURSALES.values()]
+        total = cols[0]
+        for col in cols[1:]:
+            total = total + col
+        return total
+
+    stock_ampliado_global = num('stock_total') + suma_matriz('transito') + suma_matriz('entrante')
+    lf = lf.with_columns(
+        cobertura_ampliada_total=stock_ampliado_global / _sin_cero(pl.col('demanda_estimada_total'), 0.00001)
+    )
+
+    # 2. Coberturas y diferencias por sucursal
+    columnas = []
+    for suc, datos in SUCURSALES.items():
+        es_origen = suc == sucursal_origen
+        demanda = num(f'demanda_estimada_{suc}')
+        demanda_segura = _sin_cero(demanda, 0.00001)
+        stock_inicial = num(datos['stock']) + num(datos['transito'])
+        stock_ampliado = stock_inicial + num(datos['entrante'])
+        target_eff = _minimo(
+            pl.lit(cob_origen_años if es_origen else cob_destino_años), pl.col('cobertura_ampliada_total')
+        )
+        stock_base = stock_ampliado if es_origen else stock_inicial
+
+        columnas += [
+            (stock_inicial / demanda_segura).alias(f'cobertura_ini_{suc}'),
+            (stock_base - demanda * target_eff).alias(f'diff_{suc}'),
+        ]
+        if es_origen:
+            origen = [
+                (stock_ampliado / demanda_segura).alias(f'cobertura_ampliada_{suc}'),
+                target_eff.alias(f'target_{suc}_eff'),
+                num(datos['stock']).alias(f'_stock_fisico_{suc}'),
+                stock_ampliado.alias(f'_stock_ampliado_{suc}'),
+            ]
+    return lf.with_columns(columnas).with_columns(origen)
+
+def _matriz(df, columnas):
+    matriz = np.zeros((df.height, len(columnas)))
+    for j, col in enumerate(columnas):
+        if col in df.columns:
+            matriz[:, j] = df[col].cast(pl.Float64).to_numpy()
+    return matriz
+
+def distribuir_stock(lf, sucursal_origen='sf', reglas_cajas=None):
+    """ Equivalente a logic.distribuir_stock (materializa el frame para el núcleo numpy). """
+    df = lf.collect()
+    sucursales = list(SUCURSALES)
+
+    qty_p = df['qty_piezas'].cast(pl.Float64).to_numpy()
+    qty_p = np.where(np.isnan(qty_p) | (qty_p <= 0), 1, qty_p)
+    es_filtro = df['familia_logica'].cast(pl.String).is_in(FAMILIAS_FILTROS).to_numpy()
+
+    i_origen = sucursales.index(sucursal_origen)
+    envios = logic._distribuir_matriz(
+        _matriz(df, [SUCURSALES[s]['stock'] for s in sucursales]),
+        _matriz(df, [SUCURSALES[s]['transito'] for s in sucursales]),
+        _matriz(df, [f'demanda_estimada_{s}' for s in sucursales]),
+        _matriz(df, [f'diff_{s}' for s in sucursales]),
+        np.full(df.height, i_origen), qty_p, es_filtro, reglas_cajas
+    )
+
+    return df.with_columns([
+        pl.Series(f'final_enviar_{suc}', envios[:, i]) for i, suc in enumerate(sucursales) if i != i_origen
+    ]).lazy()
+
+def ajustar_a_capacidad(lf, capacidades, sucursal_origen='sf', cob_destino_meses=4.0):
+    """ Equivalente a logic.ajustar_a_capacidad (el llenado greedy corre sobre las columnas necesarias). """
+    df = lf.collect()
+    necesarias = ['qty_piezas', 'familia_logica', 'peso', 'volumen'] + [
+        c for suc, datos in SUCURSALES.items()
+        for c in (f'final_enviar_{suc}', f'demanda_estimada_{suc}', datos['stock'], datos['transito'])
+    ]
+    ajustado = logic.ajustar_a_capacidad(
+        df.select([c for c in necesarias if c in df.columns]).to_pandas(),
+        capacidades, sucursal_origen, cob_destino_meses
+    )
+    nuevas = [c for c in ajustado.columns if c.startswith(('final_enviar_', 'recorte_'))]
+    return df.with_columns([pl.Series(c, ajustado[c].to_numpy(dtype=float)) for c in nuevas]).lazy()
+
+def salida_liviana(lf, sucursal_origen='sf'):
+    """ Equivalente a logic.salida_liviana. """
+    columnas = _columnas(lf)
+    finales = []
+    for suc, datos in SUCURSALES.items():
+        col_envio = f'final_enviar_{suc}'
+        if suc == sucursal_origen or datos['stock'] not in columnas or col_envio not in columnas:
+            continue
+        transito = pl.col(datos['transito']) if datos['transito'] in columnas else pl.lit(0)
+        stock_final = pl.col(datos['stock']) + transito + pl.col(col_envio)
+        demanda = _sin_cero(pl.col(f'demanda_estimada_{suc}'), 0.0001)
+        finales.append((stock_final / demanda).alias(f'cobertura_fin_{suc}'))
+    lf = lf.with_columns(finales)
+
+    columnas = _columnas(lf)
+    identificacion = [c for c in logic.COLUMNAS_IDENTIFICACION if c in columnas]
+    decision = [c for c in columnas if c.startswith(('final_enviar_', 'recorte_', 'cobertura_fin_', 'diff_'))]
+    return lf.select(['_fila'] + identificacion + decision if '_fila' in columnas else identificacion + decision)
+
+def calcular_excedentes_sucursales(lf, umbral_meses_exceso=0.5, cob_transferencia_meses=None):
+    """ Equivalente a logic.calcular_excedentes_sucursales (el cruce lateral corre en numpy). """
+    columnas = _columnas(lf)
+    schema = lf.collect_schema()
+    central = SUCURSALES[SUCURSAL_CENTRAL]
+
+    def num(col):
+        return pl.col(col) if col in columnas else pl.lit(0)
+
+    lf = lf.with_columns([
+        (pl.col(c) if schema[c].is_numeric() else pl.col(c).cast(pl.Float64, strict=False)).fill_null(0).alias(c)
+        for c in ['peso', 'volumen']
+    ])
+
+    # Contexto SF
+    obj_sf = 0.5
+    stock_sf_total = pl.col(central['stock']) + num(central['entrante'])
+    target_sf = pl.col(f'demanda_estimada_{SUCURSAL_CENTRAL}') * obj_sf
+    lf = lf.with_columns(sf_deficit=target_sf - stock_sf_total)
+    lf = lf.with_columns(sf_necesita_stock=(pl.col('sf_deficit') > 0).fill_null(False))
+
+    for suc, datos in SUCURSALES.items():
+        if suc == SUCURSAL_CENTRAL:
+            continue
+        stock = pl.col(datos['stock'])
+        stock_suc = stock + num(datos['transito_devolucion'])
+        demanda_suc = pl.col(f'demanda_estimada_{suc}')
+
+        cobertura_actual = stock_suc / demanda_suc
+        mask_exceso = (
+            (cobertura_actual > umbral_meses_exceso) & cobertura_actual.is_not_nan() & (stock > 0)
+        ).fill_null(False)
+
+        excedente_teorico = stock_suc - demanda_suc * umbral_meses_exceso
+        excedente_final = _minimo(excedente_teorico, stock.cast(pl.Float64)).floor()
+
+        col_excedente = f'excedente_qty_{suc}'
+        lf = lf.with_columns(
+            pl.when(mask_exceso).then(excedente_final).otherwise(0.0).clip(lower_bound=0)
+            .cast(pl.Int64, strict=False).alias(col_excedente)
+        )
+        lf = lf.with_columns([
+            (pl.col(col_excedente) * pl.col('peso')).alias(f'excedente_peso_{suc}'),
+            (pl.col(col_excedente) * pl.col('volumen')).alias(f'excedente_vol_{suc}'),
+            ((pl.col(col_excedente) > 0) & pl.col('sf_necesita_stock')).fill_null(False).alias(f'prioridad_retorno_{suc}'),
+        ])
+
+    if cob_transferencia_meses is not None:
+        sucursales = [s for s in SUCURSALES if s != SUCURSAL_CENTRAL]
+        df = lf.collect()
+        columnas = df.columns
+
+        def matriz(exprs):
+            return df.select(exprs).to_numpy().astype(float)
+
+        excedente = matriz([pl.col(f'excedente_qty_{suc}') for suc in sucursales])
+        stock = matriz([
+            (pl.col(SUCURSALES[suc]['stock']) + (
+                pl.col(SUCURSALES[suc]['transito_devolucion']) if SUCURSALES[suc]['transito_devolucion'] in columnas else pl.lit(0)
+            )).alias(suc)
+            for suc in sucursales
+        ])
+        demanda = matriz([pl.col(f'demanda_estimada_{suc}') for suc in sucursales])
+        envios, retorno = logic._rebalanceo_lateral(excedente, stock, demanda, cob_transferencia_meses)
+
+        nuevas = [
+            pl.Series(f'transferir_{origen}_a_{destino}', envios[:, o, d].astype(np.int64))
+            for o, origen in enumerate(sucursales) for d, destino in enumerate(sucursales) if o != d
+        ]
+        for i, suc in enumerate(sucursales):
+            retorno_qty = pl.lit(pl.Series(retorno[:, i].astype(np.int64)))
+            nuevas += [
+                retorno_qty.alias(f'retorno_qty_{suc}'),
+                (retorno_qty * pl.col('peso')).alias(f'retorno_peso_{suc}'),
+                (retorno_qty * pl.col('volumen')).alias(f'retorno_vol_{suc}'),
+            ]
+        lf = df.with_columns(nuevas).lazy()
+        lf = lf.with_columns([
+            ((pl.col(f'retorno_qty_{suc}') > 0) & pl.col('sf_necesita_stock')).fill_null(False).alias(f'prioridad_retorno_{suc}')
+            for suc in sucursales
+        ])
+    return lf
+
+# Etapas del pipeline (mismos nombres que pipeline.ETAPAS_*)
+def _etapa_excedentes(lf, parametros):
+    lf = preparar_stock_fisico(lf)
+    return calcular_excedentes_sucursales(
+        lf, umbral_meses_exceso=parametros['umbral_devolucion'],
+        cob_transferencia_meses=parametros.get('cob_transferencia_meses')
+    )
+
+ETAPAS = {
+    'parametros_w': lambda lf, p: calcular_parametros_w(lf, p.get('sumas_familia')),
+    'familias': lambda lf, p: filtrar_familias(lf, p.get('familias')),
+    'demanda': lambda lf, p: estimar_demanda(lf, p['metodo_demanda'], p.get('historial_mensual')),
+    'coberturas': lambda lf, p: calcular_coberturas(
+        lf, sucursal_origen=p['sucursal_origen'],
+        cob_origen_meses=p['cob_origen_meses'], cob_destino_meses=p['cob_destino_meses']
+    ),
+    'distribucion': lambda lf, p: distribuir_stock(lf, sucursal_origen=p['sucursal_origen']),
+    'capacidad': lambda lf, p: ajustar_a_capacidad(
+        lf, p['capacidad_destinos'], p['sucursal_origen'], p['cob_destino_meses']
+    ) if p.get('capacidad_destinos') else lf,
+    'salida': lambda lf, p: salida_liviana(lf, p['sucursal_origen']) if p.get('salida_liviana') else lf,
+    'excedentes': _etapa_excedentes,
+}
+
+def ejecutar_etapas(datos, parametros, nombres):
+    """
+    Arma una única consulta lazy con las etapas indicadas y la ejecuta.
+
+    Args:
+        datos: pandas DataFrame, pl.DataFrame o pl.LazyFrame (ej: pl.scan_csv)
+        parametros: Parámetros de las etapas (ver pipeline.ejecutar_pipeline)
+        nombres: Nombres de las etapas en orden
+
+    Returns:
+        pandas DataFrame si la entrada es pandas (con el mismo índice que el motor pandas),
+        si no pl.DataFrame
+    """
+    _verificar_polars()
+    no_soportadas = [nombre for nombre in nombres if nombre not in ETAPAS]
+    if no_soportadas:
+        raise ValueError(
+            f"El motor 'polars' no soporta la(s) etapa(s) {', '.join(no_soportadas)}: usar motor='pandas'"
+        )
+    es_pandas = isinstance(datos, pd.DataFrame)
+    if es_pandas:
+        lf = pl.from_pandas(datos, include_index=False).lazy()
+    else:
+        lf = datos.lazy()
+
+    # calcular_parametros_w reinicia el índice (merge): se conserva la posición original
+    lf = lf.with_row_index('_fila')
+    for nombre in nombres:
+        lf = ETAPAS[nombre](lf, parametros)
+    resultado = lf.collect()
+
+    if not es_pandas:
+        return resultado.drop('_fila')
+    df = resultado.drop('_fila').to_pandas()
+    if 'familia_logica' in df.columns:
+        df['familia_logica'] = df['familia_logica'].cat.as_unordered()
+    df.index = resultado['_fila'].to_numpy().astype(np.int64)
+    return df
@@ -0,0 +1,613 @@
+import hashlib
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import logic
+import logic_polars
+import utils
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Pipeline de reposición como etapas con parámetros declarados.
+# Cada etapa tiene una clave armada con la clave de la etapa anterior (que arranca
+# en el hash de los datos) y los parámetros propios de la etapa; las etapas de
+# ETAPAS_CACHEADAS guardan su resultado bajo esa clave. Si cambia un parámetro, se
+# retoma desde el último resultado guardado anterior a esa etapa.
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _etapa_parametros_w(df, parametros):
+    return logic.calcular_parametros_w(df, parametros.get('sumas_familia'))
+
+def _etapa_familias(df, parametros):
+    familias = parametros.get('familias')
+    if familias:
+        df = df[df['familia_logica'].isin(familias)]
+    return df
+
+def _etapa_demanda(df, parametros):
+    return logic.estimar_demanda(
+        df, parametros['metodo_demanda'], disperso=parametros.get('disperso', False),
+        historial=parametros.get('historial_mensual')
+    )
+
+def _etapa_coberturas(df, parametros):
+    return logic.calcular_coberturas(
+        df,
+        sucursal_origen=parametros['sucursal_origen'],
+        cob_origen_meses=parametros['cob_origen_meses'],
+        cob_destino_meses=parametros['cob_destino_meses'],
+        disperso=parametros.get('disperso', False)
+    )
+
+def _etapa_distribucion(df, parametros):
+    return logic.distribuir_stock(
+        df, sucursal_origen=parametros['sucursal_origen'], disperso=parametros.get('disperso', False)
+    )
+
+def _etapa_capacidad(df, parametros):
+    if parametros.get('capacidad_destinos'):
+        df = logic.ajustar_a_capacidad(
+            df, parametros['capacidad_destinos'], parametros['sucursal_origen'], parametros['cob_destino_meses']
+        )
+    return df
+
+def _etapa_salida(df, parametros):
+    if parametros.get('salida_liviana'):
+        df = logic.salida_liviana(df, parametros['sucursal_origen'])
+    return df
+
+def _etapa_red(df, parametros):
+    return logic.resolver_red(
+        df,
+        cob_origen_meses=parametros['cob_origen_meses'],
+        cob_destino_meses=parametros['cob_destino_meses'],
+        costos=parametros.get('costos_tramos')
+    )
+
+def _etapa_excedentes(df, parametros):
+    df = logic.preparar_stock_fisico(df)
+    return logic.calcular_excedentes_sucursales(
+        df, umbral_meses_exceso=parametros['umbral_devolucion'],
+        cob_transferencia_meses=parametros.get('cob_transferencia_meses')
+    )
+
+# Etapas en orden: (nombre, parámetros propios, función)
+ETAPAS_COMUNES = [
+    ('parametros_w', (), _etapa_parametros_w),
+    ('familias', ('familias',), _etapa_familias),
+    ('demanda', ('metodo_demanda', 'disperso', 'clave_historial'), _etapa_demanda),
+]
+
+ETAPAS_REPOSICION = ETAPAS_COMUNES + [
+    ('coberturas', ('sucursal_origen', 'cob_origen_meses', 'cob_destino_meses', 'disperso'), _etapa_coberturas),
+    ('distribucion', ('sucursal_origen', 'disperso'), _etapa_distribucion),
+    ('capacidad', ('sucursal_origen', 'cob_destino_meses', 'capacidad_destinos'), _etapa_capacidad),
+    ('salida', ('salida_liviana',), _etapa_salida),
+]
+
+# Rebalanceo de toda la red en una pasada (solo motor pandas)
+ETAPAS_RED = ETAPAS_COMUNES + [
+    ('red', ('cob_origen_meses', 'cob_destino_meses', 'costos_tramos'), _etapa_red),
+]
+
+ETAPAS_DEVOLUCION = ETAPAS_COMUNES + [
+    ('excedentes', ('umbral_devolucion', 'cob_transferencia_meses'), _etapa_excedentes),
+]
+
+def hash_datos(df):
+    """ Hash de contenido del DataFrame (valores, índice y nombres de columnas). """
+    h = hashlib.sha1()
+    h.update(repr(list(df.columns)).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return h.hexdigest()
+
+def _normalizar_parametro(valor):
+    """ Las listas (ej: familias) y los dicts (ej: costos_tramos) no dependen del orden de carga. """
+    if isinstance(valor, (list, tuple, set)):
+        return tuple(sorted(valor))
+    if isinstance(valor, dict):
+        return tuple(sorted(valor.items()))
+    return valor
+
+def _clave_etapa(clave_anterior, nombre, nombres_parametros, parametros):
+    propios = tuple((p, _normalizar_parametro(parametros.get(p))) for p in nombres_parametros)
+    return hashlib.sha1(f'{clave_anterior}|{nombre}|{propios!r}'.encode('utf-8')).hexdigest()
+
+# Etapas cuyo resultado se guarda en el cache: W y familias los reusan los cambios de
+# método de demanda; la demanda, todos los modos y cualquier cambio de coberturas; la
+# distribución, los cambios de capacidad y salida
+ETAPAS_CACHEADAS = ('familias', 'demanda', 'distribucion')
+# En la sesión de la app no se guardan coberturas ni distribución: llevan las columnas
+# auxiliares y rehacerlos es más barato que retenerlos
+ETAPAS_CACHEADAS_SESION = ('familias', 'demanda')
+MAX_BYTES_CACHE = 512 * 1024 * 1024
+
+# Hash de cada historial mensual ya visto (se calcula una vez por objeto)
+_CLAVES_HISTORIAL = {}
+
+def _clave_historial(historial):
+    """ Hash de historial_mensual, calculado una sola vez por objeto (no modificarlo in situ). """
+    guardado = _CLAVES_HISTORIAL.get(id(historial))
+    if guardado is not None and guardado[0]() is historial:
+        return guardado[1]
+    clave = hash_datos(historial)
+    for muerto in [k for k, (ref, _) in _CLAVES_HISTORIAL.items() if ref() is None]:
+        del _CLAVES_HISTORIAL[muerto]
+    _CLAVES_HISTORIAL[id(historial)] = (weakref.ref(historial), clave)
+    return clave
+
+def _guardar_en_cache(cache, clave, df, max_bytes):
+    """ Guarda df con su tamaño y descarta los usados hace más tiempo hasta entrar en max_bytes. """
+    tamano = int(df.memory_usage(deep=True).sum())
+    if tamano > max_bytes:
+        return
+    cache[clave] = (df, tamano)
+    total = sum(t for _, t in cache.values())
+    while total > max_bytes:
+        _, tamano_viejo = cache.pop(next(iter(cache)))
+        total -= tamano_viejo
+
+def ejecutar_pipeline(df, parametros, etapas=None, cache=None, hasta=None, max_bytes=MAX_BYTES_CACHE, clave_datos=None,
+                      motor='pandas', puntos_cache=ETAPAS_CACHEADAS):
+    """
+    Ejecuta las etapas reutilizando los resultados cacheados.
+
+    Args:
+        df: DataFrame de entrada (ya filtrado)
+        parametros: Dict con los parámetros de las etapas (metodo_demanda, familias,
+                    sucursal_origen, cob_origen_meses, cob_destino_meses, umbral_devolucion,
+                    disperso: guardar demandas, coberturas, diferencias y envíos por sucursal
+                              como columnas dispersas,
+                    salida_liviana: devolver solo identificación y columnas de decisión,
+                    capacidad_destinos: {destino: (peso_max, volumen_max)} para recortar los envíos,
+                    costos_tramos: {(origen, destino): costo} para la etapa red,
+                    cob_transferencia_meses: cobertura objetivo para cruzar excedentes entre sucursales,
+                    historial_mensual: historial del Método C (ver utils.cargar_historial); su
+                    hash se guarda en clave_historial para la clave de la etapa demanda)
+        etapas: Lista de etapas a ejecutar (por defecto ETAPAS_REPOSICION)
+        cache: Dict donde se guardan los resultados (ej: uno guardado en st.session_state); None = sin cache
+        hasta: Nombre de la última etapa a ejecutar
+        max_bytes: Tamaño máximo del cache; se descartan los resultados usados hace más tiempo
+        clave_datos: Hash de df ya calculado (evita recalcularlo en ejecuciones sucesivas)
+        motor: 'pandas' o 'polars'. Con 'polars' (requiere polars instalado) todas las etapas
+               se arman como una única consulta lazy y se ejecutan juntas, sin cache por etapa.
+        puntos_cache: Nombres de las etapas cuyo resultado se guarda en el cache
+
+    Returns:
+        (DataFrame resultado, lista de etapas recalculadas)
+    """
+    if etapas is None: etapas = ETAPAS_REPOSICION
+
+    if motor == 'polars':
+        nombres = [nombre for nombre, _, _ in etapas]
+        if hasta is not None:
+            nombres = nombres[:nombres.index(hasta) + 1]
+        return logic_polars.ejecutar_etapas(df, parametros, nombres), nombres
+
+    if parametros.get('historial_mensual') is not None and 'clave_historial' not in parametros:
+        parametros = {**parametros, 'clave_historial': _clave_historial(parametros['historial_mensual'])}
+
+    nombres = [nombre for nombre, _, _ in etapas]
+    if hasta is not None:
+        etapas = etapas[:nombres.index(hasta) + 1]
+
+    claves = []
+    clave = clave_datos if clave_datos is not None else hash_datos(df)
+    for nombre, nombres_parametros, _ in etapas:
+        clave = _clave_etapa(clave, nombre, nombres_parametros, parametros)
+        claves.append(clave)
+
+    # Arrancar desde la última etapa cacheada
+    inicio = 0
+    if cache is not None:
+        for i in range(len(claves) - 1, -1, -1):
+            if claves[i] in cache:
+                # Reinsertar para mantener el orden de uso reciente
+                cache[claves[i]] = cache.pop(claves[i])
+                df = cache[claves[i]][0]
+                inicio = i + 1
+                break
+
+    # Las funciones de logic agregan columnas in-place: se copia solo lo que no es
+    # propio (la entrada o un resultado cacheado)
+    compartido = True
+    recalculadas = []
+    for i in range(inicio, len(etapas)):
+        nombre, _, funcion = etapas[i]
+        df = funcion(df.copy() if compartido else df, parametros)
+        compartido = False
+        recalculadas.append(nombre)
+        if cache is not None and nombre in puntos_cache:
+            _guardar_en_cache(cache, claves[i], df, max_bytes)
+            compartido = True
+
+    return (df.copy() if compartido else df), recalculadas
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Ejecución en paralelo por familia lógica
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _ejecutar_etapas(df, etapas, parametros):
+    for _, _, funcion in etapas:
+        df = funcion(df, parametros)
+    return df
+
+def ejecutar_por_familias(df, parametros, etapas=None, max_procesos=None):
+    """
+    Ejecuta las etapas repartiendo el trabajo por familia lógica en un pool de procesos.
+    Wf (la única dependencia entre familias) y el filtro de familias se calculan antes
+    sobre todo df; el resto de las etapas corre por familia y los resultados se
+    concatenan en el orden original de las filas. El recorte por capacidad (y lo que
+    sigue) depende de todo el catálogo y corre después, sobre el resultado unido.
+
+    Args:
+        df: DataFrame de entrada (ya filtrado)
+        parametros: Parámetros de las etapas (ver ejecutar_pipeline)
+        etapas: Lista de etapas a ejecutar (por defecto ETAPAS_REPOSICION)
+        max_procesos: Procesos del pool (None = todos los núcleos, 1 = sin pool)
+
+    Returns:
+        DataFrame resultado
+    """
+    if etapas is None: etapas = ETAPAS_REPOSICION
+
+    # Etapas globales: hasta el filtro de familias inclusive
+    nombres = [nombre for nombre, _, _ in etapas]
+    corte = nombres.index('familias') + 1
+    df = _ejecutar_etapas(df.copy(), etapas[:corte], parametros)
+    fin = nombres.index('capacidad') if 'capacidad' in nombres else len(etapas)
+    por_familia = etapas[corte:fin]
+
+    posiciones = list(df.groupby('familia_logica', observed=True).indices.values())
+    if len(posiciones) <= 1 or max_procesos == 1:
+        df = _ejecutar_etapas(df, por_familia, parametros)
+    else:
+        particiones = [df.iloc[pos] for pos in posiciones]
+        with ProcessPoolExecutor(max_workers=max_procesos) as pool:
+            partes = list(pool.map(_ejecutar_etapas, particiones,
+                                   [por_familia] * len(particiones), [parametros] * len(particiones)))
+
+        orden = np.argsort(np.concatenate(posiciones), kind='stable')
+        df = pd.concat(partes).iloc[orden]
+
+    return _ejecutar_etapas(df, etapas[fin:], parametros)
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Vista previa progresiva
+# ─────────────────────────────────────────────────────────────────────────────
+
+def ejecutar_progresivo(df, parametros, etapas=None, n_prioritarios=2000, cobertura_meses=1.0, cache=None,
+                        clave_datos=None, puntos_cache=ETAPAS_CACHEADAS):
+    """
+    Ejecuta las etapas en dos entregas: primero solo los SKUs prioritarios (ver
+    logic.seleccionar_prioritarios), después el catálogo completo. Las etapas por SKU
+    dan en la vista previa los mismos valores que en el resultado completo; el recorte
+    por capacidad depende de todo el catálogo y solo se aplica en la segunda entrega.
+
+    Args:
+        df, parametros, etapas, cache, clave_datos, puntos_cache: Como en ejecutar_pipeline
+        n_prioritarios: SKUs a incluir en la vista previa
+        cobertura_meses: Los SKUs con menos cobertura que esta en alguna sucursal van primero
+
+    Yields:
+        (DataFrame, es_final): la vista previa y luego el resultado completo
+    """
+    if etapas is None: etapas = ETAPAS_REPOSICION
+    if clave_datos is None: clave_datos = hash_datos(df)
+
+    base, _ = ejecutar_pipeline(df, parametros, etapas=etapas, cache=cache, hasta='demanda', clave_datos=clave_datos,
+                                puntos_cache=puntos_cache)
+    posiciones = logic.seleccionar_prioritarios(base, n_prioritarios, cobertura_meses)
+    nombres = [nombre for nombre, _, _ in etapas]
+    por_sku = [etapa for etapa in etapas[nombres.index('demanda') + 1:] if etapa[0] != 'capacidad']
+    yield _ejecutar_etapas(base.iloc[posiciones].copy(), por_sku, parametros), False
+
+    completo, _ = ejecutar_pipeline(df, parametros, etapas=etapas, cache=cache, clave_datos=clave_datos,
+                                    puntos_cache=puntos_cache)
+    yield completo, True
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Traza de cálculo de un SKU
+# ─────────────────────────────────────────────────────────────────────────────
+
+def explicar_sku(df, codigo, parametros, estado=None, resultado=None):
+    """
+    Recalcula la traza completa de Reposición para un único SKU: parámetros W,
+    demanda, coberturas, objetivos, necesidad por destino, disponible en origen y
+    envío final. Pensado para la salida liviana, que no guarda las columnas auxiliares.
+    Con capacidad_destinos el recorte depende de todo el catálogo: el envío sin recortar
+    queda en envio_sin_recorte y final_enviar y recorte se toman del resultado completo.
+
+    Args:
+        df: DataFrame de entrada (el mismo que se pasó a ejecutar_pipeline)
+        codigo: Código del SKU
+        parametros: Los mismos parámetros usados en el cálculo
+        estado: Sumas por familia (ver estado_familias); por defecto se calculan sobre df
+        resultado: Resultado de ejecutar_pipeline con esos parámetros (el que se muestra);
+                   solo se usa con capacidad_destinos y, si falta, se recalcula
+
+    Returns:
+        Dict con 'sku' (Series con los valores del SKU) y 'sucursales' (DataFrame con
+        una fila por sucursal), o None si el código no está en df
+    """
+    fila = df[df['codigo'].astype(str) == str(codigo)]
+    if fila.empty:
+        return None
+
+    if estado is None:
+        columnas = [c for c in ('subfamilia', 'subfamilia2', 'qrem_total', 'qpres_total') if c in df.columns]
+        w = logic.calcular_parametros_w(df[columnas].copy())
+        estado = estado_familias(w)
+
+    sku = logic.calcular_parametros_w(fila.head(1).copy(), estado)
+    sku = logic.estimar_demanda(sku, parametros['metodo_demanda'], historial=parametros.get('historial_mensual'))
+    sku = logic.calcular_coberturas(
+        sku,
+        sucursal_origen=parametros['sucursal_origen'],
+        cob_origen_meses=parametros['cob_origen_meses'],
+        cob_destino_meses=parametros['cob_destino_meses']
+    )
+
+    # Distribución con los valores intermedios del núcleo
+    m = logic.construir_matrices(sku)
+    m['cobertura_ampliada_total'] = sku['cobertura_ampliada_total'].to_numpy(dtype=float)
+    qty_p, es_filtro = logic._parametros_empaque(sku)
+    i_origen = m['sucursales'].index(parametros['sucursal_origen'])
+    es_origen = np.array([suc == parametros['sucursal_origen'] for suc in m['sucursales']])
+    cob = logic._coberturas_matriz(m, es_origen, parametros['cob_origen_meses'] / 12.0, parametros['cob_destino_meses'] / 12.0)
+    traza = {}
+    envios = logic._distribuir_matriz(
+        m['stock'], m['transito'], m['demanda'], m['diff'], np.array([i_origen]), qty_p, es_filtro, traza=traza
+    )
+
+    sucursales = pd.DataFrame({
+        'rol': np.where(es_origen, 'origen', 'destino'),
+        'remitido': [sku[d['rem']].iloc[0] for d in logic.SUCURSALES.values()],
+        'presupuestado': [sku[d['pres']].iloc[0] for d in logic.SUCURSALES.values()],
+        'demanda_estimada': m['demanda'][0],
+        'stock': m['stock'][0],
+        'transito': m['transito'][0],
+        'entrante': m['entrante'][0],
+        'cobertura_ini': cob['cobertura_ini'][0],
+        'cobertura_ampliada': cob['cobertura_ampliada'][0],
+        'target_eff': cob['target_eff'][0],
+        'diff': m['diff'][0],
+        'falta': traza['falta_base'][0],
+        'envio_deseado': traza['envios_deseados'][0],
+        'final_enviar': envios[0],
+    }, index=m['sucursales'])
+
+    # Recorte por capacidad: sale del catálogo completo, no de este SKU solo
+    if parametros.get('capacidad_destinos'):
+        if resultado is None:
+            resultado, _ = ejecutar_pipeline(df, parametros, hasta='capacidad')
+        fila_resultado = resultado[resultado['codigo'].astype(str) == str(codigo)].head(1)
+        sucursales['envio_sin_recorte'] = sucursales['final_enviar']
+        sucursales['recorte'] = 0.0
+        for suc in m['sucursales']:
+            if not fila_resultado.empty and f'final_enviar_{suc}' in fila_resultado.columns:
+                sucursales.loc[suc, 'final_enviar'] = logic._serie_densa(fila_resultado[f'final_enviar_{suc}']).iloc[0]
+            if not fila_resultado.empty and f'recorte_{suc}' in fila_resultado.columns:
+                sucursales.loc[suc, 'recorte'] = fila_resultado[f'recorte_{suc}'].iloc[0]
+
+    resumen = pd.Series({
+        'codigo': codigo,
+        'familia_logica': sku['familia_logica'].iloc[0],
+        'es_filtro': bool(es_filtro[0]),
+        'qty_piezas': qty_p[0],
+        'Wp': sku['Wp'].iloc[0],
+        'Wf': sku['Wf'].iloc[0],
+        'metodo_demanda': parametros['metodo_demanda'],
+        'demanda_estimada_total': sku['demanda_estimada_total'].iloc[0],
+        'cobertura_ini_total': sku['cobertura_ini_total'].iloc[0],
+        'cobertura_ampliada_total': sku['cobertura_ampliada_total'].iloc[0],
+        'disponible_origen': traza['disponible_origen'][0],
+        'total_deseado': traza['total_deseado'][0],
+        'escasez': bool(traza['total_deseado'][0] > traza['disponible_origen'][0] > 0),
+    })
+    return {'sku': resumen, 'sucursales': sucursales}
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Recalculo incremental de SKUs corregidos
+# ─────────────────────────────────────────────────────────────────────────────
+
+def estado_familias(df):
+    """
+    Sumas de qrem_total y qpres_total por familia lógica (qpres_total ya con 0 -> 1,
+    como queda tras calcular_parametros_w). Es la única dependencia global del cálculo:
+    con ella actualizar_skus ajusta Wf por diferencias sin reagrupar todo el maestro.
+    Debe armarse sobre la salida de calcular_parametros_w, antes del filtro de familias.
+    """
+    sumas = df.groupby(df['familia_logica'].astype(str))[['qrem_total', 'qpres_total']].sum()
+    return sumas.astype(float)
+
+def _wf_familias(estado):
+    return estado['qrem_total'] / estado['qpres_total'].replace(0, 1)
+
+def _asignar_filas(df, posiciones, valores):
+    """ Copia las columnas de valores en las filas indicadas de df, ampliando el dtype si hace falta. """
+    for col in valores.columns:
+        nuevos = valores[col].to_numpy()
+        if col not in df.columns:
+            df[col] = pd.Series(np.nan if pd.api.types.is_numeric_dtype(valores[col]) else None, index=df.index)
+        actual = df[col]
+        if isinstance(actual.dtype, pd.SparseDtype):
+            # Las columnas dispersas no admiten asignación parcial: se rearman
+            densa = actual.to_numpy(dtype=float)
+            densa[posiciones] = nuevos
+            df[col] = pd.arrays.SparseArray(densa, fill_value=actual.dtype.fill_value)
+            continue
+        if pd.api.types.is_numeric_dtype(actual) and pd.api.types.is_numeric_dtype(valores[col]):
+            tipo = np.result_type(actual.dtype, valores[col].dtype)
+            if tipo != actual.dtype:
+                df[col] = actual.astype(tipo)
+        elif isinstance(actual.dtype, pd.CategoricalDtype):
+            faltantes = pd.Index(pd.unique(nuevos)).difference(actual.cat.categories)
+            if len(faltantes) > 0:
+                df[col] = actual.cat.add_categories(faltantes)
+        elif actual.dtype != valores[col].dtype:
+            df[col] = actual.astype(object)
+        df.iloc[posiciones, df.columns.get_loc(col)] = nuevos
+
+def actualizar_skus(df, cambios, parametros, estado):
+    """
+    Aplica correcciones de pocas filas (stock, qty_piezas, qrem/qpres, subfamilias...)
+    sobre un resultado de Reposición ya calculado y recalcula solo los SKUs afectados:
+    las filas editadas y, con Método A, todas las de las familias cuyo Wf cambió.
+
+    Args:
+        df: Resultado de ejecutar_pipeline con ETAPAS_REPOSICION (se modifica in-place)
+        cambios: DataFrame con 'codigo' y las columnas corregidas (NaN = sin cambio)
+        parametros: Los mismos parámetros con los que se calculó df
+        estado: Sumas por familia (ver estado_familias)
+
+    Returns:
+        (df actualizado, estado actualizado, posiciones de las filas recalculadas)
+    """
+    # 1. Filas editadas
+    cambios = cambios.drop_duplicates('codigo', keep='last').set_index('codigo')
+    editadas_pos = np.flatnonzero(df['codigo'].isin(cambios.index).to_numpy())
+    if len(editadas_pos) == 0:
+        return df, estado, editadas_pos
+
+    antes = df.iloc[editadas_pos]
+    editadas = antes.copy()
+    codigos = editadas['codigo'].to_numpy()
+    for col in cambios.columns:
+        nuevos = cambios[col].reindex(codigos)
+        if col in editadas.columns:
+            nuevos = nuevos.where(nuevos.notna(), editadas[col].to_numpy())
+        editadas[col] = nuevos.to_numpy()
+
+    # 2. Parámetros por fila (familia y Wp), igual que calcular_parametros_w
+    if 'subfamilia' in cambios.columns or 'subfamilia2' in cambios.columns:
+        editadas['familia_logica'] = logic.clasificar_familias(editadas)
+    editadas['qpres_total'] = editadas['qpres_total'].replace(0, 1)
+    editadas['Wp'] = editadas['qrem_total'] / editadas['qpres_total']
+
+    # 3. Wf por diferencias: restar el aporte anterior y sumar el nuevo
+    wf_antes = _wf_familias(estado)
+    estado = (
+        estado
+        .sub(estado_familias(antes), fill_value=0)
+        .add(estado_familias(editadas), fill_value=0)
+    )
+    wf_nuevo = _wf_familias(estado)
+    cambio_wf = wf_nuevo.ne(wf_antes.reindex(wf_nuevo.index))
+    familias_movidas = wf_nuevo.index[cambio_wf.to_numpy()]
+
+    # 4. Filas afectadas
+    familia_str = df['familia_logica'].astype(str)
+    en_familia_movida = familia_str.isin(familias_movidas).to_numpy()
+    afectadas = np.zeros(len(df), dtype=bool)
+    afectadas[editadas_pos] = True
+    if parametros['metodo_demanda'] == 'A':
+        # Con Método A la demanda depende de Wf: toda la familia se recalcula
+        afectadas |= en_familia_movida
+    elif en_familia_movida.any():
+        # Con Método B Wf solo se informa: se actualiza la columna sin recalcular
+        df.loc[en_familia_movida, 'Wf'] = familia_str[en_familia_movida].map(wf_nuevo).fillna(0).to_numpy()
+    afectadas_pos = np.flatnonzero(afectadas)
+
+    # 5. Recalcular demanda, coberturas y distribución solo para las filas afectadas
+    sub = df.iloc[afectadas_pos].copy()
+    _asignar_filas(sub, np.searchsorted(afectadas_pos, editadas_pos), editadas)
+    sub['Wf'] = sub['familia_logica'].astype(str).map(wf_nuevo).fillna(0)
+
+    sub = logic.estimar_demanda(sub, parametros['metodo_demanda'], historial=parametros.get('historial_mensual'))
+    sub = logic.calcular_coberturas(
+        sub,
+        sucursal_origen=parametros['sucursal_origen'],
+        cob_origen_meses=parametros['cob_origen_meses'],
+        cob_destino_meses=parametros['cob_destino_meses']
+    )
+    sub = logic.distribuir_stock(sub, sucursal_origen=parametros['sucursal_origen'])
+
+    _asignar_filas(df, afectadas_pos, sub)
+
+    # 6. El recorte por capacidad compite entre todos los SKUs del destino: se vuelve a
+    #    recortar el catálogo desde los envíos sin recortar
+    capacidades = parametros.get('capacidad_destinos')
+    if capacidades:
+        antes = {suc: logic._serie_densa(df[f'final_enviar_{suc}']).to_numpy(dtype=float).copy()
+                 for suc in capacidades if f'recorte_{suc}' in df.columns}
+        for suc, envio in antes.items():
+            recorte = df[f'recorte_{suc}'].to_numpy(dtype=float).copy()
+            recorte[afectadas_pos] = 0
+            disperso = isinstance(df[f'final_enviar_{suc}'].dtype, pd.SparseDtype)
+            df[f'final_enviar_{suc}'] = logic._columna_sucursal(envio + recorte, disperso)
+        logic.ajustar_a_capacidad(df, capacidades, parametros['sucursal_origen'], parametros['cob_destino_meses'])
+        for suc, envio in antes.items():
+            afectadas |= logic._serie_densa(df[f'final_enviar_{suc}']).to_numpy(dtype=float) != envio
+        afectadas_pos = np.flatnonzero(afectadas)
+
+    return df, estado, afectadas_pos
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Ejecución por bloques (maestros que no entran en memoria)
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _sumas_por_bloques(ruta, tamano_bloque, filtros, encoding):
+    """ Primera pasada: sumas por familia lógica (la única dependencia global, Wf). """
+    columnas = None if filtros is not None else {'subfamilia', 'subfamilia2', 'qrem_total', 'qpres_total'}
+    sumas = None
+    filas = 0
+    for bloque in utils.leer_csv_por_bloques(ruta, tamano_bloque, columnas=columnas, encoding=encoding):
+        if filtros is not None:
+            bloque = filtros(bloque)
+        filas += len(bloque)
+        bloque['familia_logica'] = logic.clasificar_familias(bloque)
+        bloque['qpres_total'] = bloque['qpres_total'].replace(0, 1)
+        parcial = estado_familias(bloque)
+        sumas = parcial if sumas is None else sumas.add(parcial, fill_value=0)
+    return sumas, filas
+
+def ejecutar_por_bloques(ruta_entrada, ruta_salida, parametros, etapas=None, tamano_bloque=100_000,
+                         filtros=None, columnas_salida=None):
+    """
+    Ejecuta las etapas sobre un CSV en dos pasadas por bloques, sin cargar el maestro
+    completo: la memoria queda acotada por el tamaño de bloque.
+      1. Se recorren los bloques acumulando las sumas por familia para Wf.
+      2. Se recorren otra vez calculando cada bloque con esas sumas y se agrega
+         el resultado al CSV de salida.
+
+    Args:
+        ruta_entrada: CSV estándar (mismo formato que admite utils.cargar_datos)
+        ruta_salida: CSV donde se escribe el resultado
+        parametros: Parámetros de las etapas (ver ejecutar_pipeline)
+        etapas: Lista de etapas a ejecutar (por defecto ETAPAS_REPOSICION)
+        tamano_bloque: Filas por bloque
+        filtros: Función DataFrame -> DataFrame aplicada a cada bloque antes de calcular
+                 (ej: utils.aplicar_filtros_avanzados con sus opciones); debe filtrar fila a fila
+        columnas_salida: Columnas a escribir (None = todas)
+
+    Returns:
+        Dict con filas_entrada (tras filtros), filas_salida y bloques
+    """
+    if etapas is None: etapas = ETAPAS_REPOSICION
+    if parametros.get('capacidad_destinos') and any(nombre == 'capacidad' for nombre, _, _ in etapas):
+        raise ValueError("El recorte por capacidad depende de todo el catálogo y no se puede calcular por bloques")
+
+    try:
+        encoding = 'utf-8'
+        sumas, filas_entrada = _sumas_por_bloques(ruta_entrada, tamano_bloque, filtros, encoding)
+    except UnicodeDecodeError:
+        encoding = 'latin-1'
+        sumas, filas_entrada = _sumas_por_bloques(ruta_entrada, tamano_bloque, filtros, encoding)
+
+    parametros = dict(parametros, sumas_familia=sumas)
+    filas_salida = 0
+    bloques = 0
+    for bloque in utils.leer_csv_por_bloques(ruta_entrada, tamano_bloque, encoding=encoding):
+        if filtros is not None:
+            bloque = filtros(bloque)
+        for _, _, funcion in etapas:
+            bloque = funcion(bloque, parametros)
+        if columnas_salida is not None:
+            bloque = bloque[[c for c in columnas_salida if c in bloque.columns]]
+
+        bloque.to_csv(ruta_salida, mode='w' if bloques == 0 else 'a', header=bloques == 0, index=False)
+        filas_salida += len(bloque)
+        bloques += 1
+
+    return {'filas_entrada': filas_entrada, 'filas_salida': filas_salida, 'bloques': bloques}
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logic
+
+
+def generar_maestro(n=2000, seed=0):
+    """ Maestro sintético con las columnas que usa el cálculo. """
+    r = np.random.default_rng(seed)
+    subfamilias = np.array(['FILTRO DONALDSON', 'TURBO X', 'KTN', 'GET', 'RODAJE', 'REPUESTO', 'VARIOS', 'FILTROS'])
+    df = pd.DataFrame({
+        'codigo': [f'C{i}' for i in range(n)],
+        'descripcion': 'x',
+        'subfamilia': r.choice(subfamilias, n),
+        'subfamilia2': r.choice(['', 'KTN', 'TURBO', 'ABC'], n),
+        'qty_piezas': r.choice([1, 2, 4, 6, 12], n),
+        'peso': r.random(n) * 5,
+        'volumen': r.random(n),
+    })
+    for datos in logic.SUCURSALES.values():
+        df[datos['rem']] = r.poisson(3, n) * (r.random(n) < .6)
+        df[datos['pres']] = r.poisson(4, n) * (r.random(n) < .6)
+        for c in datos['depositos']:
+            df[c] = r.poisson(2, n) * (r.random(n) < .5)
+        df[datos['transito']] = r.poisson(1, n) * (r.random(n) < .2)
+        df[datos['entrante']] = r.poisson(1, n) * (r.random(n) < .1)
+        df[datos['transito_devolucion']] = r.poisson(1, n) * (r.random(n) < .2)
+    df['qrem_total'] = df[[d['rem'] for d in logic.SUCURSALES.values()]].sum(axis=1)
+    df['qpres_total'] = df[[d['pres'] for d in logic.SUCURSALES.values()]].sum(axis=1)
+    df['stock_total'] = df[[c for d in logic.SUCURSALES.values() for c in d['depositos']]].sum(axis=1)
+    return df
+
+
+@pytest.fixture
+def maestro():
+    return generar_maestro()
+
+
+@pytest.fixture
+def con_demanda(maestro):
+    df = logic.calcular_parametros_w(maestro)
+    return logic.estimar_demanda(df, 'B')
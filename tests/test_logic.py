@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+
+import logic
+
+
+def test_cascada_no_devuelve_a_origenes_anteriores(con_demanda):
+    cascada = ['sf', 'ba', 'mdz']
+    df = logic.planificar_multi_origen(con_demanda, origenes=['sf'], cascada=cascada)['cascada']
+    for k, origen in enumerate(cascada):
+        for anterior in cascada[:k]:
+            assert (df[f'final_enviar_{anterior}_desde_{origen}'] == 0).all()
+
+
+def test_riesgo_quiebre_sku_de_alto_volumen():
+    # 20.000 unidades/mes contra 15.000 en stock: se sortea directo, sin tabular
+    media, disponible = np.array([[20_000.0]]), np.array([[15_000.0]])
+    assert logic._umbrales_poisson(media, disponible)[0, 0] == 1.0
+
+    df = pd.DataFrame({
+        'codigo': ['A', 'B'],
+        'stock_ba': [15_000, 5],
+        'demanda_estimada_ba': [20_000 * 12, 12],
+        'final_enviar_ba': [10_000, 0],
+    })
+    df, _ = logic.simular_riesgo_quiebre(df, n_ensayos=200)
+    assert df.loc[0, 'prob_quiebre_antes_ba'] == 1.0
+    assert df.loc[0, 'prob_quiebre_despues_ba'] == 0.0
+    assert 0.0 <= df.loc[1, 'prob_quiebre_antes_ba'] < 0.1
+
+
+def test_empaquetar_no_excede_camiones_compartidos():
+    # Un bulto de 356 kg en camiones de 200 kg va solo; las unidades sin peso no se le suman
+    peso = np.array([356.0, 0.0, 3.0])
+    volumen = np.array([1.0, 0.5, 0.0])
+    cargas, _ = logic._empaquetar(
+        unidades=[1, 3, 4], tamano_bulto=[1, 1, 1], peso=peso, volumen=volumen,
+        capacidad_peso=200.0, capacidad_volumen=10.0,
+    )
+    cargas['peso'] = cargas['unidades'] * peso[cargas['linea']]
+    cargas['volumen'] = cargas['unidades'] * volumen[cargas['linea']]
+    por_camion = cargas.groupby('camion').agg(lineas=('linea', 'nunique'), peso=('peso', 'sum'),
+                                              volumen=('volumen', 'sum'))
+    compartidos = por_camion[por_camion['lineas'] > 1]
+    assert (compartidos['peso'] <= 200.0 + 1e-9).all()
+    assert (compartidos['volumen'] <= 10.0 + 1e-9).all()
+    assert cargas.groupby('linea')['unidades'].sum().tolist() == [1, 3, 4]
+
+
+def test_retornos_acreditan_el_deficit_central_una_sola_vez():
+    df = pd.DataFrame({
+        'codigo': ['A', 'B'],
+        'peso': [1.0, 1.0],
+        'volumen': [0.01, 0.01],
+        'qty_piezas': [1, 1],
+        'familia_logica': ['REPUESTO', 'REPUESTO'],
+        'sf_deficit': [10.0, 0.0],
+        'retorno_qty_ba': [10, 5],
+        'retorno_qty_mdz': [10, 0],
+    })
+    manifiesto, _ = logic.armar_retornos(df)
+    valor = manifiesto.groupby(['sucursal', 'codigo'])['valor'].sum()
+    assert valor[('ba', 'A')] == 5.0
+    assert valor[('mdz', 'A')] == 5.0
+    assert valor[('ba', 'B')] == 0.0
+
+
+def test_metodo_c_usa_metodo_b_en_sucursales_sin_historial(maestro):
+    df = logic.calcular_parametros_w(maestro)
+    # Historial solo de la central y de la mitad de los SKUs
+    codigos = df['codigo'].iloc[:len(df) // 2]
+    meses = [f'2024-{m:02d}' for m in range(1, 13)] + [f'2025-{m:02d}' for m in range(1, 13)]
+    valores = np.random.default_rng(1).poisson(2, (len(codigos), len(meses)))
+    historial = pd.DataFrame(valores, index=codigos, columns=pd.MultiIndex.from_product([['sf'], meses]))
+
+    metodo_b = logic.estimar_demanda(df.copy(), 'B')
+    metodo_c = logic.estimar_demanda(df.copy(), 'C', historial=historial)
+    for suc in ['ba', 'mdz', 'slt']:
+        assert np.allclose(metodo_c[f'demanda_estimada_{suc}'], metodo_b[f'demanda_estimada_{suc}'])
+    resto = slice(len(df) // 2, None)
+    assert np.allclose(metodo_c['demanda_estimada_sf'].iloc[resto], metodo_b['demanda_estimada_sf'].iloc[resto])
+    assert not np.allclose(metodo_c['demanda_estimada_sf'].iloc[:len(df) // 2],
+                           metodo_b['demanda_estimada_sf'].iloc[:len(df) // 2])
+
+
+def test_red_asigna_tramos_a_costo_minimo():
+    # sf y ba ofrecen una unidad, mdz y slt piden una: por tramo de menor costo sale
+    # sf -> mdz (0) y ba -> slt (10); el óptimo cruza los tramos por 1 + 1
+    costo = np.array([
+        [0.0, 1.0, 0.0, 1.0],
+        [1.0, 0.0, 1.0, 10.0],
+        [1.0, 1.0, 0.0, 1.0],
+        [1.0, 1.0, 1.0, 0.0],
+    ])
+    disponible = np.array([[1.0, 1.0, 0.0, 0.0]])
+    envios = np.zeros((1, 4, 4))
+    envios[0, 0, 2] = envios[0, 1, 3] = 1.0
+    logic._cancelar_ciclos_negativos(envios, disponible, costo)
+    assert (envios * costo).sum() == 2.0
+    assert envios.sum(axis=1).tolist() == [[0.0, 0.0, 1.0, 1.0]]
+
+
+def test_simular_semanas_todo_lo_despachado_llega(con_demanda):
+    df = logic.distribuir_stock(logic.calcular_coberturas(con_demanda))
+    semanas = 6
+    for demora in (0, 1, 2):
+        sim = logic.simular_semanas(df, semanas=semanas, demora_envio_semanas=demora)
+        despachado = sim.loc[sim['semana'] <= semanas - demora, 'unidades_enviadas'].sum()
+        assert np.isclose(sim['unidades_recibidas'].sum(), despachado)
+
+    # Los tránsitos iniciales llegan igual en la semana 0 que en la 1 (antes del primer consumo)
+    arribo_0 = logic.simular_semanas(df, semanas=semanas, semanas_arribo_transito=0)
+    arribo_1 = logic.simular_semanas(df, semanas=semanas, semanas_arribo_transito=1)
+    assert arribo_0.drop(columns='unidades_recibidas').equals(arribo_1.drop(columns='unidades_recibidas'))
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import logic
+import pipeline
+
+PARAMETROS = dict(familias=None, metodo_demanda='B', sucursal_origen='sf', cob_origen_meses=6.0, cob_destino_meses=4.0)
+
+
+def test_cache_guarda_solo_puntos_y_respeta_tamano(maestro):
+    referencia, _ = pipeline.ejecutar_pipeline(maestro, PARAMETROS)
+
+    cache = {}
+    pipeline.ejecutar_pipeline(maestro, PARAMETROS, cache=cache)
+    assert len(cache) == len(pipeline.ETAPAS_CACHEADAS)
+
+    resultado, recalculadas = pipeline.ejecutar_pipeline(maestro, PARAMETROS, cache=cache)
+    assert recalculadas == ['capacidad', 'salida']
+    assert resultado.equals(referencia)
+
+    # Modificar el resultado no altera lo cacheado
+    resultado['x'] = 1
+    assert pipeline.ejecutar_pipeline(maestro, PARAMETROS, cache=cache)[0].equals(referencia)
+
+    chico = {}
+    limite = max(t for _, t in cache.values())
+    pipeline.ejecutar_pipeline(maestro, PARAMETROS, cache=chico, max_bytes=limite)
+    assert sum(t for _, t in chico.values()) <= limite
+
+
+def test_polars_rechaza_etapas_no_soportadas(maestro):
+    pytest.importorskip('polars')
+    with pytest.raises(ValueError, match='red'):
+        pipeline.ejecutar_pipeline(maestro, PARAMETROS, etapas=pipeline.ETAPAS_RED, motor='polars')
+
+
+def test_modo_disperso_igual_al_denso(maestro):
+    # SKUs sin stock, tránsito ni demanda: quedan fuera del cálculo disperso
+    numericas = maestro.select_dtypes('number').columns.difference(['qty_piezas', 'peso', 'volumen'])
+    maestro.loc[maestro.index[:200], numericas] = 0
+
+    denso, _ = pipeline.ejecutar_pipeline(maestro, PARAMETROS)
+    disperso, _ = pipeline.ejecutar_pipeline(maestro, dict(PARAMETROS, disperso=True))
+    assert list(disperso.columns) == list(denso.columns)
+    for suc in ['sf', 'ba', 'mdz', 'slt']:
+        for col in [f'cobertura_ini_{suc}', f'diff_{suc}']:
+            assert isinstance(disperso[col].dtype, pd.SparseDtype)
+    assert isinstance(disperso['target_sf_eff'].dtype, pd.SparseDtype)
+    for col in denso.columns:
+        if pd.api.types.is_numeric_dtype(denso[col]):
+            assert np.allclose(disperso[col].to_numpy(dtype=float), denso[col].to_numpy(dtype=float), equal_nan=True)
+
+
+def test_cache_de_sesion_no_guarda_columnas_auxiliares(maestro):
+    cache = {}
+    pipeline.ejecutar_pipeline(maestro, PARAMETROS, cache=cache, puntos_cache=pipeline.ETAPAS_CACHEADAS_SESION)
+    assert len(cache) == len(pipeline.ETAPAS_CACHEADAS_SESION)
+    for guardado, _ in cache.values():
+        assert not logic.columnas_auxiliares(guardado)
+        assert not any(c.startswith(('diff_', 'final_enviar_')) for c in guardado.columns)
+
+
+def test_cambio_de_metodo_retoma_desde_demanda(maestro):
+    for puntos in (pipeline.ETAPAS_CACHEADAS, pipeline.ETAPAS_CACHEADAS_SESION):
+        cache = {}
+        pipeline.ejecutar_pipeline(maestro, PARAMETROS, cache=cache, puntos_cache=puntos)
+        _, recalculadas = pipeline.ejecutar_pipeline(
+            maestro, dict(PARAMETROS, metodo_demanda='A'), cache=cache, puntos_cache=puntos
+        )
+        assert recalculadas == ['demanda', 'coberturas', 'distribucion', 'capacidad', 'salida']
+
+
+def test_explicar_sku_muestra_el_envio_recortado(maestro):
+    parametros = dict(PARAMETROS, capacidad_destinos={'ba': (200.0, None)})
+    resultado, _ = pipeline.ejecutar_pipeline(maestro, parametros)
+    recortados = resultado.loc[resultado['recorte_ba'] > 0, 'codigo']
+    assert len(recortados)
+
+    for codigo in recortados.head(3):
+        fila = resultado[resultado['codigo'] == codigo].iloc[0]
+        for res in (resultado, None):
+            traza = pipeline.explicar_sku(maestro, codigo, parametros, resultado=res)['sucursales']
+            assert traza.loc['ba', 'final_enviar'] == fila['final_enviar_ba']
+            assert traza.loc['ba', 'recorte'] == fila['recorte_ba']
+            assert traza.loc['ba', 'envio_sin_recorte'] == fila['final_enviar_ba'] + fila['recorte_ba']
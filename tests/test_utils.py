@@ -0,0 +1,16 @@
+import io
+
+import utils
+
+
+def test_cache_de_maestros_depende_de_la_normalizacion(tmp_path, monkeypatch):
+    contenido = b'codigo;peso\nA;1\nB;2\n'
+    df = utils.cargar_datos(io.BytesIO(contenido), directorio_cache=str(tmp_path))
+    assert 'qrem_total' in df.columns
+    assert len(list(tmp_path.glob('*.parquet'))) == 1
+
+    # Con otra normalización el maestro cacheado no se reutiliza
+    monkeypatch.setattr(utils, 'COLS_RELLENO', utils.COLS_RELLENO + ['columna_nueva'])
+    df = utils.cargar_datos(io.BytesIO(contenido), directorio_cache=str(tmp_path))
+    assert 'columna_nueva' in df.columns
+    assert len(list(tmp_path.glob('*.parquet'))) == 2
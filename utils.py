@@ -1,97 +1,226 @@
 import pandas as pd
+import hashlib
 import io
+import os
+import tempfile
 
-def cargar_datos(uploaded_file):
+# Mapeo ampliado para incluir columnas visuales
+RENAME_MAP = {
+    'código': 'codigo',
+    'descripción': 'descripcion',
+    'descripción2': 'descripcion2', 
+    'descripcion2': 'descripcion2',
+    'familia': 'familia',
+    'subfamilia': 'subfamilia',
+    'subfamilia2': 'subfamilia2', 
+    'grupo stock': 'grupo_stock', 
+    'grupo stock': 'grupo_stock',
+    'inhabilitado': 'inhabilitado',
+    'peso': 'peso',
+    'volumen': 'volumen', # Nueva columna para resumen
+    'qty piezas': 'qty_piezas',
+    
+    # Totales
+    'qpres total': 'qpres_total',
+    'qrem total': 'qrem_total',
+    'stock total': 'stock_total',
+    
+    # Santa Fe
+    'qpressf': 'qpressf',
+    'qremsf': 'qremsf',
+    'stock sf': 'stock_sf',
+    'stock sf final': 'stock_sf_final',
+    'stock aux': 'stock_aux',
+    'stock sv arg': 'stock_sv_arg',
+    'stock sv min': 'stock_sv_min',
+    'stock ns noa': 'stock_ns_noa',
+    
+    # Sucursales
+    'qpresba': 'qpresba',
+    'qremba': 'qremba',
+    'stock ba': 'stock_ba',
+    
+    'qpresmdz': 'qpresmdz',
+    'qremmdz': 'qremmdz',
+    'stock mdz': 'stock_mdz',
+    
+    'qpresslt': 'qpresslt',
+    'qremslt': 'qremslt',
+    'stock slt': 'stock_slt',
+
+    # Extras y Aplicaciones
+    'datos_y_aplicaciones': 'datos_y_aplicaciones'
+}
+
+# Relleno de columnas necesarias para lógica
+COLS_RELLENO = [
+    'qty_ee_transito_sf', 'qty_ot_transito_sf',
+    'qty_transito_ba', 'qty_transito_mdz', 'qty_ot_transito_slt',
+    'qpres_total', 'qrem_total', # Por seguridad
+    'peso', 'volumen'
+]
+
+def detectar_separador(content):
+    """ Detecta ; o , a partir de los primeros bytes del archivo """
+    try:
+        sample = content[:1024].decode('utf-8')
+    except:
+        sample = content[:1024].decode('latin-1')
+    
+    return ';' if ';' in sample and sample.count(';') > sample.count(',') else ','
+
+def normalizar_nombre_columna(col):
+    col = str(col).strip().lower()
+    return RENAME_MAP.get(col, col)
+
+def normalizar_columnas(df):
+    """ Normalización básica de nombres y relleno de columnas necesarias para la lógica """
+    df.columns = [normalizar_nombre_columna(c) for c in df.columns]
+    for col in COLS_RELLENO:
+        if col not in df.columns:
+            df[col] = 0
+    return df
+
+# Cache local de maestros ya normalizados (Parquet), por hash del contenido subido
+DIRECTORIO_CACHE = os.path.join(tempfile.gettempdir(), 'reposicion_cache_maestros')
+LIMITE_CACHE_BYTES = 512 * 1024 * 1024
+# Subir al cambiar la normalización (además de RENAME_MAP y COLS_RELLENO, que ya
+# forman parte de la clave) para no leer maestros cacheados con la versión anterior
+VERSION_NORMALIZACION = 1
+
+def _firma_normalizacion():
+    """ Hash de la versión y las tablas de normalización, parte de la clave del cache. """
+    firma = repr((VERSION_NORMALIZACION, sorted(RENAME_MAP.items()), COLS_RELLENO))
+    return hashlib.sha1(firma.encode('utf-8')).hexdigest()[:12]
+
+def _leer_cache(ruta):
+    """ Lee un maestro cacheado y lo marca como usado recientemente; None si no está. """
+    try:
+        df = pd.read_parquet(ruta, memory_map=True)
+        os.utime(ruta)
+        return df
+    except Exception:
+        return None
+
+def _guardar_cache(df, ruta, directorio, limite_bytes):
+    """
+    Guarda el maestro normalizado y descarta los menos usados (por fecha de último uso)
+    hasta quedar dentro del límite. Si el DataFrame no se puede guardar en Parquet
+    (ej: columnas con tipos mezclados) simplemente no se cachea.
+    """
+    temporal = f'{ruta}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(directorio, exist_ok=True)
+        df.to_parquet(temporal, index=False)
+        os.replace(temporal, ruta)
+
+        archivos = [os.path.join(directorio, f) for f in os.listdir(directorio) if f.endswith('.parquet')]
+        archivos.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(f) for f in archivos)
+        for archivo in archivos:
+            if total <= limite_bytes or archivo == ruta:
+                continue
+            total -= os.path.getsize(archivo)
+            os.remove(archivo)
+    except Exception:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+
+def cargar_datos(uploaded_file, directorio_cache=DIRECTORIO_CACHE, limite_cache_bytes=LIMITE_CACHE_BYTES):
     """
     Carga el archivo CSV estándar.
     Se asume que el archivo ya ha sido pre-procesado o es el original con separadores ; o ,
+    El resultado normalizado se guarda en Parquet bajo el hash del contenido y de la
+    normalización: volver a subir el mismo archivo lo lee de ahí sin parsear el CSV
+    (directorio_cache=None desactiva el cache; limite_cache_bytes acota su tamaño).
     """
     if uploaded_file is not None:
         try:
             # Detección automática de separador
             content = uploaded_file.getvalue()
+
+            ruta_cache = None
+            if directorio_cache is not None:
+                clave = f'{hashlib.sha1(content).hexdigest()}-{_firma_normalizacion()}'
+                ruta_cache = os.path.join(directorio_cache, clave + '.parquet')
+                if os.path.exists(ruta_cache):
+                    df = _leer_cache(ruta_cache)
+                    if df is not None:
+                        return df
+
+            sep = detectar_separador(content)
+            
+            uploaded_file.seek(0)
             try:
-                sample = content[:1024].decode('utf-8')
+                df = pd.read_csv(uploaded_file, sep=sep, encoding='utf-8', on_bad_lines='skip')
             except:
-                sample = content[:1024].decode('latin-1')
-            
-            sep = ';' if ';' in sample and sample.count(';') > sample.count(',') else ','
-            
+                df = pd.read_csv(uploaded_file, sep=sep, encoding='latin-1', on_bad_lines='skip')
+
+            df = normalizar_columnas(df)
+            if ruta_cache is not None:
+                _guardar_cache(df, ruta_cache, directorio_cache, limite_cache_bytes)
+            return df
+        except Exception as e:
+            return None
+    return None
+
+def cargar_historial(uploaded_file):
+    """
+    Carga el historial mensual para el Método C: un CSV con columnas codigo, sucursal,
+    mes (AAAA-MM) y cantidad, una fila por SKU, sucursal y mes.
+    Devuelve un DataFrame indexado por código con columnas (sucursal, mes) en orden
+    cronológico; los meses sin movimiento quedan en 0.
+    """
+    if uploaded_file is not None:
+        try:
+            content = uploaded_file.getvalue()
+            sep = detectar_separador(content)
+
             uploaded_file.seek(0)
             try:
                 df = pd.read_csv(uploaded_file, sep=sep, encoding='utf-8', on_bad_lines='skip')
             except:
+                uploaded_file.seek(0)
                 df = pd.read_csv(uploaded_file, sep=sep, encoding='latin-1', on_bad_lines='skip')
 
-            # Normalización básica
-            df.columns = df.columns.str.strip().str.lower()
-            
-            # Mapeo ampliado para incluir columnas visuales
-            rename_map = {
-                'código': 'codigo',
-                'descripción': 'descripcion',
-                'descripción2': 'descripcion2', 
-                'descripcion2': 'descripcion2',
-                'familia': 'familia',
-                'subfamilia': 'subfamilia',
-                'subfamilia2': 'subfamilia2', 
-                'grupo stock': 'grupo_stock', 
-                'grupo stock': 'grupo_stock',
-                'inhabilitado': 'inhabilitado',
-                'peso': 'peso',
-                'volumen': 'volumen', # Nueva columna para resumen
-                'qty piezas': 'qty_piezas',
-                
-                # Totales
-                'qpres total': 'qpres_total',
-                'qrem total': 'qrem_total',
-                'stock total': 'stock_total',
-                
-                # Santa Fe
-                'qpressf': 'qpressf',
-                'qremsf': 'qremsf',
-                'stock sf': 'stock_sf',
-                'stock sf final': 'stock_sf_final',
-                'stock aux': 'stock_aux',
-                'stock sv arg': 'stock_sv_arg',
-                'stock sv min': 'stock_sv_min',
-                'stock ns noa': 'stock_ns_noa',
-                
-                # Sucursales
-                'qpresba': 'qpresba',
-                'qremba': 'qremba',
-                'stock ba': 'stock_ba',
-                
-                'qpresmdz': 'qpresmdz',
-                'qremmdz': 'qremmdz',
-                'stock mdz': 'stock_mdz',
-                
-                'qpresslt': 'qpresslt',
-                'qremslt': 'qremslt',
-                'stock slt': 'stock_slt',
-
-                # Extras y Aplicaciones
-                'datos_y_aplicaciones': 'datos_y_aplicaciones'
-            }
-            
-            df = df.rename(columns=rename_map)
-            
-            # Relleno de columnas necesarias para lógica
-            cols_relleno = [
-                'qty_ee_transito_sf', 'qty_ot_transito_sf',
-                'qty_transito_ba', 'qty_transito_mdz', 'qty_ot_transito_slt',
-                'qpres_total', 'qrem_total', # Por seguridad
-                'peso', 'volumen'
-            ]
-            for col in cols_relleno:
-                if col not in df.columns:
-                    df[col] = 0
+            df.columns = [normalizar_nombre_columna(c) for c in df.columns]
+            df['sucursal'] = df['sucursal'].astype(str).str.strip().str.lower()
+            df['mes'] = df['mes'].astype(str).str.strip()
+            df['cantidad'] = pd.to_numeric(df['cantidad'], errors='coerce').fillna(0)
 
-            return df
+            historial = df.pivot_table(
+                index='codigo', columns=['sucursal', 'mes'], values='cantidad', aggfunc='sum', fill_value=0
+            )
+            meses = sorted(historial.columns.get_level_values('mes').unique())
+            sucursales = historial.columns.get_level_values('sucursal').unique()
+            return historial.reindex(columns=pd.MultiIndex.from_product([sucursales, meses]), fill_value=0)
         except Exception as e:
             return None
     return None
 
+def leer_csv_por_bloques(ruta, tamano_bloque, columnas=None, encoding='utf-8'):
+    """
+    Lee un CSV estándar por bloques de `tamano_bloque` filas, con la misma
+    normalización que cargar_datos. Pensado para maestros que no entran en memoria.
+
+    Args:
+        ruta: Ruta del archivo CSV
+        tamano_bloque: Filas por bloque
+        columnas: Columnas normalizadas a leer (None = todas)
+        encoding: Encoding del archivo
+    """
+    with open(ruta, 'rb') as f:
+        sep = detectar_separador(f.read(1024))
+
+    usecols = None
+    if columnas is not None:
+        encabezado = pd.read_csv(ruta, sep=sep, encoding=encoding, nrows=0).columns
+        usecols = [c for c in encabezado if normalizar_nombre_columna(c) in columnas]
+
+    for bloque in pd.read_csv(ruta, sep=sep, encoding=encoding, on_bad_lines='skip',
+                              usecols=usecols, chunksize=tamano_bloque):
+        yield normalizar_columnas(bloque)
+
 def generar_csv_ejemplo():
     """ Genera CSV ejemplo (Simplificado) """
     data = {'codigo': ['A1'], 'descripcion': ['Ejemplo']}